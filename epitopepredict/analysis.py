@@ -32,92 +32,73 @@ datadir = os.path.join(home, 'testpredictions')
 
 def get_AAcontent(df, colname, amino_acids=None):
     """Amino acid composition for dataframe with sequences"""
-    return df.apply( lambda r: peptutils.get_AAfraction(str(r[colname]), amino_acids), 1)
+
+    seqs = df[colname].astype(str).tolist()
+    return pd.Series(peptutils.aa_fractions(seqs, amino_acids), index=df.index)
 
 def net_charge(df, colname):
     """Net peptide charge for dataframe with sequences"""
-    return df.apply( lambda r: peptutils.net_charge(r[colname]),1)
 
-def isoelectric_point(df):
-    def getpi(seq):
-        X = ProteinAnalysis(seq)
-        return X.isoelectric_point()
-    return df.apply( lambda r: getpi(r.peptide),1)
+    seqs = df[colname].astype(str).tolist()
+    return pd.Series(peptutils.net_charges(seqs), index=df.index)
+
+def isoelectric_point(df, colname='peptide'):
+    """Isoelectric points for dataframe with sequences"""
+
+    seqs = df[colname].astype(str).tolist()
+    return pd.Series(peptutils.isoelectric_points(seqs), index=df.index)
 
 def peptide_properties(df, colname='peptide'):
-    """Find hydrophobicity and net charge for peptides"""
+    """Find hydrophobicity, net charge, gravy, molecular weight and pI
+    for peptides. The features are calculated for all rows together
+    from their amino acid counts."""
 
-    df['hydro'] = get_AAcontent(df, colname)
-    df['net_charge'] = net_charge(df, colname)
+    x = peptutils.peptide_features(df[colname].astype(str).tolist())
+    for c in ['hydro','net_charge','gravy','mw','pI']:
+        df[c] = x[c].values
     return df
 
-def _center_nmer(x, n):
-    """Get n-mer sequence for a peptide centered in the middle.
-    This should be applied to a dataframe per row.
-    Returns: a single sequence centred on the peptide"""
-
-    seq = x['translation']
-    size = x.end-x.start
-    l = int((size-n)/2.0)
-    if size>n:
-        if size%2 == 1: l1 = l+1
-        else: l1=l
-        start = x.start+l1
-        end = x.end-l
-    elif size<=n:
-        if size%2 == 1: l1 = l-1
-        else: l1=l
-        start = x.start+l1
-        end = x.end-l
-    if start<=0:
-        d=1-start
-        start = start+d
-        end = end+d
-    seq = seq[start:end]
-    #print(size, x.peptide, x.start, x.end, l, l1, start, end, seq, len(seq))
-    return seq
-
-def _split_nmer(x, n, key, margin=3):
-    """Row based method to split a peptide in to multiple n-mers
-        if it's too large. Returns a dataframe of 3 cols so should be
-        applied using iterrows and then use concat"""
-
-    size = x.end-x.start
-    m = margin
-
-    if size <= n+m:
-        seq = _center_nmer(x, n)
-        return pd.DataFrame({'peptide': seq,
-                             'start':x.start,'end':x.end},index=[0])
-    else:
-        seq = x[key]
-        o=size%n
-        #print (x.peptide, size, o)
-        if o<=margin:
-            size=size-o
-            seq = _center_nmer(x, size)
-            print (size)
-        seqs=[]
-        S=[];E=[]
-        if x.start==0: s=1
-        else: s=0
-        for i in range(s, size, n):
-            if i+n>size:
-                seqs.append(seq[o:o+n])
-                S.append(x.start+o)
-                E.append(x.start+o+n)
-            else:
-                seqs.append(seq[i:i+n])
-                S.append(x.start+i)
-                E.append(x.start+i+n)
-        seqs = pd.Series(seqs)
-        d = pd.DataFrame({'peptide':seqs,'start':S,'end':E})
-        return d
+def _center_coords(start, end, n):
+    """Coords of n-mers centred on each start/end pair. n can be a single
+    length or an array of lengths.
+    Returns: arrays of new start and end coords"""
+
+    size = end-start
+    l = np.trunc((size-n)/2.0).astype(int)
+    odd = size%2 == 1
+    l1 = np.where(odd, np.where(size>n, l+1, l-1), l)
+    start = start+l1
+    end = end-l
+    d = np.clip(1-start, 0, None)
+    return start+d, end+d
+
+def _slice_sequences(seqs, idx, start, end):
+    """
+    Slice many sequences at once from a single concatenated buffer.
+    Args:
+        seqs: list of sequences
+        idx: index into seqs for each slice
+        start: slice starts, should not be negative
+        end: slice ends, clipped to the sequence length like python slices
+    Returns:
+        list of sub-sequences
+    """
+
+    lengths = np.array([len(s) for s in seqs], dtype=int)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    buf = ''.join(seqs)
+    L = lengths[idx]
+    s = np.clip(start, 0, L)
+    e = np.clip(end, s, L)
+    s = offsets[idx] + s
+    e = offsets[idx] + e
+    return [buf[i:j] for i,j in zip(s, e)]
 
 def get_nmer(df, genome, length=20, seqkey='peptide', how='center', margin=3):
     """
     Get n-mer peptide surrounding a set of sequences using the host
-    protein sequence.
+    protein sequence. All rows are done at once using arrays of coords
+    that are sliced from a single buffer of the host proteins.
     Args:
         df: input dataframe with sequences
         genome: genome dataframe with host sequences
@@ -127,28 +108,53 @@ def get_nmer(df, genome, length=20, seqkey='peptide', how='center', margin=3):
             the sequence into overlapping n-mes of length is larger than size
         margin: allow
     Returns:
-        pandas Series with nmer values
+        pandas Series with nmer values, or a dataframe of peptide/start/end
+        indexed by the original rows for 'split'
     """
 
-    cols = ['locus_tag','gene','translation','length']
-    cols = list(set(cols) & set(genome.columns))
-    #merge with genome dataframe but must keep index for re-merging!
-    temp = df.merge(genome[cols],left_on='name',right_on='locus_tag',
-                    how='left').set_index(df.index)
-    if not 'end' in list(temp.columns):
-        temp = base.get_coords(temp)
+    #host protein of each row, rows not in the genome get empty sequences
+    genome = genome.drop_duplicates('locus_tag')
+    seqs = list(genome.translation.fillna('')) + ['']
+    idx = pd.Index(genome.locus_tag).get_indexer(df.name)
+    idx[idx<0] = len(seqs)-1
 
-    temp = base.get_coords(temp)
+    if 'start' in df.columns:
+        start = df.start.values.astype(int)
+        end = df.end.values.astype(int)
+    else:
+        start = df.pos.values.astype(int)
+        end = (df.pos + df.peptide.str.len()).values.astype(int)
+
+    n = length
     if how == 'center':
-        res = temp.apply( lambda r: _center_nmer(r, length), 1)
+        s, e = _center_coords(start, end, n)
+        res = pd.Series(_slice_sequences(seqs, idx, s, e), index=df.index)
     elif how == 'split':
-        res=[]
-        for n,r in temp.iterrows():
-            d = _split_nmer(r, length, seqkey, margin)
-            res.append(d)
-            d['index']=n
-            d.set_index('index',inplace=True)
-        res = pd.concat(res)
+        size = end-start
+        small = size <= n+margin
+        o = size%n
+        #trim the remainder if it is within the margin
+        trim = ~small & (o<=margin)
+        size = np.where(trim, size-o, size)
+        s, e = _center_coords(start, end, np.where(small, n, size))
+        centred = np.array(_slice_sequences(seqs, idx, s, e), dtype=object)
+        src = np.where(small | trim, centred, df[seqkey].astype(str).values)
+        #one n-mer for short rows, otherwise one per window in range(s0, size, n)
+        s0 = (start==0).astype(int)
+        counts = np.where(small, 1, np.clip(-(-(size-s0)//n), 0, None))
+        row = np.repeat(np.arange(len(df)), counts)
+        i = s0[row] + n*(np.arange(counts.sum()) - np.repeat(np.cumsum(counts)-counts, counts))
+        #the last window is taken from the remainder
+        off = np.where(i+n > size[row], o[row], i)
+        sm = small[row]
+        off[sm] = 0
+        width = np.where(sm, e[row]-s[row], n)
+        peps = _slice_sequences(list(src), row, off, off+width)
+        res = pd.DataFrame({'peptide': peps,
+                            'start': np.where(sm, start[row], start[row]+off),
+                            'end': np.where(sm, end[row], start[row]+off+n)},
+                            columns=['peptide','start','end'],
+                            index=pd.Index(df.index.values[row], name='index'))
     return res
 
 def create_nmers(df, genome, key='nmer', length=20, margin=1):
@@ -159,7 +165,7 @@ def create_nmers(df, genome, key='nmer', length=20, margin=1):
 
     x = get_nmer(df, genome, how='split', length=length, margin=margin)
     x = x.rename(columns={'peptide':key})
-    df = df.drop(['start','end'],1)
+    df = df.drop(['start','end'], axis=1)
     x = df.merge(x,left_index=True,right_index=True).reset_index(drop=True)
     return x
 
@@ -175,34 +181,49 @@ def get_overlaps(df1, df2, label='overlap', how='inside'):
         how: may be 'any' or 'inside'
     Returns:
         First DataFrame with no. of overlaps stored in a new column
+    Overlaps are counted per protein with binary searches over the sorted
+    coordinates of df2, these are assumed to have end >= start.
     """
 
-    new=[]
     a = base.get_coords(df1)
     b = base.get_coords(df2)
-
-    def overlap(x,y):
-        f=0
-        #print x['name'],x.peptide
-        #print (x.start,x.end)
-        for i,r in y.iterrows():
-            if how == 'inside':
-                if ((x.start<=r.start) & (x.end>=r.end)):
-                    f+=1
-            elif how == 'any':
-                if ((x.start<r.start) & (x.end>r.start)) or \
-                   ((x.start>r.start) & (x.start<r.end)):
-                    #t = abs(r.start-x.start)
-                    #print (a, b)
-                    f+=1
-            #print (r.start,r.end, f)
-        return f
-
-    for n,df in a.groupby('name'):
-        found = b[b.name==n]
-        df[label] = df.apply(lambda r: overlap(r,found),axis=1)
-        new.append(df)
-    result = pd.concat(new)
+    #sort df1 by name as the results are grouped by protein
+    codes, names = pd.factorize(pd.concat([a.name, b.name]), sort=True)
+    ca = codes[:len(a)]
+    cb = codes[len(a):]
+    a = a.iloc[np.argsort(ca, kind='mergesort')].copy()
+    ca = np.sort(ca, kind='mergesort')
+    #offset coordinates per protein so all proteins can be searched at once
+    allc = np.concatenate([a.start.values, a.end.values, b.start.values, b.end.values])
+    lo, hi = allc.min(), allc.max()
+    span = hi - lo + 2
+    xs = a.start.values.astype(np.int64) - lo + ca*span
+    xe = a.end.values.astype(np.int64) - lo + ca*span
+    rs = b.start.values.astype(np.int64) - lo + cb*span
+    re_ = b.end.values.astype(np.int64) - lo + cb*span
+    order = np.argsort(rs, kind='mergesort')
+    rs = rs[order]
+    re_ = re_[order]
+    if how == 'inside':
+        #candidates start inside x, then check the ends
+        i0 = np.searchsorted(rs, xs, side='left')
+        i1 = np.maximum(np.searchsorted(rs, xe, side='right'), i0)
+        n = i1 - i0
+        q = np.repeat(np.arange(len(xs)), n)
+        j = np.arange(n.sum()) - np.repeat(np.cumsum(n)-n, n) + np.repeat(i0, n)
+        f = np.bincount(q[re_[j] <= xe[q]], minlength=len(xs))
+    elif how == 'any':
+        #y starts inside x
+        f = np.clip(np.searchsorted(rs, xe, side='left') - np.searchsorted(rs, xs, side='right'), 0, None)
+        #or x starts inside y, assumes y end >= start
+        ve = np.sort(re_)
+        zero = np.sort(rs[rs == re_])
+        f = f + np.searchsorted(rs, xs, side='left') - np.searchsorted(ve, xs, side='right') \
+              + np.searchsorted(zero, xs, side='right') - np.searchsorted(zero, xs, side='left')
+    else:
+        f = np.zeros(len(xs), dtype=int)
+    a[label] = f
+    result = a
     print ('%s with overlapping sequences' %len(result[result[label]>0]))
     return result
 
@@ -288,11 +309,9 @@ def find_conserved_sequences(seqs, alnrows):
         a pandas DataFrame of 1 or 0 values for each protein/search sequence
     """
 
-    f=[]
-    for i,a in alnrows.iterrows():
-        sequence = a.seq
-        found = [sequence.find(j) for j in seqs]
-        f.append(found)
+    #all sequences are searched for in one pass over each aligned row
+    m = peptutils.Matcher(seqs)
+    f = [m.first(sequence) for sequence in alnrows.seq]
     for n in ['species','accession','name']:
         if n in alnrows.columns:
             ind = alnrows[n]
@@ -369,26 +388,30 @@ def find_clusters(binders, dist=None, min_binders=2, min_size=12, max_size=50,
         if splitting)
     """
 
-    C=[]
-    grps = list(binders.groupby('name'))
+    if len(binders) == 0:
+        print ('no clusters')
+        return pd.DataFrame()
     length = binders.head(1).peptide.str.len().max()
     #print (length)
     if dist == None:
         dist = length+1
         #print ('using dist for clusters: %s' %dist)
-    for n,b in grps:
-        if len(b)==0: continue
-        clusts = base.dbscan(b,dist=dist,minsize=min_binders)
-        if len(clusts) == 0:
-            continue
-        for c in clusts:
-            gaps = [c[i]-c[i-1] for i in range(1,len(c))]
-            C.append([n,min(c),max(c)+length,len(c)])
-
-    if len(C)==0:
+    names = binders.name.values
+    pos = binders.pos.values.astype(int)
+    order, labels = base.cluster_positions(names, pos, dist=dist, minsize=min_binders)
+    keep = labels >= 0
+    if keep.sum() == 0:
         print ('no clusters')
         return pd.DataFrame()
-    x = pd.DataFrame(C,columns=['name','start','end','binders'])
+    #labels increase along the sorted points so clusters are contiguous
+    l = labels[keep]
+    p = pos[order][keep]
+    st = np.flatnonzero(np.concatenate([[True], l[1:] != l[:-1]]))
+    x = pd.DataFrame({'name': names[order][keep][st],
+                      'start': p[st],
+                      'end': np.maximum.reduceat(p, st)+length,
+                      'binders': np.diff(np.concatenate([st, [len(l)]]))},
+                      columns=['name','start','end','binders'])
     x['length'] = (x.end-x.start)
     x = x[x['length']>=min_size]
     x = x[x['length']<=max_size]
@@ -531,28 +554,31 @@ def prediction_coverage(expdata, binders, key='sequence', perc=50, verbose=False
         target = math.ceil(len(data)*perc/100.0)
         if verbose == True:
             print (len(data), target)
-        #print data[key]
-        #print peptides[peptides.isin(data[key])]
-        found=[]
-        count=0
-        for p in peptides:
-            for i,r in data.iterrows():
-                #print p, r[key]
-                if r[key] in found:
-                    continue
-                if r[key].find(p)!=-1 or p.find(r[key])!=-1:
-                    found.append(r[key])
-                    if verbose == True:
-                        print (count, p, r[key])
-                    continue
-            count+=1
-            if len(found) >= target:
-                if verbose == True:
-                    print (count, target)
-                    print ('--------------')
-                return count
+        peptides = list(peptides)
+        seqs = list(OrderedDict.fromkeys(data[key]))
+        n = len(peptides)
+        #index of the first peptide that each sequence contains or is contained in
+        first = np.full(len(seqs), n)
+        m = peptutils.Matcher(peptides)
+        for i,s in enumerate(seqs):
+            hits = m.found(s)
+            if len(hits) > 0:
+                first[i] = min(hits)
+        m = peptutils.Matcher(seqs)
+        for j,p in enumerate(peptides):
+            for i in m.found(p):
+                first[i] = min(first[i], j)
+        #sequences found after each peptide in turn
+        found = np.bincount(first, minlength=n+1)[:n].cumsum()
+        idx = np.flatnonzero(found >= target)
+        if len(idx) > 0:
+            count = idx[0]+1
+        else:
+            count = n
+            if verbose == True:
+                print ('not all sequences found', count, target)
         if verbose == True:
-            print ('not all sequences found', count, target)
+            print (count, target)
         return count
 
     total = 0
@@ -644,11 +670,7 @@ def test_conservation(label,gname):
 def find_conserved_peptide(peptide, recs):
     """Find sequences where a peptide is conserved"""
 
-    f=[]
-    for i,a in recs.iterrows():
-        seq = a.sequence.replace('-','')
-        found = seq.find(peptide)
-        f.append(found)
+    f = recs.sequence.str.replace('-','').str.find(peptide).values
     s = pd.DataFrame(f,columns=['found'],index=recs.accession)
     s = s.replace(-1,np.nan)
     #print s
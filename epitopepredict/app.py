@@ -82,7 +82,7 @@ class WorkFlow(object):
 
             P.predictProteins(self.sequences, length=length, alleles=a, names=self.names,
                               path=savepath, overwrite=self.overwrite, verbose=self.verbose,
-                              method=method, cpus=self.cpus)
+                              method=method, cpus=self.cpus, format=self.format)
             #load results into predictor
             P.load(path=savepath)
             if P.data is None:
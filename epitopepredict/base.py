@@ -8,24 +8,27 @@
 
 from __future__ import absolute_import, print_function
 import sys, os, shutil, string
-import csv, glob, pickle, tempfile
-import time, io
+import csv, tempfile
+import time, io, threading
 import operator as op
 import re, types
 import math
 import subprocess
 from subprocess import CalledProcessError
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 from Bio.Seq import Seq
 from Bio import SeqIO
 from Bio.SeqRecord import SeqRecord
-from . import utilities, peptutils, sequtils, tepitope
+from . import utilities, peptutils, sequtils, tepitope, bcell, storage
 
 home = os.path.expanduser("~")
 path = os.path.dirname(os.path.abspath(__file__)) #path to module
 datadir = os.path.join(path, 'mhcdata')
 predictors = ['tepitope','netmhciipan','iedbmhc1','iedbmhc2','mhcflurry','iedbbcell']
+#cutoff methods that can be applied to one protein at a time
+stream_cutoff_methods = ['rank','score','percentile']
 iedbmethods = ['arbpython','comblib','consensus3','IEDB_recommended',
                'NetMHCIIpan','nn_align','smm_align','tepitope']
 iedbsettings = {'cutoff_type': 'none', 'pred_method': 'IEDB_recommended',
@@ -47,6 +50,18 @@ iedbkeys = {'consensus3': ['Allele','Start','End','Sequence','consensus_percenti
 iedbmhc1path = ''
 iedbmhc2path = ''
 iedbbcellpath = ''
+#run the iedb tools inside this process where possible, falls back to a subprocess
+iedb_inprocess = True
+#iedb tool prediction objects loaded in this process (one set per worker) with
+#their imports, None if the tool can't be run in-process
+iedb_tools = {}
+iedb_lock = threading.Lock()
+#held while a tool is loaded or called in-process
+iedb_call_lock = threading.Lock()
+#held while sys.stdout is wrapped or restored, see capture_output
+output_lock = threading.Lock()
+#mhcflurry predictor loaded in this process
+mhcflurry_predictor = None
 
 mhc1_presets = ['mhc1_supertypes','us_caucasion_mhc1','us_african_mhc1','broad_coverage_mhc1']
 mhc2_presets = ['mhc2_supertypes','human_common_mhc2','bovine_like_mhc2']
@@ -59,10 +74,12 @@ testsequence = ('MRRVILPTAPPEYMEAIYPVRSNSTIARGGNSNTGFLTPESVNGDTPSNPLRPIADDTIDHAS
                'GQPIIPVLLPKYIGLDPVAPGDLTMVITQDCDTCHSPASLPAVIEK')
 
 presets_dir = os.path.join(path, 'presets')
+#stored background score distributions used for percentile ranks
+calibrationdir = os.path.join(home, '.epitopepredict', 'calibration')
 
 def worker(P, recs, kwargs):
     df = P.predict_multiple(recs, **kwargs)
-    return df
+    return df, P.summary
 
 def get_preset_alleles(name):
     df = pd.read_csv(os.path.join(presets_dir, name+'.csv'),comment='#')
@@ -94,27 +111,63 @@ def get_overlapping(index, s, length=9, cutoff=25):
             break
     return g
 
+def cluster_positions(names, pos, dist=7, minsize=4):
+    """
+    Density based clustering of positions within each protein, equivalent to
+    DBSCAN on 1-D points. All proteins are done at once: points are sorted,
+    neighbours counted by binary search and clusters split at gaps.
+    Args:
+        names: array of protein names
+        pos: array of positions
+        dist: max distance between neighbouring points (eps)
+        minsize: min number of points in a neighbourhood for a core point
+    Returns:
+        order of the points sorted by name and position, and the cluster
+        label of each sorted point, -1 for noise. Labels increase with
+        position as in sklearn DBSCAN.
+    """
+
+    codes = pd.factorize(np.asarray(names), sort=True)[0]
+    pos = np.asarray(pos).astype(np.int64)
+    order = np.lexsort((pos, codes))
+    if len(pos) == 0:
+        return order, np.array([], dtype=int)
+    #offset each protein so no points in different proteins are neighbours
+    span = pos.max() - pos.min() + 2*dist + 1
+    x = pos[order] + codes[order].astype(np.int64)*span
+    count = np.searchsorted(x, x+dist, side='right') - np.searchsorted(x, x-dist, side='left')
+    core = count >= minsize
+    xc = x[core]
+    labels = np.full(len(x), -1)
+    if len(xc) == 0:
+        return order, labels
+    cid = np.cumsum(np.concatenate([[0], np.diff(xc) > dist]))
+    #border points join the cluster of the nearest core before them if in
+    #reach, otherwise the one after
+    j = np.searchsorted(xc, x, side='right') - 1
+    prev = (j >= 0) & (x - xc[np.clip(j, 0, None)] <= dist)
+    k = np.clip(j+1, 0, len(xc)-1)
+    nxt = ~prev & (j+1 < len(xc)) & (xc[k] - x <= dist)
+    labels[prev] = cid[j[prev]]
+    labels[nxt] = cid[k[nxt]]
+    return order, labels
+
 def dbscan(B=None, x=None, dist=7, minsize=4):
     """Density-Based Spatial clustering. Finds core samples of
-      high density and expands clusters from them."""
+      high density and expands clusters from them. See cluster_positions."""
 
-    from sklearn.cluster import DBSCAN
     if B is not None:
         if len(B)==0:
             return
-        x = sorted(B.pos.astype('int'))
-    X = np.array(zip(x,np.zeros(len(x))), dtype=np.int)
-    db = DBSCAN(eps=dist, min_samples=minsize)
-    db.fit(X)
-    labels = db.labels_
-    n_clusters_ = len(set(labels))
+        x = B.pos.astype('int')
+    x = np.asarray(x)
+    if len(x) == 0:
+        return []
+    order, labels = cluster_positions(np.zeros(len(x)), x, dist, minsize)
+    x = x[order]
     clusts=[]
-    for k in range(n_clusters_):
-        my_members = labels == k
-        #print "cluster {0}: {1}".format(k, X[my_members, 0])
-        if len(X[my_members, 0])>0:
-            clusts.append(list(X[my_members, 0]))
-    #print clusts
+    for k in range(labels.max()+1):
+        clusts.append(list(x[labels == k]))
     return clusts
 
 def get_predictor(name='tepitope', **kwargs):
@@ -136,10 +189,21 @@ def get_predictor(name='tepitope', **kwargs):
         print ('no such predictor %s' %name)
         return
 
+def get_mhcflurry_predictor():
+    """Load the mhcflurry affinity predictor, once per process"""
+
+    global mhcflurry_predictor
+    if mhcflurry_predictor is None:
+        from mhcflurry import Class1AffinityPredictor
+        mhcflurry_predictor = Class1AffinityPredictor.load()
+    return mhcflurry_predictor
+
 def get_length(data):
     """Get peptide length of a dataframe of predictions"""
 
     if len(data)>0:
+        if 'length' in data.columns and 'peptide' not in data.columns:
+            return int(data.length.iloc[0])
         return len(data.head(1).peptide.max())
     return
 
@@ -162,6 +226,131 @@ def get_length(data):
     df = df.drop(['start','end'],1)
     return df.join(temp)'''
 
+def memory_usage(df):
+    """Memory used by a dataframe in MB"""
+
+    return df.memory_usage(deep=True).sum()/1048576.
+
+def data_checksum(df, cols):
+    """Checksum of the index and numeric columns of a dataframe, used to
+       detect in-place changes such as sorting or editing scores"""
+
+    import zlib
+    idx = df.index
+    if isinstance(idx, pd.RangeIndex):
+        c = zlib.crc32(str((idx.start, idx.stop, idx.step)).encode())
+    else:
+        h = pd.util.hash_pandas_object(idx, index=False).values
+        c = zlib.crc32(np.ascontiguousarray(h).view(np.uint8))
+    for col in cols:
+        x = df[col]
+        if x.dtype.kind in 'biuf':
+            x = np.ascontiguousarray(x.values)
+        else:
+            x = np.ascontiguousarray(pd.util.hash_pandas_object(x, index=False).values)
+        c = zlib.crc32(x.view(np.uint8), c)
+    return c
+
+def check_peptides(df, sequences):
+    """
+    Check that every peptide in a prediction dataframe can be recovered from
+    its protein sequence at pos. The sequences are joined into one buffer and
+    all rows are compared at once, one peptide length at a time.
+    Returns:
+        True if all rows match
+    """
+
+    names, codes = np.unique(df.name.astype(str).values, return_inverse=True)
+    if not all([n in sequences for n in names]):
+        return False
+    seqs = [sequences[n] for n in names]
+    lengths = np.array([len(q) for q in seqs], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    buf = np.frombuffer(''.join(seqs).encode('ascii', 'replace'), dtype=np.uint8)
+    peptides = df.peptide.astype(str).values
+    pos = df.pos.values.astype(np.int64)
+    length = np.array([len(p) for p in peptides], dtype=np.int64)
+    if (pos < 0).any() or (pos+length > lengths[codes]).any():
+        return False
+    for l in np.unique(length):
+        m = length == l
+        pep = np.frombuffer(''.join(peptides[m]).encode('ascii', 'replace'), dtype=np.uint8)
+        idx = (offsets[codes[m]]+pos[m])[:,None] + np.arange(l)
+        if not (buf[idx] == pep.reshape(-1, l)).all():
+            return False
+    return True
+
+def compact_data(df, sequences=None, keep=[]):
+    """
+    Reduce the memory used by a prediction dataframe. Names, alleles, peptides
+    and cores become categoricals and numeric columns are narrowed to
+    int32/float32. If the protein sequences are given the peptide and core
+    strings are replaced by offsets into them, see expand_data. This is only
+    done if all peptides can be recovered from the sequences.
+    Args:
+        df: dataframe of predictions
+        sequences: dict of protein sequences keyed by name, optional
+        keep: columns to leave as they are, e.g. the score so that cutoffs
+        give identical results
+    Returns:
+        a new dataframe
+    """
+
+    df = df.copy()
+    if sequences is not None and 'peptide' in df.columns:
+        length = df.peptide.str.len()
+        if check_peptides(df, sequences) == True:
+            df['length'] = length.astype('int8')
+            if 'core' in df.columns:
+                offset = [p.find(c) for p,c in zip(df.peptide, df.core)]
+                df['core_offset'] = np.array(offset, dtype='int8')
+                df['core_length'] = df.core.str.len().astype('int8')
+                if (df.core_offset >= 0).all():
+                    df = df.drop('core', axis=1)
+                else:
+                    df = df.drop(['core_offset','core_length'], axis=1)
+            df = df.drop('peptide', axis=1)
+    for c in df.columns:
+        x = df[c]
+        if c in keep:
+            continue
+        if c in ['name','allele','peptide','core','method']:
+            df[c] = x.astype('category')
+        elif x.dtype.kind == 'f':
+            df[c] = x.astype('float32')
+        elif x.dtype.kind == 'i' and c not in ['length','core_offset','core_length']:
+            df[c] = x.astype('int32')
+    return df
+
+def expand_data(df, sequences=None):
+    """
+    Restore a compacted prediction dataframe to plain dtypes, materialising the
+    peptide and core strings from the sequences if needed. Uncompacted data
+    is returned unchanged. Raises a ValueError if the data is compacted and
+    no sequences are given.
+    """
+
+    if df is None:
+        return
+    compacted = 'peptide' not in df.columns and 'length' in df.columns
+    cats = [c for c in df.columns if str(df[c].dtype) == 'category']
+    if compacted == False and len(cats) == 0:
+        return df
+    df = df.copy()
+    for c in cats:
+        df[c] = df[c].astype(object)
+    if compacted == True:
+        if sequences is None:
+            raise ValueError('sequences are needed to recover peptides from compacted data')
+        pos = df.pos.values
+        length = df.length.values
+        df['peptide'] = [sequences[n][p:p+l] for n,p,l in zip(df.name, pos, length)]
+        if 'core_offset' in df.columns:
+            df['core'] = [p[o:o+l] for p,o,l in zip(df.peptide, df.core_offset, df.core_length)]
+            df = df.drop(['core_offset','core_length'], axis=1)
+        df = df.drop('length', axis=1)
+    return df
+
 def get_coords(df):
     """Get start end coords from position and length of peptides"""
 
@@ -186,6 +375,240 @@ def write_fasta(sequences, id=None, filename='tempseq.fa'):
     out.close()
     return filename
 
+def write_fasta_batch(seqs, filename='tempseq.fa'):
+    """Write a dict of name/sequence pairs to a single fasta file"""
+
+    path = os.path.dirname(filename)
+    #the temp folder is removed after each run by cleanup
+    if path != '' and not os.path.exists(path):
+        os.makedirs(path)
+    recs = [SeqRecord(Seq(seqs[n]), n, description='') for n in seqs]
+    SeqIO.write(recs, filename, 'fasta')
+    return filename
+
+def batches(recs, size=1):
+    """Split a dataframe into consecutive chunks of at most size rows"""
+
+    size = max(int(size), 1)
+    for i in range(0, len(recs), size):
+        yield recs.iloc[i:i+size]
+
+def _load_source(name, filename):
+    """Import a python source file as a module"""
+
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(name, filename)
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+    except ImportError:
+        import imp
+        mod = imp.load_source(name, filename)
+    return mod
+
+class ThreadOutput(object):
+    """
+    Stand-in for sys.stdout that sends what a thread prints to its own
+    buffer while it is capturing, see capture_output. Output from other
+    threads goes to the original stream.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        #number of threads capturing
+        self.users = 0
+        return
+
+    def write(self, s):
+        buf = getattr(self.local, 'buffer', None)
+        if buf is None:
+            return self.stream.write(s)
+        buf.append(s)
+        return
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+        return
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def capture_output(func, *args):
+    """Call func and return what it prints in this thread as bytes.
+       sys.stdout is wrapped with ThreadOutput while any thread is
+       capturing and restored after the last one is done."""
+
+    with output_lock:
+        if not isinstance(sys.stdout, ThreadOutput):
+            sys.stdout = ThreadOutput(sys.stdout)
+        out = sys.stdout
+        out.users += 1
+    out.local.buffer = []
+    try:
+        func(*args)
+    except SystemExit as e:
+        #tools may exit when done
+        if e.code not in [None, 0]:
+            raise
+    finally:
+        buf = out.local.buffer
+        out.local.buffer = None
+        with output_lock:
+            out.users -= 1
+            if out.users == 0 and sys.stdout is out:
+                sys.stdout = out.stream
+    temp = ''.join(buf)
+    if not isinstance(temp, bytes):
+        temp = temp.encode('utf-8')
+    return temp
+
+def local_modules(path):
+    """Names of the top level modules and packages in a folder"""
+
+    names = set()
+    for f in os.listdir(path):
+        name, ext = os.path.splitext(f)
+        if ext == '.py' or os.path.exists(os.path.join(path, f, '__init__.py')):
+            names.add(name)
+    return names
+
+class IEDBImports(object):
+    """
+    Context in which an IEDB tool's modules are imported. Its folders are
+    put first in sys.path and the modules it has loaded from them are put
+    in sys.modules, both are restored on exit. The MHC-I and MHC-II tools
+    ship modules with the same names, so they are never left in sys.modules
+    where another tool would import them.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.paths = [p for p in [os.path.join(self.path,'src'), self.path]
+                      if os.path.isdir(p)]
+        self.names = set()
+        for p in self.paths:
+            self.names.update(local_modules(p))
+        #the tool's own modules, kept between calls
+        self.modules = {}
+        return
+
+    def __enter__(self):
+        self.syspath = list(sys.path)
+        sys.path[:0] = self.paths
+        self.saved = {}
+        for k in self.names | set(self.modules):
+            self.saved[k] = sys.modules.pop(k, None)
+        sys.modules.update(self.modules)
+        return self
+
+    def __exit__(self, *args):
+        for k,m in list(sys.modules.items()):
+            f = getattr(m, '__file__', None)
+            if k in self.names or (f is not None and
+                os.path.abspath(f).startswith(self.path+os.sep)):
+                self.modules[k] = m
+        for k in self.modules:
+            sys.modules.pop(k, None)
+        for k,m in self.saved.items():
+            if m is not None:
+                sys.modules[k] = m
+        sys.path[:] = self.syspath
+        return False
+
+def get_iedb_tool(script):
+    """
+    Load an IEDB tools script in this process and create its prediction
+    object, whose commandline_input(args) method runs a prediction. This is
+    done once per process and the object is kept, so the method and model
+    data it loads are re-used by later calls. Returns None if the script
+    can't be used in-process, otherwise the object and its IEDBImports.
+    """
+
+    with iedb_lock:
+        if script in iedb_tools:
+            return iedb_tools[script]
+        path = os.path.dirname(os.path.abspath(script))
+        name = 'iedb_' + os.path.splitext(os.path.basename(script))[0]
+        #the tools load their data relative to their own folder
+        currpath = os.getcwd()
+        tool = None
+        imports = IEDBImports(path)
+        try:
+            os.chdir(path)
+            with iedb_call_lock, imports:
+                mod = _load_source(name, script)
+                if hasattr(mod, 'Prediction'):
+                    tool = mod.Prediction()
+                else:
+                    tool = mod
+            if not hasattr(tool, 'commandline_input'):
+                tool = None
+        except Exception as e:
+            print ('could not load %s in-process, using subprocess (%s)' %(script, e))
+            tool = None
+        finally:
+            os.chdir(currpath)
+        if tool is not None:
+            iedb_tools[script] = (tool, imports)
+        else:
+            iedb_tools[script] = None
+        return iedb_tools[script]
+
+def _run_iedb_inprocess(tool, script, args):
+    """
+    Run a prediction with a loaded IEDB tool object, capturing its output.
+    Calls are serialised as the tools keep state between them and their
+    imports are swapped into sys.modules. Returns None if the call failed
+    and the subprocess should be used, the tool isn't used again.
+    """
+
+    tool, imports = tool
+    args = [str(a) for a in args]
+    with iedb_call_lock:
+        try:
+            with imports:
+                return capture_output(tool.commandline_input, args)
+        except SystemExit as e:
+            raise CalledProcessError(e.code, script)
+        except Exception as e:
+            print ('in-process call to %s failed, using subprocess (%s)' %(script, e))
+    with iedb_lock:
+        iedb_tools[script] = None
+    return
+
+def run_iedb_tool(script, args):
+    """
+    Run an IEDB tools script and return the raw output as bytes. The tool
+    is called in-process when iedb_inprocess is set, so the interpreter and
+    model start-up happens once per worker rather than on every call.
+    The subprocess call is used as a fallback.
+    """
+
+    if iedb_inprocess == True:
+        tool = get_iedb_tool(script)
+        if tool is not None:
+            res = _run_iedb_inprocess(tool, script, args)
+            if res is not None:
+                return res
+    cmd = script + ' ' + ' '.join([str(a) for a in args])
+    return subprocess.check_output(cmd, shell=True, executable='/bin/bash')
+
+def split_iedb_batch(df, names):
+    """Split IEDB tool output for a multi-sequence fasta file by sequence.
+       Returns a dict of dataframes keyed by name."""
+
+    names = list(names)
+    if len(names) == 1:
+        return {names[0]: df}
+    if 'seq_num' not in df.columns:
+        return
+    res = {}
+    for i,g in df.groupby('seq_num'):
+        res[names[int(i)-1]] = g.reset_index(drop=True)
+    return res
+
 def get_sequence(seqfile):
     """Get sequence from fasta file"""
 
@@ -225,13 +648,18 @@ def summarize(data):
                                         len(proteins),len(allelegrps)))
     return
 
-def get_cutoffs(pred=None, data=None, cutoff=5):
+def get_cutoffs(pred=None, data=None, cutoff=5, path=None):
     """
     Get score cutoffs per allele for supplied predictions at this
     percentile level. Can be used to set global cutoffs for scoring
-    arbitary sequences and then check if they are binders.
+    arbitary sequences and then check if they are binders. If path is given
+    the cutoffs are estimated from the score sketches saved with the results
+    in path, without loading them.
     """
 
+    if path is not None:
+        sk = storage.load_sketches(path)
+        return storage.sketch_cutoffs(sk, cutoff, pred.rankascending==1)
     q = (1-cutoff/100.) #score quantile value
     cuts={}
     if data is None:
@@ -241,6 +669,24 @@ def get_cutoffs(pred=None, data=None, cutoff=5):
     cuts = pd.Series(cuts)
     return cuts
 
+def percentile_rank(scores, dist, ascending=0):
+    """
+    Percentile rank of scores in a sorted background score distribution,
+    the percentage of background peptides scoring as well or better.
+    Args:
+        scores: array of scores
+        dist: sorted array of background scores
+        ascending: 1 if lower scores are better
+    """
+
+    scores = np.asarray(scores, dtype=float)
+    n = len(dist)
+    if ascending == 1:
+        count = np.searchsorted(dist, scores, side='right')
+    else:
+        count = n - np.searchsorted(dist, scores, side='left')
+    return np.round(count*100.0/n, 3)
+
 def get_standard_mhc1(name):
     """Taken from iedb mhc1 utils.py"""
 
@@ -292,9 +738,10 @@ def compare_predictors(p1, p2, by='allele', cutoff=5, n=2):
     #b1 = p1.getBinders(perc=perc)
     #b2 = p2.getBinders(perc=perc)
     #o = analysis.getOverlaps(b1,b2)
-    #merge data for plotting score correlation
-    df = pd.merge(p1.data, p2.data, on=['peptide','allele','name','pos'])
-    g = sns.lmplot(x='score_x', y='score_y', data=df, col=by, ci=None, #robust=True,
+    #align data for plotting score correlation
+    df = align_predictions([p1,p2], values=['score'])
+    x,y = [c for c in df.columns if c.startswith('score_')]
+    g = sns.lmplot(x=x, y=y, data=df, col=by, ci=None, #robust=True,
                hue=by, col_wrap=3, markers='o', scatter_kws={'alpha':0.5,'s':30})
 
     g.set_axis_labels(p1.name, p2.name)
@@ -303,6 +750,121 @@ def compare_predictors(p1, p2, by='allele', cutoff=5, n=2):
     #plotting.plot_tracks([pi,pf],'MAP_0005',n=2,perc=0.97,legend=True,colormap='jet')
     return
 
+def normalise_allele(name):
+    """
+    Convert an allele name to the form HLA-DRB1*01:01 so that names used by
+    different predictors can be matched, e.g. HLA-DRB1*0101, DRB1_0101 and
+    HLA-A0201. Names that aren't recognised are returned unchanged.
+    """
+
+    x = str(name).strip()
+    prefix = 'HLA-'
+    if x.startswith('HLA-'):
+        x = x[4:]
+    elif x.startswith('HLA'):
+        x = x[3:]
+    res = []
+    #alpha/beta chain pairs are separated by -
+    for p in x.split('-'):
+        m = re.match(r'^([A-Z]+[0-9]?)[\*_]?([0-9]{2,3}):?([0-9]{2,3})$', p.upper())
+        if m is None:
+            return name
+        res.append('%s*%s:%s' %m.groups())
+    return prefix + '-'.join(res)
+
+def align_predictions(preds, values=['score','rank'], how='inner'):
+    """
+    Align the predictions of several predictors on protein, position,
+    peptide length and allele. These are mapped to a shared integer key
+    so rows are matched by sorting rather than merging on strings. Allele
+    names are normalised with normalise_allele.
+    Args:
+        preds: list of predictors, those without data have no rows
+        values: columns to align
+        how: 'inner' for rows present in all predictions, 'outer' for any
+    Returns:
+        dataframe with name, pos, length, allele and peptide columns and one
+        column per value and predictor, e.g. score_tepitope
+    """
+
+    data = [expand_data(P.data, P.sequences) for P in preds]
+    data = [pd.DataFrame(columns=['name','pos','peptide','allele']) if d is None else d
+            for d in data]
+    labels = []
+    for P in preds:
+        l = P.name
+        i = 1
+        while l in labels:
+            l = '%s_%s' %(P.name, i)
+            i += 1
+        labels.append(l)
+    sizes = [len(d) for d in data]
+    norm = []
+    for d in data:
+        a = d.allele.astype(str)
+        norm.append(a.map(dict([(i, normalise_allele(i)) for i in a.unique()])).values)
+    acodes, alleles = pd.factorize(np.concatenate(norm))
+    ncodes, names = pd.factorize(np.concatenate([d.name.astype(str).values for d in data]))
+    pos = np.concatenate([d.pos.values for d in data]).astype(np.int64)
+    length = np.concatenate([d.peptide.str.len().values for d in data]).astype(np.int64)
+    #no rows gives an empty frame
+    dims = tuple([int(np.max(x, initial=0))+1 for x in (ncodes, pos, length, acodes)])
+    keys = np.ravel_multi_index((ncodes, pos, length, acodes), dims)
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    keys = [keys[offsets[i]:offsets[i+1]] for i in range(len(data))]
+
+    common = keys[0]
+    for k in keys[1:]:
+        if how == 'inner':
+            common = np.intersect1d(common, k)
+        else:
+            common = np.union1d(common, k)
+    common = np.unique(common)
+    n,p,l,a = np.unravel_index(common, dims)
+    df = pd.DataFrame({'name': np.asarray(names)[n], 'pos': p, 'length': l,
+                       'allele': np.asarray(alleles)[a]})
+    peptide = np.full(len(common), None, dtype=object)
+    for d,k,label in zip(data, keys, labels):
+        order = np.argsort(k, kind='mergesort')
+        sk = k[order]
+        idx = np.clip(np.searchsorted(sk, common), 0, max(len(sk)-1, 0))
+        found = sk[idx] == common if len(sk) > 0 else np.zeros(len(common), dtype=bool)
+        rows = order[idx[found]]
+        fill = found & (peptide == None)
+        peptide[fill] = d.peptide.values[order[idx[fill]]]
+        for v in values:
+            if v not in d.columns:
+                continue
+            x = np.full(len(common), np.nan)
+            x[found] = d[v].values[rows]
+            df['%s_%s' %(v,label)] = x
+    df.insert(4, 'peptide', peptide)
+    return df
+
+def consensus(preds, method='median', cutoff=None, how='inner'):
+    """
+    Consensus ranks of the same peptides/alleles over several predictors.
+    Args:
+        preds: list of predictors with data
+        method: 'mean', 'median' or 'best' rank over predictors
+        cutoff: only keep rows with a consensus rank below this
+        how: see align_predictions
+    Returns:
+        aligned dataframe with a consensus_rank column, sorted by it
+    """
+
+    df = align_predictions(preds, values=['score','rank'], how=how)
+    cols = [c for c in df.columns if c.startswith('rank_')]
+    m = df[cols].values
+    funcs = {'mean':np.nanmean, 'median':np.nanmedian, 'best':np.nanmin}
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        df['consensus_rank'] = funcs[method](m, axis=1)
+    if cutoff is not None:
+        df = df[df.consensus_rank < cutoff]
+    return df.sort_values(['consensus_rank','name','pos'])
+
 def reshape_data(pred, peptides=None, name=None, values='score'):
     """
     Create summary table per binder/allele with cutoffs applied.
@@ -312,7 +874,7 @@ def reshape_data(pred, peptides=None, name=None, values='score'):
         n: number of alleles
     """
 
-    df = pred.data
+    df = expand_data(pred.data, pred.sequences)
     idx = ['name','pos','peptide']
     if name != None:
         df = df[df.name==name]
@@ -358,6 +920,109 @@ def summarize_by_protein(pred, pb):
         x = binders_allele_summary(pred, g.peptide, values='score', name=i)
         ax=plot_summary_heatmap(x, name=i)
 
+class ScoreIndex(object):
+    """
+    Prediction rows sorted by score within each allele, best first. Binders
+    at any score or percentile cutoff are then a contiguous slice of each
+    allele block found by binary search. The number of alleles each peptide
+    binds is updated incrementally as the cutoff is moved.
+    """
+
+    def __init__(self, data, scorekey='score', ascending=False):
+        self.ascending = ascending
+        codes, self.alleles = pd.factorize(data.allele, sort=True)
+        x = data[scorekey].values.astype(float)
+        if ascending == False:
+            x = -x
+        self.order = np.lexsort((x, codes))
+        self.keys = x[self.order]
+        na = len(self.alleles)
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=na))])
+        #nan scores are sorted last and never selected
+        self.valid = np.bincount(codes[~np.isnan(x)], minlength=na)
+        cols = [c for c in ['peptide','pos','name'] if c in data.columns]
+        pep = data.groupby(cols, sort=False, observed=True).ngroup()
+        self.peptides = pep.values
+        self.first = np.unique(self.peptides, return_index=True)[1]
+        self.counts = np.zeros(len(self.first), dtype=int)
+        self.current = np.zeros(na, dtype=int)
+        return
+
+    def __repr__(self):
+        return 'score index of %s rows in %s alleles' %(len(self.order), len(self.alleles))
+
+    def block(self, i):
+        """Sorted score keys of allele i"""
+
+        st = self.offsets[i]
+        return self.keys[st:st+self.valid[i]]
+
+    def quantile(self, i, q):
+        """Score quantile for allele i, same as pandas linear interpolation"""
+
+        b = self.block(i)
+        m = len(b)
+        if m == 0:
+            return np.nan
+        h = (m-1)*q
+        lo = int(np.floor(h))
+        hi = min(lo+1, m-1)
+        if self.ascending == True:
+            a, c = b[lo], b[hi]
+        else:
+            a, c = -b[m-1-lo], -b[m-1-hi]
+        return a + (c-a)*(h-lo)
+
+    def sizes(self, cutoff=5, cutoff_method='default'):
+        """Number of binders in each allele for a percentile ('default') or
+           'score' cutoff, see getBinders"""
+
+        cutoff = float(cutoff)
+        k = np.zeros(len(self.alleles), dtype=int)
+        for i in range(len(self.alleles)):
+            b = self.block(i)
+            if cutoff_method == 'score':
+                c = cutoff if self.ascending == True else -cutoff
+                k[i] = np.searchsorted(b, c, side='right')
+            else:
+                if self.ascending == True:
+                    c = self.quantile(i, cutoff/100.)
+                else:
+                    c = -self.quantile(i, 1-cutoff/100.)
+                k[i] = np.searchsorted(b, c, side='left')
+        return k
+
+    def select(self, cutoff=5, cutoff_method='default'):
+        """Positions of binder rows in the data, in data order"""
+
+        k = self.sizes(cutoff, cutoff_method)
+        rows = [self.order[st:st+n] for st,n in zip(self.offsets[:-1], k)]
+        if len(rows) == 0:
+            return np.array([], dtype=int)
+        return np.sort(np.concatenate(rows))
+
+    def update(self, cutoff=5, cutoff_method='default'):
+        """Move the cutoff, only the rows entering or leaving each allele's
+           binders are used to update the peptide counts"""
+
+        k = self.sizes(cutoff, cutoff_method)
+        for i in range(len(self.alleles)):
+            st = self.offsets[i]
+            a, b = self.current[i], k[i]
+            if b > a:
+                np.add.at(self.counts, self.peptides[self.order[st+a:st+b]], 1)
+            elif b < a:
+                np.subtract.at(self.counts, self.peptides[self.order[st+b:st+a]], 1)
+        self.current = k
+        return self.counts
+
+    def promiscuous(self, n=2):
+        """Peptide ids binding at least n alleles at the current cutoff and
+           a representative row position for each"""
+
+        ids = np.flatnonzero(self.counts >= n)
+        return ids, self.first[ids]
+
 class Predictor(object):
     """Base class to handle generic predictor methods, usually these will
        wrap methods from other modules and/or call command line predictors.
@@ -371,6 +1036,24 @@ class Predictor(object):
         self.rankascending = 0
         #can specify per allele cutoffs here
         self.allelecutoffs = None
+        #number of sequences passed to predict_batch at once
+        self.batch_size = 1
+        #sorted background scores keyed by (allele, length)
+        self.calibration = {}
+        #predictor version and method the calibration was made with, see version
+        self.calibration_version = None
+        #rows held in memory before writing to a dataset
+        self.buffer_rows = 500000
+        #protein sequences, used to recover peptides from compacted data
+        self.sequences = None
+        #per allele statistics of the last predictions
+        self.summary = None
+        #per allele score cutoffs for the current data, see allele_cutoffs
+        self.cutoff_cache = {}
+        #number of top binders per allele and protein kept when predicting
+        self.top_n = 50
+        #method used when none is given, see version
+        self.default_method = ''
         self.temppath = tempfile.mkdtemp()
         return
 
@@ -404,9 +1087,136 @@ class Predictor(object):
 
         s=self.scorekey
         df['rank'] = df[s].rank(method='min',ascending=self.rankascending)
+        self.add_percentile_rank(df)
         df.sort_values(by=['rank','name','allele'], ascending=True, inplace=True)
         return df
 
+    def add_percentile_rank(self, df):
+        """Add a perc_rank column using the calibrated score distributions,
+           if there are any for the alleles in the data"""
+
+        if len(self.calibration) == 0 or len(df) == 0:
+            return df
+        #only use a calibration made with the same method and version, for
+        #IEDB predictors iedbmethod is the method of these predictions
+        if self.calibration_version != self.version(getattr(self, 'iedbmethod', None)):
+            return df
+        length = get_length(df)
+        ranks = pd.Series(np.nan, index=df.index)
+        for a,g in df.groupby('allele'):
+            key = (a, length)
+            if key not in self.calibration:
+                continue
+            ranks[g.index] = percentile_rank(g[self.scorekey], self.calibration[key],
+                                             self.rankascending)
+        df['perc_rank'] = ranks.values
+        return df
+
+    def is_calibrated(self, alleles, length, method=None):
+        """Check there are calibrated score distributions for these alleles
+           and length, made with the same method and version"""
+
+        if self.calibration_version != self.version(method):
+            return False
+        return all([(a, length) in self.calibration for a in alleles])
+
+    def calibrate(self, alleles=[], length=11, n=10000, sequences=None,
+                  key='locus_tag', seqkey='translation', seqlength=250,
+                  freqs=None, seed=None, save=True, **kwargs):
+        """
+        Score a background set of sequences for each allele and store the
+        sorted scores. Predictions are then given a percentile rank that
+        doesn't depend on the rest of the data. Random sequences are used
+        unless a set of natural sequences is provided.
+        Args:
+            alleles: alleles to calibrate
+            length: peptide length
+            n: approx. number of background peptides per allele if random
+            sequences: dataframe of protein sequences to use as background
+            seqlength: length of each random sequence
+            freqs: amino acid frequencies for random sequences, see
+            peptutils.aa_frequencies
+            seed: random seed
+            save: save to calibrationdir so that they can be re-used
+            kwargs: passed to predict_multiple
+        Returns:
+            dict of sorted score arrays. These are only used for predictions
+            with the same method and predictor version, see load_calibration
+        """
+
+        if type(alleles) is str:
+            alleles = [alleles]
+        if sequences is None:
+            k = max(int(n/(seqlength-length+1)), 1)
+            seqs = peptutils.create_random_sequences(size=k, length=seqlength,
+                                                     freqs=freqs, seed=seed)
+            sequences = pd.DataFrame({key: ['random%s' %i for i in range(k)],
+                                      seqkey: seqs})
+        #keep the data and summary of the last real predictions
+        data, summary = self.data, self.summary
+        try:
+            df = self.predict_multiple(sequences, alleles=alleles, length=length,
+                                       key=key, seqkey=seqkey, **kwargs)
+        finally:
+            self.data, self.summary = data, summary
+        if len(df) == 0:
+            print ('no background predictions')
+            return
+        version = self.version(kwargs.get('method'))
+        if version != self.calibration_version:
+            self.calibration = {}
+            self.calibration_version = version
+        for a,g in df.groupby('allele'):
+            x = g[self.scorekey].dropna().values.astype('float32')
+            self.calibration[(a, length)] = np.sort(x)
+        if save == True:
+            self.save_calibration()
+        return self.calibration
+
+    def calibration_file(self, version):
+        """Default calibration file for a predictor version string"""
+
+        name = re.sub('[^A-Za-z0-9.-]+', '_', version)
+        return os.path.join(calibrationdir, name+'.npz')
+
+    def save_calibration(self, filename=None):
+        """Save calibrated score distributions with the version they were
+           made with, one file per predictor, method and version"""
+
+        if filename == None:
+            if not os.path.exists(calibrationdir):
+                os.makedirs(calibrationdir)
+            filename = self.calibration_file(self.calibration_version)
+        arrs = {'%s_%s' %k: self.calibration[k] for k in self.calibration}
+        arrs['version'] = np.array(self.calibration_version)
+        np.savez(filename, **arrs)
+        return filename
+
+    def load_calibration(self, filename=None, method=None):
+        """
+        Load saved calibrated score distributions. By default the file for
+        this predictor, method and version is used, see calibration_file.
+        Percentile ranks are only added to predictions with the same method
+        and version as the calibration.
+        """
+
+        if filename == None:
+            filename = self.calibration_file(self.version(method))
+        if not os.path.exists(filename):
+            return
+        f = np.load(filename)
+        if 'version' not in f.files:
+            print ('no version in %s, not loaded' %filename)
+            return
+        self.calibration = {}
+        self.calibration_version = str(f['version'])
+        for k in f.files:
+            if k == 'version':
+                continue
+            a, length = k.rsplit('_', 1)
+            self.calibration[(a, int(length))] = f[k]
+        return self.calibration
+
     def evaluate(self, df, key, value, operator='<'):
         """
         Evaluate binders less than or greater than a cutoff.
@@ -427,9 +1237,12 @@ class Predictor(object):
         Args:
             name: name of protein in predictions, optional
             cutoff: percentile cutoff for score or rank cutoff if value='rank'
-            value: 'score' or 'rank'
+            cutoff_method: 'default', 'rank', 'score' or 'percentile' to use the
+            percentile rank from calibrated background scores. With 'default'
+            and a name the score cutoffs are taken from that protein only
         Returns:
-            binders above cutoff in all alleles, pandas dataframe
+            binders above cutoff in all alleles, pandas dataframe. Compacted
+            data is expanded to plain columns for the selected rows only
         """
 
         if data is None:
@@ -437,41 +1250,45 @@ class Predictor(object):
                 return
             data = self.data
         cutoff = float(cutoff)
+        alldata = data
         if name != None:
             if name not in self.proteins():
                 print ('no such protein name in binder data')
                 return
             data = data[data.name==name]
 
-        if cutoff_method in ['default','']:
-            #calculates per allele cutoff over all data laoded
+        if cutoff_method in ['default',''] and name is None and alldata is self.data \
+            and not hasattr(self, 'cutoffs'):
+            #slices of the sorted score index
+            rows = self.get_index().select(cutoff, 'default')
+            return expand_data(data.iloc[rows], self.sequences)
+        elif cutoff_method in ['default','']:
+            #calculates per allele cutoff over all data loaded or the protein
             value = self.scorekey
-            if self.rankascending == 0:
-                q = (1-cutoff/100.)
-            else:
-                q = cutoff/100
             if hasattr(self, 'cutoffs'):
-                cuts = self.cutoffs
+                cuts = pd.Series(self.cutoffs)
             else:
-                cuts={}
-                #derive score cutoffs for each allele
-                for a,g in data.groupby('allele'):
-                    cuts[a] = g[value].quantile(q=q)
-            cuts = pd.Series(cuts)
-            #print (cuts)
-            res=[]
-            for a,g in data.groupby('allele'):
-                #print cuts[a]
-                if self.rankascending == 0:
-                    b = g[g[value]>cuts[a]]
-                else:
-                    b = g[g[value]<cuts[a]]
-                res.append(b)
-            return pd.concat(res)
+                cuts = self.allele_cutoffs(cutoff, alldata, name)
+            c = data.allele.map(cuts).astype(float).values
+            if self.rankascending == 0:
+                mask = data[value].values > c
+            else:
+                mask = data[value].values < c
+            return expand_data(data[mask], self.sequences)
         elif cutoff_method == 'rank':
             #done by rank in each sequence/allele
             res = data[data['rank'] < cutoff]
-            return res
+            return expand_data(res, self.sequences)
+        elif cutoff_method == 'percentile':
+            #done by percentile rank in calibrated background scores
+            if 'perc_rank' not in data.columns:
+                print ('no percentile ranks in data, calibrate the predictor first')
+                return
+            res = data[data['perc_rank'] <= cutoff]
+            return expand_data(res, self.sequences)
+        elif cutoff_method == 'score' and name is None and alldata is self.data:
+            rows = self.get_index().select(cutoff, 'score')
+            return expand_data(data.iloc[rows], self.sequences)
         elif cutoff_method == 'score':
             #done by global single score cutoff
             #print (data[self.scorekey])
@@ -479,7 +1296,110 @@ class Predictor(object):
                 res = data[data[self.scorekey] >= cutoff]
             else:
                 res = data[data[self.scorekey] <= cutoff]
-            return res
+            return expand_data(res, self.sequences)
+
+    def allele_cutoffs(self, cutoff=5, data=None, name=None):
+        """
+        Per allele score cutoffs at the given percentile of the data. These
+        are cached until the data is replaced or changed, see get_cache.
+        Args:
+            cutoff: percentile of best scores
+            data: predictions, uses the current data if None
+            name: only use the predictions for this protein
+        Returns: pandas series of cutoffs indexed by allele
+        """
+
+        if data is None:
+            data = self.data
+        if self.rankascending == 0:
+            q = (1-float(cutoff)/100.)
+        else:
+            q = float(cutoff)/100
+        c = self.get_cache(data)
+        key = (q, name)
+        if key not in c:
+            if name is not None:
+                data = data[data.name==name]
+            c[key] = data.groupby('allele', observed=True)[self.scorekey].quantile(q)
+        return c[key]
+
+    def get_cache(self, data):
+        """Cache of values derived from data, cleared when the data is
+           replaced, changes size or its index or scores are changed in place"""
+
+        c = self.cutoff_cache
+        checksum = data_checksum(data, [self.scorekey])
+        if c.get('data') is not data or c.get('size') != len(data) or \
+            c.get('checksum') != checksum:
+            c.clear()
+            c['data'] = data
+            c['size'] = len(data)
+            c['checksum'] = checksum
+        return c
+
+    def get_index(self):
+        """Sorted score index of the current data, see ScoreIndex. Rebuilt
+           when the data is replaced or changed, see get_cache."""
+
+        c = self.get_cache(self.data)
+        if 'index' not in c:
+            c['index'] = ScoreIndex(self.data, self.scorekey, self.rankascending==1)
+        return c['index']
+
+    def top_binders(self, path=None, by='allele', name=None, allele=None, n=None):
+        """
+        Top binders kept while predicting, from the last run or saved with
+        the results in path, so the score tables needn't be loaded.
+        Args:
+            path: results path, uses the current summary if None
+            by: 'allele' for the best over all proteins or 'protein' for the
+            best in each protein/allele
+            name: protein name
+            allele: allele
+            n: number per group, up to top_n when predicted
+        Returns: dataframe of predictions
+        """
+
+        if path is not None:
+            df = storage.load_stats(path, 'top_'+by)
+        elif self.summary is not None:
+            if by == 'allele':
+                df = self.summary.top.by_allele()
+            else:
+                df = self.summary.top.by_protein()
+        else:
+            df = None
+        if df is None or len(df) == 0:
+            return
+        if name is not None:
+            df = df[df.name==name]
+        if allele is not None:
+            df = df[df.allele==allele]
+        if n is not None:
+            keys = 'allele' if by == 'allele' else ['name','allele']
+            df = df.groupby(keys, sort=False).head(n)
+        return df
+
+    def promiscuity(self, cutoff=5, n=2, cutoff_method='default'):
+        """
+        Number of alleles each peptide binds at a cutoff, using the score
+        index so that repeated calls with a changing cutoff only process the
+        rows whose binder status changes.
+        Args:
+            cutoff: percentile or score cutoff
+            n: min number of alleles
+            cutoff_method: 'default' for per allele percentiles or 'score'
+        Returns:
+            dataframe of peptides binding at least n alleles
+        """
+
+        idx = self.get_index()
+        idx.update(cutoff, cutoff_method)
+        ids, rows = idx.promiscuous(n)
+        df = expand_data(self.data.iloc[rows], self.sequences)
+        df = df[['name','pos','peptide']].copy()
+        df['alleles'] = idx.counts[ids]
+        return df.sort_values(['alleles','name','pos'], ascending=[False,True,True])
 
     def promiscuousBinders(self, binders=None, name=None, cutoff=5,
                            cutoff_method='default', n=1, unique_core=True, **kwargs):
@@ -505,26 +1425,49 @@ class Predictor(object):
             return
         if 'core' not in binders.columns :
             binders['core'] = binders.peptide
-        grps = binders.groupby(['peptide','pos','name'])
         if self.operator == '<':
-            func = min
-            skname = 'min'
+            best = np.fmin
         else:
-            func = max
-            skname = 'max'
-        s = grps.agg({'allele':pd.Series.count,
-                      'core': first, self.scorekey:[func,np.mean],
-                      'rank': np.median})
-        s.columns = s.columns.get_level_values(1)
-        s.rename(columns={skname: self.scorekey, 'count': 'alleles','median':'median_rank',
-                         'first':'core'}, inplace=True)
-        s = s.reset_index()
-        s = s.sort_values(['alleles','median_rank'],ascending=[False,True])
-
-        #if we just want unique cores, drop duplicates takes most promiscuous in each group
+            best = np.fmax
+        if len(binders) == 0:
+            return pd.DataFrame(columns=['peptide','pos','name','alleles','core',
+                                         self.scorekey,'mean','median_rank'])
+        #integer group keys, rows sorted by peptide, pos, name then data order
+        codes = [pd.factorize(binders[c], sort=True)[0] for c in ['name','pos','peptide']]
+        order = np.lexsort([np.arange(len(binders))] + codes)
+        keys = np.array([c[order] for c in codes])
+        start = np.flatnonzero(np.concatenate([[True], (keys[:,1:] != keys[:,:-1]).any(0)]))
+        size = np.diff(np.concatenate([start, [len(order)]]))
+        grp = np.repeat(np.arange(len(start)), size)
+        rows = binders.iloc[order[start]]
+        x = binders[self.scorekey].values[order].astype(float)
+        valid = ~np.isnan(x)
+        nvalid = np.add.reduceat(valid.astype(int), start)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.add.reduceat(np.where(valid, x, 0), start) / nvalid
+        #median rank of each group from the ranks sorted within groups
+        r = binders['rank'].values[order].astype(float)
+        r = r[np.lexsort((r, grp))]
+        nr = np.add.reduceat((~np.isnan(r)).astype(int), start)
+        lo = start + np.clip((nr-1)//2, 0, None)
+        hi = start + np.clip(nr//2, 0, None)
+        median = np.where(nr > 0, (r[lo] + r[hi])/2., np.nan)
+        s = pd.DataFrame({'peptide': rows.peptide.values, 'pos': rows.pos.values,
+                          'name': rows.name.values,
+                          'alleles': np.add.reduceat(binders.allele.notnull().values[order]
+                                                     .astype(int), start),
+                          'core': rows.core.values,
+                          self.scorekey: best.reduceat(x, start),
+                          'mean': mean, 'median_rank': median},
+                          columns=['peptide','pos','name','alleles','core',
+                                   self.scorekey,'mean','median_rank'])
+        s = s.iloc[np.lexsort((np.arange(len(s)), s.median_rank.values, -s.alleles.values))]
+
+        #if we just want unique cores, take the most promiscuous in each group
         #since we have sorted by alleles and median rank
         if unique_core == True:
-            s = s.drop_duplicates('core')
+            c = pd.factorize(s.core)[0]
+            s = s.iloc[np.sort(np.unique(c, return_index=True)[1])]
         s = s[s.alleles>=n]
         return s
 
@@ -543,6 +1486,7 @@ class Predictor(object):
             if names is str:
                 names = [names]
             df=df[df.name.isin(names)]
+        df = expand_data(df, self.sequences)
         funcs = { 'median':np.median, 'mean':np.mean, 'best':min }
         func = funcs[how]
         b = df.groupby(['peptide']).agg({'rank': func,'pos':first, 'name':first,
@@ -559,7 +1503,7 @@ class Predictor(object):
         if binders == True:
             df = self.getBinders()
         else:
-            df = self.data
+            df = expand_data(self.data, self.sequences)
         grouped = df.groupby('core')
         cores = grouped.agg({self.scorekey:max})
         #cores = df.loc[grouped[self.scorekey].max().index]
@@ -597,7 +1541,7 @@ class Predictor(object):
 
     def predictProteins(self, recs, key='locus_tag', seqkey='translation',
                         names=None, alleles=[], path=None, verbose=False,
-                        cpus=1, **kwargs):
+                        cpus=1, compact=False, calibrated=False, clear=False, **kwargs):
         """
         Get predictions for a set of proteins and/or over multiple alleles.
         This is mostly a wrapper for predict_multiple. Sequences should be put into
@@ -608,7 +1552,17 @@ class Predictor(object):
             seqkey: key for sequence column
             names: names of proteins to use from sequences, list or pandas series
             cpus: number of threads to run, use 0 for all cpus
-            see predict_multiple for other kwargs
+            compact: store results in memory using compact_data
+            calibrated: load the saved calibration for this predictor, method
+            and version if none is loaded, to add percentile ranks
+            output: 'all' or 'binders' to keep only binders, filtered in the
+            workers with the cutoff and cutoff_method kwargs
+            see predict_multiple for other kwargs, with format='parquet' or 'sqlite'
+            and overwrite the existing results in path of the proteins being
+            predicted are replaced, with overwrite=False only proteins/alleles
+            missing from the results in path are predicted
+            clear: with format='parquet' or 'sqlite' first remove all saved
+            results in path for this predictor, not only those being predicted
           Returns:
             a dataframe of predictions over multiple proteins
         """
@@ -622,12 +1576,38 @@ class Predictor(object):
             print ('no alleles provided')
             return
 
+        if kwargs.get('output') == 'binders' and \
+            kwargs.get('cutoff_method', 'rank') not in stream_cutoff_methods:
+            raise ValueError('cutoff method %s needs all data, use output=\'all\''
+                             %kwargs.get('cutoff_method'))
+        if calibrated == True and len(self.calibration) == 0:
+            self.load_calibration(method=kwargs.get('method'))
+        if kwargs.get('output') == 'binders' and kwargs.get('cutoff_method') == 'percentile' \
+            and not self.is_calibrated(alleles, kwargs.get('length', 11), kwargs.get('method')):
+            raise ValueError('no calibration for these alleles, calibrate the predictor '
+                             'or use another cutoff method')
         if names is not None:
             recs = recs[recs[key].isin(names)]
         results = []
         if path is not None and path != '':
             if not os.path.exists(path):
                 os.mkdir(path)
+            #only the results of the proteins predicted are replaced
+            remove = None if clear == True else list(recs[key])
+            if kwargs.get('format') == 'parquet' and \
+                (kwargs.get('overwrite', True) == True or clear == True):
+                storage.delete_dataset(path, self.name, remove)
+                m = storage.RunManifest(path)
+                m.clear(self.name, remove)
+                m.close()
+            if kwargs.get('format') == 'sqlite' and \
+                (kwargs.get('overwrite', True) == True or clear == True):
+                db = storage.ResultDB(path)
+                db.delete(self.name, remove)
+                db.close()
+                m = storage.RunManifest(path)
+                m.clear(self.name, remove)
+                m.close()
 
         if verbose == True:
             self.print_heading()
@@ -642,16 +1622,198 @@ class Predictor(object):
         if path is None:
             #if no path we keep assign results to the data object
             #assumes we have enough memory..
+            if compact == True and len(results) > 0:
+                self.sequences = dict(zip(recs[key], recs[seqkey].apply(clean_sequence)))
+                results = self.compact(results)
             self.data = results
         else:
             print ('results saved to %s' %os.path.abspath(path))
+            #summaries of all results saved, including those of earlier runs
+            m = storage.RunManifest(path)
+            self.summary = m.summary(self.name, self.scorekey, self.rankascending==1,
+                                     self.top_n)
+            m.close()
+            self.summary.save(path)
             results = None
         self.cleanup()
         return results
 
+    def predict_batch(self, seqs, allele='', length=11, overlap=1, method=None):
+        """
+        Predict a batch of sequences for one allele. Calls predict for each
+        sequence, override for predictors that can score many sequences per call.
+            Args:
+                seqs: dict of name/sequence pairs
+            Returns: a dict of dataframes keyed by name
+        """
+
+        res = OrderedDict()
+        for name in seqs:
+            res[name] = self.predict(sequence=seqs[name], length=length, overlap=overlap,
+                                     allele=allele, name=name, method=method)
+        return res
+
+    def iter_predict(self, recs, alleles=[], length=11, overlap=1, key='locus_tag',
+                     seqkey='sequence', verbose=False, method=None, batch_size=None,
+                     skip=None, done=None, per_allele=False, units=None):
+        """
+        Generator of predictions for multiple proteins in a dataframe. Yields
+        one dataframe per protein over all alleles, only the current batch of
+        sequences is held in memory.
+            Args:
+                recs: protein sequences in a pandas DataFrame
+                skip: names of proteins to skip
+                done: (name, allele) pairs to skip
+                per_allele: yield each protein/allele as soon as it is done
+                units: list that (name, allele) pairs are appended to, with
+                per_allele as each is yielded, otherwise after each batch
+                see predict_multiple for other args
+        """
+
+        self.length = length
+        if batch_size is None:
+            batch_size = self.batch_size
+        if skip is None:
+            skip = set()
+        if done is None:
+            done = set()
+        for chunk in batches(recs, batch_size):
+            seqs = OrderedDict()
+            for i,row in chunk.iterrows():
+                name = row[key]
+                if name in skip:
+                    continue
+                #clean the sequence of non-aa characters
+                seqs[name] = clean_sequence(row[seqkey])
+            if len(seqs) == 0:
+                continue
+            preds = {}
+            for a in alleles:
+                s = OrderedDict([(n,seqs[n]) for n in seqs if (n,a) not in done])
+                if len(s) == 0:
+                    continue
+                preds[a] = self.predict_batch(s, allele=a, length=length,
+                                              overlap=overlap, method=method)
+                if per_allele == False:
+                    continue
+                for name in s:
+                    df = preds[a].get(name)
+                    if units is not None:
+                        units.append((name,a))
+                    if df is None:
+                        continue
+                    if verbose == True and len(df)>0:
+                        print (self.format_row(df.iloc[0]))
+                    yield df
+            if per_allele == True:
+                continue
+            for name in seqs:
+                res = []
+                for a in alleles:
+                    df = preds.get(a, {}).get(name)
+                    if df is None:
+                        continue
+                    res.append(df)
+                    if verbose == True and len(df)>0:
+                        x = df.iloc[0]
+                        s = self.format_row(x)
+                        print (s)
+                if len(res) == 0:
+                    continue
+                yield pd.concat(res)
+            if units is not None:
+                units.extend([(n,a) for a in preds for n in seqs if (n,a) not in done])
+
+    def stream(self, recs, sinks=[], **kwargs):
+        """
+        Run predictions and pass each protein's results to one or more sinks,
+        e.g. storage.CSVSink, storage.DatasetSink or storage.CallbackSink
+            Args:
+                recs: protein sequences in a pandas DataFrame
+                sinks: list of sink objects
+                kwargs: passed to iter_predict
+            Returns: number of rows written
+        """
+
+        n = 0
+        try:
+            for df in self.iter_predict(recs, **kwargs):
+                for s in sinks:
+                    s.write(df)
+                n += len(df)
+        finally:
+            for s in sinks:
+                s.close()
+        return n
+
+    def iter_binders(self, stream, cutoff=5, cutoff_method='rank'):
+        """
+        Filter a stream of predictions from iter_predict to binders. Only
+        cutoff methods that don't depend on the whole dataset can be used:
+        'rank', 'score' or 'percentile', others raise a ValueError.
+        """
+
+        if cutoff_method not in stream_cutoff_methods:
+            raise ValueError('cutoff method %s needs all data, use getBinders' %cutoff_method)
+        def binders():
+            for df in stream:
+                b = self.getBinders(data=df, cutoff=cutoff, cutoff_method=cutoff_method)
+                if b is not None and len(b) > 0:
+                    yield b
+        return binders()
+
+    def stream_promiscuous(self, stream, cutoff=5, cutoff_method='rank', n=1,
+                           unique_core=True):
+        """
+        Promiscuous binders from a stream of predictions, see promiscuousBinders.
+        Binders are aggregated per protein as they arrive and only the
+        aggregated rows are kept.
+        """
+
+        res = []
+        for b in self.iter_binders(stream, cutoff, cutoff_method):
+            pb = self.promiscuousBinders(binders=b, n=n, unique_core=False)
+            res.append(pb)
+        if len(res) == 0:
+            return pd.DataFrame()
+        s = pd.concat(res)
+        #stable sort so ties keep the order of promiscuousBinders
+        s = s.iloc[np.lexsort((np.arange(len(s)), s.median_rank.values, -s.alleles.values))]
+        if unique_core == True:
+            s = s.drop_duplicates('core')
+        return s
+
+    def version(self, method=None):
+        """Version string used to identify results in run manifests,
+           the default method is used if method is None. Predictors without
+           a method have no trailing space"""
+
+        from . import __version__
+        if method is None:
+            method = self.default_method
+        return ('%s %s %s' %(self.name, __version__, method)).strip()
+
+    def _summarize_stream(self, stream, units=None):
+        """Update the summary statistics from a stream of predictions, and
+           those of each protein/allele in the units dict if given"""
+
+        for df in stream:
+            self.summary.update(df)
+            if units is not None and len(df) > 0:
+                self._unit_summary(units, df).update(df)
+            yield df
+
+    def _unit_summary(self, units, df):
+        u = (df.name.iloc[0], df.allele.iloc[0])
+        if u not in units:
+            units[u] = storage.AlleleSummary(self.scorekey, self.rankascending==1,
+                                             self.top_n)
+        return units[u]
+
     def predict_multiple(self, recs, path=None, overwrite=True, alleles=[], length=11, overlap=1,
                           key='locus_tag', seqkey='sequence', verbose=False,
-                          method=None):
+                          method=None, batch_size=None, format='csv', output='all',
+                          cutoff=5, cutoff_method='rank'):
         """Predictions for multiple proteins in a dataframe
             Args:
                 recs: protein sequences in a pandas DataFrame
@@ -664,42 +1826,118 @@ class Predictor(object):
                 seqkey: key for sequence column
                 verbose: provide output per protein/sequence
                 method: IEDB method if using those predictors
-            Returns: a dataframe of the results if no path is given
+                batch_size: sequences per call to predict_batch, uses the
+                predictor default if None
+                format: 'csv' for one file per protein, 'parquet' for a
+                dataset partitioned by predictor and allele or 'sqlite' for an
+                indexed database, see storage module
+                output: 'all' or 'binders' to only keep rows passing the cutoff
+                cutoff: cutoff used if output='binders'
+                cutoff_method: 'rank' (top n per protein/allele), 'score' or
+                'percentile', see getBinders
+            Returns: a dataframe of the results if no path is given, per allele
+            summary statistics are stored in the summary attribute
+
+            When saving to a path the completed proteins/alleles are recorded in
+            a run manifest (see storage.RunManifest) with their summary
+            statistics as they are written. With
+            overwrite=False only the missing proteins/alleles are predicted and
+            added to the existing results, a ValueError is raised if these are
+            for another peptide length, predictor version or output and cutoff.
         """
 
+        if output == 'binders' and cutoff_method not in stream_cutoff_methods:
+            raise ValueError('cutoff method %s needs all data, use output=\'all\'' %cutoff_method)
+        if output == 'binders' and cutoff_method == 'percentile' and \
+            not self.is_calibrated(alleles, length, method):
+            raise ValueError('no calibration for these alleles, calibrate the predictor '
+                             'or use another cutoff method')
         results = []
-        self.length = length
-        for i,row in recs.iterrows():
-            seq = row[seqkey]
-            seq = clean_sequence(seq) #clean the sequence of non-aa characters
-            #print (row)
-            name = row[key]
-            if path is not None:
-                fname = os.path.join(path, name+'.csv')
-                if os.path.exists(fname) and overwrite == False:
-                    continue
-            res = []
-            for a in alleles:
-                #print (a)
-                df = self.predict(sequence=seq, length=length, overlap=overlap,
-                                    allele=a, name=name, method=method)
-                if df is not None:
-                    res.append(df)
-                else:
-                    continue
-                if verbose == True and len(df)>0:
-                    x = df.iloc[0]
-                    s = self.format_row(x)
-                    print (s)
-            if len(res) == 0:
-                continue
-            res = pd.concat(res)
-
-            if path is not None and len(res)>0:
-                res.to_csv(fname)
-            else:
-                results.append(res)
-        #print (len(recs))
+        saved = set()
+        done = set()
+        units = []
+        #summaries of the units not yet recorded in the manifest
+        pending = {}
+        manifest = None
+        self.summary = storage.AlleleSummary(self.scorekey, self.rankascending==1,
+                                             self.top_n)
+        if path is not None:
+            manifest = storage.RunManifest(path)
+            version = self.version(method)
+            okey = storage.output_key(output, cutoff, cutoff_method)
+            hashes = dict([(n, storage.sequence_hash(clean_sequence(s)))
+                            for n,s in zip(recs[key], recs[seqkey])])
+            #results saved before manifests were used are assumed complete
+            legacy = overwrite == False and manifest.count(self.name) == 0
+            if overwrite == False:
+                #never mix results of another length, version or output in the same outputs
+                runs = manifest.runs(self.name) - set([(version, length, okey)])
+                if len(runs) > 0:
+                    manifest.close()
+                    v, l, o = sorted(runs)[0]
+                    raise ValueError('results in %s are for %s, length %s, output %s. Use '
+                                     'overwrite=True or another path' %(path, v, l, o))
+            elif format == 'csv':
+                manifest.clear(self.name, list(hashes))
+        if path is not None and format == 'parquet':
+            sink = storage.DatasetSink(path, self.name, self.buffer_rows)
+            if legacy == True:
+                saved = storage.dataset_units(path, self.name)
+        elif path is not None and format == 'sqlite':
+            sink = storage.DatabaseSink(path, self.name, self.buffer_rows)
+            if legacy == True:
+                saved = sink.db.units(self.name)
+        elif path is not None:
+            sink = storage.CSVSink(path, append=not overwrite)
+            if legacy == True:
+                saved = sink.units()
+                l = storage.csv_length(storage.get_csv_files(path))
+                if l is not None and l != length:
+                    manifest.close()
+                    raise ValueError('results in %s are for length %s. Use overwrite=True '
+                                     'or another path' %(path, l))
+        else:
+            sink = storage.CallbackSink(results.append)
+        if manifest is not None:
+            #only the proteins/alleles already saved are recorded as done
+            manifest.add([(hashes[n], n, a) for n,a in saved if n in hashes and a in alleles],
+                         self.name, version, length, okey)
+            if overwrite == False:
+                d = manifest.done(self.name, version, length, okey)
+                done = set([(n,a) for n in hashes for a in alleles if (hashes[n],a) in d])
+        stream = self.iter_predict(recs, alleles=alleles, length=length, overlap=overlap,
+                                   key=key, seqkey=seqkey, verbose=verbose, method=method,
+                                   batch_size=batch_size, done=done,
+                                   per_allele=path is not None, units=units)
+        stream = self._summarize_stream(stream, pending if path is not None else None)
+        if output == 'binders':
+            stream = self.iter_binders(stream, cutoff, cutoff_method)
+        def commit(n):
+            stats = dict([(u, pending.pop(u, None)) for u in units[:n]])
+            manifest.add([(hashes[i], i, a) for i,a in units[:n]], self.name, version,
+                         length, okey, stats)
+            del units[:n]
+        #units passed to the sink, the rest are not recorded if the run fails
+        written = 0
+        complete = False
+        try:
+            for df in stream:
+                if output == 'binders':
+                    self.summary.update(df, binders=True)
+                    if path is not None and len(df) > 0:
+                        self._unit_summary(pending, df).update(df, binders=True)
+                sink.write(df)
+                written = len(units)
+                #only record units once the sink has written them to disk
+                if manifest is not None and getattr(sink, 'rows', 0) == 0:
+                    commit(written)
+                    written = 0
+            complete = True
+        finally:
+            sink.close()
+            if manifest is not None:
+                commit(len(units) if complete == True else written)
+                manifest.close()
         if len(results)>0:
             results = pd.concat(results)
         return results
@@ -726,14 +1964,17 @@ class Predictor(object):
         pool = mp.Pool(cpus)
         funclist = []
         st = time.time()
-        chunks = np.array_split(recs,cpus)
+        chunks = [recs.iloc[i] for i in np.array_split(np.arange(len(recs)),cpus)]
         for recs in chunks:
             f = pool.apply_async(worker, [self,recs,kwargs])
             #print (f)
             funclist.append(f)
         result = []
+        self.summary = storage.AlleleSummary(self.scorekey, self.rankascending==1,
+                                             self.top_n)
         for f in funclist:
-            df = f.get(timeout=None)
+            df, summary = f.get(timeout=None)
+            self.summary.merge(summary)
             if df is not None and len(df)>0:
                 result.append(df)
         pool.close()
@@ -747,41 +1988,85 @@ class Predictor(object):
         return result
 
     def load(self, path=None, names=None,
-               compression='infer', file_limit=None):
+               compression='infer', file_limit=None, alleles=None, filters=None,
+               compact=False, sequences=None, cache=False):
         """
         Load results for one or more proteins
         Args:
-            path: name of a csv file or directory with one or more csv files
+            path: name of a csv or arrow file, directory with one or more csv
+            files, a partitioned dataset or a results database (see storage module)
             file_limit: limit to load only the this number of proteins
+            alleles: alleles to load from a dataset or database
+            filters: list of (column, operator, value) tuples to select rows
+            from a dataset or database, e.g. [('score','>',2)]
+            compact: store the data using compact_data
+            sequences: protein sequences keyed by name, used with compact to
+            replace peptides with offsets
+            cache: for a directory of csv files, keep a consolidated copy
+            that is used until the files change, see storage.load_csv_folder
         """
 
-        if os.path.isfile(path):
-            self.data = pd.read_csv(path, index_col=0)
-        elif os.path.isdir(path):
-            if not os.path.exists(path):
-                print('no such path %s' %path)
+        if storage.is_arrow(path):
+            r = storage.ArrowResults(path)
+            self.data = r.to_dataframe(names)
+            if alleles is not None:
+                self.data = self.data[self.data.allele.isin(alleles)]
+        elif os.path.isfile(path):
+            self.data = storage.read_csv(path, compression)
+        elif storage.is_dataset(path):
+            df = storage.load_dataset(path, self.name, names=names, alleles=alleles,
+                                      filters=filters)
+            if len(df) == 0:
                 return
-            files = glob.glob(os.path.join(path, '*.csv'))
-            if names is not None:
-                names = [n+'.csv' for n in names]
-                files = [n for n in files if os.path.basename(n) in names]
-            if len(files) == 0:
-                #print ('no files to load')
+            self.data = df
+        elif storage.is_database(path):
+            df = self.query(path, names=names, alleles=alleles, filters=filters)
+            if len(df) == 0:
                 return
-            if file_limit != None:
-                files = files[:file_limit]
-            res = []
-            for f in files:
-                df = pd.read_csv(f, index_col=0, compression=compression)
-                if len(df) == 0:
-                    continue
-                if not self.scorekey in df.columns:
-                    continue
-                res.append(df)
-            self.data = pd.concat(res)
+            self.data = df
+        elif os.path.isdir(path):
+            df = storage.load_csv_folder(path, names, file_limit, compression,
+                                         scorekey=self.scorekey, cache=cache)
+            if df is None:
+                return
+            self.data = df
+        if compact == True and self.data is not None:
+            if sequences is not None:
+                self.sequences = sequences
+            self.data = self.compact(self.data)
         return
 
-    def save(self, prefix='_', filename=None, compression=None):
+    def query(self, path, names=None, alleles=None, start=None, end=None,
+              filters=None, columns=None):
+        """
+        Query saved predictions in a results database using its indexes, e.g.
+        P.query(path, alleles=['HLA-DRB1*0101'], filters=[('rank','<',10)])
+        P.query(path, names=['ZEBOVgp1'], start=100, end=300)
+        Args:
+            path: folder with the database, see storage.ResultDB
+            names: protein names
+            alleles: alleles
+            start, end: range of peptide positions
+            filters: list of (column, operator, value) tuples
+            columns: columns to return
+        Returns: a dataframe
+        """
+
+        db = storage.ResultDB(path)
+        df = db.query(self.name, names, alleles, start, end, filters, columns)
+        db.close()
+        return df
+
+    def compact(self, data):
+        """Compact prediction data and report the memory saved"""
+
+        m1 = memory_usage(data)
+        data = compact_data(data, self.sequences, keep=[self.scorekey])
+        m2 = memory_usage(data)
+        print ('compacted data from %.1f MB to %.1f MB' %(m1, m2))
+        return data
+
+    def save(self, prefix='_', filename=None, compression=None, format='csv'):
         """
         Save all current predictions dataframe with some metadata
         Args:
@@ -789,14 +2074,27 @@ class Predictor(object):
             filename: if saving all to a single file
             compression: a string representing the compression to use,
             allowed values are 'gzip', 'bz2', 'xz'.
+            format: 'csv' or 'parquet' to append to a partitioned dataset
+            in prefix or 'sqlite' to add to a results database in prefix,
+            replacing any saved results for the same proteins.
+            Compacted data is expanded first so that peptides and cores are saved.
         """
 
         exts = {'gzip':'.gz','bz2':'.bz2','xz':'.xz'}
-        if filename != None:
+        if format == 'parquet':
+            print ('saving to %s' %prefix)
+            storage.save_dataset(expand_data(self.data, self.sequences), prefix, self.name)
+        elif format == 'sqlite':
+            print ('saving to %s' %prefix)
+            db = storage.ResultDB(prefix)
+            db.delete(self.name, self.data.name.unique())
+            db.save(expand_data(self.data, self.sequences), self.name)
+            db.close()
+        elif filename != None:
             cext = exts[compression]
             if compression != None and not filename.endswith(cext):
                 filename += cext
-            self.data.to_csv(filename, compression=compression)
+            expand_data(self.data, self.sequences).to_csv(filename, compression=compression)
         else:
             #save one file per protein/name
             ext = '.csv'
@@ -805,20 +2103,60 @@ class Predictor(object):
             if not os.path.exists(path):
                 os.makedirs(path)
             for name,df in self.data.groupby('name'):
+                if len(df) == 0:
+                    continue
                 outfile = os.path.join(path, name+ext)
-                df.to_csv(outfile)
+                expand_data(df, self.sequences).to_csv(outfile)
+        return
+
+    def save_tracks(self, path, dtype='float32'):
+        """Save current data as memory mapped score tracks, see
+           storage.save_tracks. Only for fixed length, overlap 1 predictions."""
+
+        storage.save_tracks(self.data, path, self.sequences, self.name, self.scorekey,
+                            dtype=dtype)
         return
 
-    def save_msgpack(self, filename=None):
-        """Save as msgpack format - experimental"""
+    def load_tracks(self, path, names=None, alleles=None):
+        """Load data from score tracks saved with save_tracks. Cores are not
+           stored so are not present in the data"""
 
+        T = storage.ScoreTracks(path)
+        df = T.to_dataframe(names, alleles)
+        if len(df) == 0:
+            return
+        s = self.scorekey
+        df['rank'] = df.groupby(['name','allele'])[s].rank(method='min',
+                                                 ascending=self.rankascending)
+        self.add_percentile_rank(df)
+        df.sort_values(by=['rank','name','allele'], ascending=True, inplace=True)
+        self.data = df
+        return T
+
+    def save_arrow(self, filename=None):
+        """
+        Save current data as a single Arrow IPC file, one record batch per
+        protein with the run metadata embedded. See storage.ArrowResults for
+        reading single proteins, or load the file with load. Compacted data is
+        expanded one protein at a time.
+        """
+
+        pa = storage.require_pyarrow()
+        length = get_length(self.data)
         if filename == None:
-            filename = 'epit_%s_%s_%s.msg' %(label,self.name,self.length)
+            filename = 'epit_%s_%s.arrow' %(self.name,length)
         print ('saving as %s' %filename)
-        meta = {'method':self.name, 'length':self.length}
-        pd.to_msgpack(filename, meta)
-        for i,g in self.data.groupby('name'):
-            pd.to_msgpack(filename, g, append=True)
+        meta = {'method':self.name, 'length':length,
+                'alleles':sorted(self.data.allele.astype(str).unique()),
+                'version':self.version(getattr(self, 'iedbmethod', None)),
+                'pandas':pd.__version__,
+                'pyarrow':pa.__version__}
+        sink = storage.ArrowSink(filename, meta)
+        for i,g in self.data.groupby('name', sort=False):
+            if len(g) == 0:
+                continue
+            sink.write(expand_data(g, self.sequences))
+        sink.close()
         return
 
     def summarize(self):
@@ -835,7 +2173,8 @@ class Predictor(object):
         return s
 
     def protein_summary(self):
-        print ( self.data.groupby('name').agg({'peptide':np.size}) )
+        df = expand_data(self.data, self.sequences)
+        print ( df.groupby('name').agg({'peptide':np.size}) )
 
     def proteins(self):
         return list(self.data.name.unique())
@@ -846,6 +2185,7 @@ class Predictor(object):
         df = self.data
         if name != None:
             df = df[df.name==name]
+        df = expand_data(df, self.sequences)
         p = df.pivot_table(index='peptide', columns='allele', values=self.scorekey)
         p = p.reset_index()
         x = list(df.groupby('allele'))[0][1]
@@ -1006,6 +2346,8 @@ class IEDBMHCIPredictor(Predictor):
         self.operator = '<'
         self.rankascending = 1
         self.iedbmethod = 'IEDB_recommended'
+        self.default_method = 'IEDB_recommended'
+        self.batch_size = 50
         return
 
     def predict(self, sequence=None, peptides=None, length=11, overlap=1,
@@ -1013,33 +2355,52 @@ class IEDBMHCIPredictor(Predictor):
         """Use IEDB MHCI python module to get predictions.
            Requires that the iedb MHC tools are installed locally"""
 
-        tempfile = os.path.join(self.temppath, name+'.fa')
-        seqfile = write_fasta(sequence, id=name, filename=tempfile)
-        #print (seqfile)
+        res = self.predict_batch({name: sequence}, allele=allele, length=length,
+                                 method=method)
+        if res is None:
+            return
+        return res.get(name)
+
+    def predict_batch(self, seqs, allele='HLA-A*01:01', length=11, overlap=1,
+                      method=None):
+        """Predict a batch of sequences with a single call to the IEDB tool"""
+
         path = iedbmhc1path
         if not os.path.exists(path):
             print ('IEDB mhcI tools not found')
-            return
-        if method == None: method = 'IEDB_recommended'
+            return {}
+        if method == None: method = self.default_method
         self.iedbmethod = method
+        tempfile = os.path.join(self.temppath, '%s.fa' %list(seqs)[0])
+        seqfile = write_fasta_batch(seqs, filename=tempfile)
         cmd = os.path.join(path,'src/predict_binding.py')
-        cmd = cmd+' %s %s %s %s' %(method,allele,length,seqfile)
-        #print (cmd)
-        from subprocess import Popen, PIPE
         try:
-            p = Popen(cmd, stdout=PIPE, shell=True)
-            temp,error = p.communicate()
-            #print (temp)
-        except OSError as e:
+            temp = run_iedb_tool(cmd, [method, allele, length, seqfile])
+        except (OSError, CalledProcessError) as e:
             print (e)
-            return
-        df = self.prepareData(temp, name)
-        return df
+            return {}
+        try:
+            df = pd.read_csv(io.BytesIO(temp), sep="\t")
+        except ValueError:
+            df = pd.DataFrame()
+        if len(df)==0:
+            print (temp) #should print error string from output
+            return {}
+        res = split_iedb_batch(df, seqs.keys())
+        if res is None:
+            #output can't be assigned to each sequence so run them singly
+            return Predictor.predict_batch(self, seqs, allele, length, overlap, method)
+        for name in res:
+            res[name] = self.prepareData(res[name], name)
+        return res
 
     def prepareData(self, rows, name):
         """Prepare data from results"""
 
-        df = pd.read_csv(io.BytesIO(rows),sep="\t")
+        if isinstance(rows, pd.DataFrame):
+            df = rows.reset_index(drop=True)
+        else:
+            df = pd.read_csv(io.BytesIO(rows),sep="\t")
         if len(df)==0:
             print (rows) #should print error string from output
             return
@@ -1096,6 +2457,8 @@ class IEDBMHCIIPredictor(Predictor):
         self.methods = ['comblib','consensus3','IEDB_recommended',
                         'NetMHCIIpan','nn_align','smm_align','tepitope']
         self.iedbmethod = 'IEDB_recommended'
+        self.default_method = 'IEDB_recommended'
+        self.batch_size = 50
         return
 
     def prepareData(self, rows, name):
@@ -1105,7 +2468,10 @@ class IEDBMHCIIPredictor(Predictor):
             return
 
         #print (rows)
-        df = pd.read_csv(io.BytesIO(rows),sep=r'\t',engine='python',index_col=False)
+        if isinstance(rows, pd.DataFrame):
+            df = rows.reset_index(drop=True)
+        else:
+            df = pd.read_csv(io.BytesIO(rows),sep=r'\t',engine='python',index_col=False)
         #print (df.iloc[0])
         extracols = ['Start','End','comblib_percentile','smm_percentile','nn_percentile',
                      'Sturniolo core',' Sturniolo score',' Sturniolo percentile']
@@ -1134,25 +2500,38 @@ class IEDBMHCIIPredictor(Predictor):
            Requires that the IEDB MHC-II tools are installed locally
         """
 
+        res = self.predict_batch({name: sequence}, allele=allele, length=length,
+                                 method=method)
+        return res.get(name)
+
+    def predict_batch(self, seqs, allele='HLA-DRB1*01:01', length=15, overlap=None,
+                      method='IEDB_recommended'):
+        """Predict a batch of sequences with a single call to the IEDB tool"""
+
+        if method == None: method = self.default_method
         self.iedbmethod = method
-        tempfile = os.path.join(self.temppath, name+'.fa')
-        seqfile = write_fasta(sequence, id=name, filename=tempfile)
         path = iedbmhc2path
-        if method == None: method = 'IEDB_recommended'
         if not os.path.exists(path):
             print ('iedb mhcII tools not found')
-            return
+            return {}
+        tempfile = os.path.join(self.temppath, '%s.fa' %list(seqs)[0])
+        seqfile = write_fasta_batch(seqs, filename=tempfile)
         cmd = os.path.join(path,'mhc_II_binding.py')
-        cmd = cmd+' %s %s %s' %(method,allele,seqfile)
-        #print (cmd)
-        #print (allele)
         try:
-            temp = subprocess.check_output(cmd, shell=True, executable='/bin/bash')
+            temp = run_iedb_tool(cmd, [method, allele, seqfile])
         except:
             print ('allele %s not available?' %allele)
-            return
-        data = self.prepareData(temp, name)
-        return data
+            return {}
+        if len(temp) == 0:
+            return {}
+        df = pd.read_csv(io.BytesIO(temp),sep=r'\t',engine='python',index_col=False)
+        res = split_iedb_batch(df, seqs.keys())
+        if res is None:
+            #output can't be assigned to each sequence so run them singly
+            return Predictor.predict_batch(self, seqs, allele, length, overlap, method)
+        for name in res:
+            res[name] = self.prepareData(res[name], name)
+        return res
 
     def getAlleles(self):
         if not os.path.exists(iedbmhc2path):
@@ -1214,35 +2593,43 @@ class IEDBBCellPredictor(Predictor):
         self.rankascending = 0
         self.iedbmethod = 'Bepipred'
         self.path = iedbbcellpath
+        #use the numpy implementation of the scale methods in bcell.methods
+        self.native = True
+        #score thresholds of the last predictions, per protein for predictProteins
+        self.threshold = None
+        self.thresholds = None
 
     def predict(self, sequence=None, peptides=None, window=None, name=''):
         """Uses code from iedb predict_binding.py """
 
         value = self.iedbmethod
+        if self.native == True and value in bcell.methods:
+            scale = bcell.get_scales(self.path).get(value)
+            self.data = bcell.predict(sequence, scale, value, window, name=name)
+            t = bcell.thresholds(self.data, value)
+            self.threshold = t.iloc[0] if len(t) > 0 else None
+            return self.data
         currpath=os.getcwd()
         os.chdir(self.path)
         sys.path.append(self.path)
         from src.BCell import BCell
-        bcell = BCell()
-        filepath = os.path.join(self.path,'bcell_scales.pickle')
-        picklefile = open(filepath, 'rb')
-        scale_dict = pickle.load(picklefile)
-        bcell.scale_dict = scale_dict[value]
+        bc = BCell()
+        bc.scale_dict = bcell.get_scales(self.path)[value]
         if window==None:
-            window = bcell.window
+            window = bc.window
         center = "%d" %round(int(window)/2.0)
         if value == 'Emini':
-            results = bcell.emini_method(value, sequence, window, center)
+            results = bc.emini_method(value, sequence, window, center)
         elif value == 'Karplus-Schulz':
-            results = bcell.karplusshulz_method(value, sequence, window, center)
+            results = bc.karplusshulz_method(value, sequence, window, center)
         elif value == 'Kolaskar-Tongaonkar':
-            results = bcell.kolaskartongaonkar_method(value, sequence, window, center)
+            results = bc.kolaskartongaonkar_method(value, sequence, window, center)
         elif value == 'Bepipred':
-            results = bcell.bepipred_method(value, sequence, window, center)
+            results = bc.bepipred_method(value, sequence, window, center)
         else:
-            results = bcell.classical_method(value, sequence, window, center)
+            results = bc.classical_method(value, sequence, window, center)
 
-        threshold = round(results[1][0], 3)
+        self.threshold = round(results[1][0], 3)
         temp=results[0]
         self.prepareData(temp, name)
         os.chdir(currpath)
@@ -1262,27 +2649,41 @@ class IEDBBCellPredictor(Predictor):
         return
 
     def predictProteins(self, recs, names=None, save=False,
-                        label='', path='', **kwargs):
+                        label='', path='', window=None, **kwargs):
         """Get predictions for a set of proteins - no alleles so we override
         the base method for this too. """
 
         recs = sequtils.getCDS(recs)
         if names != None:
             recs = recs[recs.locus_tag.isin(names)]
+        value = self.iedbmethod
+        if self.native == True and value in bcell.methods:
+            #score the whole set of proteins in one pass
+            scale = bcell.get_scales(self.path).get(value)
+            seqs = OrderedDict(zip(recs.locus_tag, recs.translation))
+            self.data = res = bcell.predict_proteins(seqs, scale, value, window)
+            self.thresholds = bcell.thresholds(res, value)
+            if save == True:
+                for name,df in res.groupby('name', sort=False):
+                    df.reset_index(drop=True).to_csv(os.path.join(path, name+'.csv'))
+            return
         proteins = list(recs.iterrows())
         res=[]
+        thresholds = {}
         for i,row in proteins:
             seq = row['translation']
             name = row['locus_tag']
             #print (name)
-            df = self.predict(sequence=seq,name=name)
+            df = self.predict(sequence=seq, name=name, window=window)
             res.append(df)
+            thresholds[name] = self.threshold
             if save == True:
                 #fname = os.path.join(path, name+'.mpk')
                 #pd.to_msgpack(fname, res)
                 fname = os.path.join(path, name+'.csv')
                 df.to_csv(fname)
         self.data = res = pd.concat(res)
+        self.thresholds = pd.Series(thresholds)
         return
 
 class MHCFlurryPredictor(Predictor):
@@ -1299,6 +2700,7 @@ class MHCFlurryPredictor(Predictor):
         self.operator = '<'
         self.scorekey = 'score'
         self.rankascending = 1
+        self.batch_size = 100
         return
 
     def predict(self, sequence=None, peptides=None, length=11, overlap=1,
@@ -1306,8 +2708,7 @@ class MHCFlurryPredictor(Predictor):
         """Uses mhcflurry python classes for prediction"""
 
         self.sequence = sequence
-        from mhcflurry import Class1AffinityPredictor
-        predictor = Class1AffinityPredictor.load()
+        predictor = get_mhcflurry_predictor()
         if peptides == None:
             peptides, s = peptutils.create_fragments(seq=sequence,
                                                     length=length, overlap=overlap)
@@ -1317,6 +2718,30 @@ class MHCFlurryPredictor(Predictor):
         self.data = df
         return df
 
+    def predict_batch(self, seqs, allele='HLA-A0101', length=11, overlap=1, **kwargs):
+        """
+        Fragment all sequences and score the peptides in one call to the
+        model, then split the results back per sequence.
+        """
+
+        predictor = get_mhcflurry_predictor()
+        peptides = []
+        names = []
+        for name in seqs:
+            frags, s = peptutils.create_fragments(seq=seqs[name], length=length,
+                                                  overlap=overlap)
+            peptides.extend(frags)
+            names.extend([name]*len(frags))
+        res = OrderedDict()
+        if len(peptides) == 0:
+            return res
+        df = predictor.predict_to_dataframe(peptides=peptides, allele=allele)
+        df['name'] = names
+        for name,g in df.groupby('name', sort=False):
+            g = g.drop('name', axis=1).reset_index(drop=True)
+            res[name] = self.prepareData(g, name, allele)
+        return res
+
     def prepareData(self, df, name, allele):
         """Post process dataframe to alter some column names"""
 
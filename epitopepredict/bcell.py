@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""
+    Native implementation of the IEDB B-cell propensity scale methods
+    Created October 2026
+    Copyright (C) Damien Farrell
+"""
+
+from __future__ import absolute_import, print_function
+import os, pickle
+import numpy as np
+import pandas as pd
+from .peptutils import AAletters, encode
+
+#methods scored natively, Bepipred is left to the IEDB code
+methods = ['Chou-Fasman', 'Emini', 'Karplus-Schulz', 'Kolaskar-Tongaonkar', 'Parker']
+#default window sizes used by the IEDB tools
+windows = {'Chou-Fasman': 7, 'Emini': 6, 'Karplus-Schulz': 7,
+           'Kolaskar-Tongaonkar': 7, 'Parker': 7}
+#Karplus-Schulz normalized B values of residues with 0, 1 or 2 rigid neighbours
+karplus_schulz = [
+    {'A': 1.041, 'C': 0.960, 'D': 1.033, 'E': 1.094, 'F': 0.930, 'G': 1.142,
+     'H': 0.982, 'I': 1.002, 'K': 1.093, 'L': 0.967, 'M': 0.947, 'N': 1.117,
+     'P': 1.055, 'Q': 1.165, 'R': 1.038, 'S': 1.169, 'T': 1.073, 'V': 0.982,
+     'W': 0.925, 'Y': 0.961},
+    {'A': 0.946, 'C': 0.878, 'D': 1.089, 'E': 1.036, 'F': 0.912, 'G': 1.042,
+     'H': 0.952, 'I': 0.892, 'K': 1.082, 'L': 0.961, 'M': 0.862, 'N': 1.006,
+     'P': 1.085, 'Q': 1.025, 'R': 1.028, 'S': 1.048, 'T': 1.051, 'V': 0.927,
+     'W': 0.917, 'Y': 0.930},
+    {'A': 0.892, 'C': 0.925, 'D': 0.932, 'E': 0.933, 'F': 0.914, 'G': 0.923,
+     'H': 0.894, 'I': 0.872, 'K': 1.057, 'L': 0.921, 'M': 0.804, 'N': 0.930,
+     'P': 0.932, 'Q': 0.885, 'R': 0.901, 'S': 0.923, 'T': 0.934, 'V': 0.913,
+     'W': 0.803, 'Y': 0.837}]
+rigid = ['A', 'L', 'H', 'V', 'Y', 'I', 'F', 'C', 'W', 'M']
+#scale tables already loaded, keyed by file name
+scales = {}
+
+def get_scales(path):
+    """Load the IEDB bcell_scales.pickle file in path, once per process"""
+
+    filepath = os.path.join(path, 'bcell_scales.pickle')
+    if filepath not in scales:
+        with open(filepath, 'rb') as f:
+            try:
+                scales[filepath] = pickle.load(f, encoding='latin1')
+            except TypeError:
+                scales[filepath] = pickle.load(f)
+    return scales[filepath]
+
+def scale_array(scale):
+    """Convert a scale dict to an array indexed like encode, unknown residues
+       and residues missing from the scale are nan"""
+
+    vals = np.full(21, np.nan)
+    for i,a in enumerate(AAletters):
+        if a in scale:
+            vals[i] = float(scale[a])
+    return vals
+
+def residue_values(x, scale, method='Parker', starts=None):
+    """
+    Scale value of each residue of an encoded sequence.
+    Args:
+        x: encoded sequence from encode
+        scale: dict of amino acid scale values, not used for Karplus-Schulz
+        method: Karplus-Schulz picks one of the karplus_schulz scales by the
+        number of rigid neighbours, all others use the scale
+        starts: positions in x where proteins start, neighbours are not
+        counted across these
+    Returns:
+        array of len(x) values
+    """
+
+    if method != 'Karplus-Schulz':
+        return scale_array(scale)[x]
+    r = np.isin(x, encode(''.join(rigid)))
+    #rigid neighbours of each residue within its protein
+    prev = np.concatenate([[False], r[:-1]])
+    nxt = np.concatenate([r[1:], [False]])
+    if starts is not None:
+        starts = np.asarray(starts, dtype=int)
+        prev[starts[starts<len(x)]] = False
+        nxt[starts[(starts>0) & (starts<=len(x))]-1] = False
+    n = prev.astype(int) + nxt
+    b0, b1, b2 = [scale_array(b)[x] for b in karplus_schulz]
+    return np.where(n == 0, b0, np.where(n == 1, b1, b2))
+
+def window_scores(v, window, method='Parker'):
+    """
+    Window scores of residue values using running sums.
+    Args:
+        v: residue values from residue_values
+        window: window size
+        method: Emini uses the product of the window values, all others the mean
+    Returns:
+        array of len(v)-window+1 scores, one per window start
+    """
+
+    if len(v) < window:
+        return np.array([])
+    if method == 'Emini':
+        v = np.log(v)
+    c = np.concatenate([[0], np.cumsum(v)])
+    s = c[window:] - c[:-window]
+    if method == 'Emini':
+        return np.exp(s) * 0.37**-window
+    return s/window
+
+def predict(sequence, scale, method='Parker', window=None, name=None):
+    """
+    Score a protein sequence with a propensity scale.
+    Args:
+        sequence: protein sequence
+        scale: dict of amino acid scale values for the method, the built in
+        karplus_schulz scales are used for Karplus-Schulz
+        method: one of methods
+        window: window size, uses the IEDB default if None
+    Returns:
+        a dataframe with the same columns as the IEDB tool output
+    """
+
+    return predict_proteins({name: sequence}, scale, method, window)
+
+def predict_proteins(seqs, scale, method='Parker', window=None):
+    """
+    Score many proteins at once. The sequences are encoded into a single
+    buffer and windows crossing protein boundaries are dropped.
+    Args:
+        seqs: dict of name/sequence pairs
+    Returns:
+        a dataframe of all results with a name column
+    """
+
+    if window is None:
+        window = windows[method]
+    window = int(window)
+    center = int(round(window/2.0))
+    names = list(seqs)
+    lengths = np.array([len(seqs[n]) for n in names], dtype=int)
+    buf = ''.join([seqs[n] for n in names])
+    x = encode(buf)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    v = residue_values(x, scale, method, offsets[1:-1])
+    scores = window_scores(v, window, method)
+    #window starts within each protein
+    counts = np.clip(lengths-window+1, 0, None)
+    prot = np.repeat(np.arange(len(names)), counts)
+    start = np.arange(counts.sum()) - np.repeat(np.cumsum(counts)-counts, counts)
+    gstart = offsets[prot] + start
+    df = pd.DataFrame({'Position': start+center,
+                       'Residue': [buf[i+center-1] for i in gstart],
+                       'Start': start+1,
+                       'End': start+window,
+                       'Peptide': [buf[i:i+window] for i in gstart],
+                       'Score': np.round(scores[gstart], 3)},
+                       columns=['Position','Residue','Start','End','Peptide','Score'])
+    df['name'] = np.array(names, dtype=object)[prot]
+    return df
+
+def thresholds(df, method='Parker'):
+    """
+    Default IEDB thresholds for each protein in a set of results, the mean
+    score of the protein or 1.0 for Emini.
+    Returns: pandas series indexed by name
+    """
+
+    if method == 'Emini':
+        return pd.Series(1.0, index=df.name.unique())
+    return df.groupby('name', sort=False).Score.mean().round(3)
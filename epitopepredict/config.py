@@ -42,6 +42,7 @@ baseoptions = {'base': [('predictors', 'tepitope'),
                 ('cutoff',4), #percentile cutoff
                 ('sequence_file', ''), #genbank/fasta file
                 ('path', 'results'),
+                ('format', 'csv'), #csv, parquet or sqlite
                 ('overwrite', 'no'),
                 ('verbose','no'),
                 ('names', ''), #subset of protein names from genome file
@@ -6,11 +6,11 @@
     Copyright (C) Damien Farrell
 """
 
-import os, random, csv
+import os, csv
+import numpy as np
+import pandas as pd
 from Bio import SeqIO
 from Bio.SeqRecord import SeqRecord
-from Bio.SeqUtils.ProtParam import ProteinAnalysis
-from Bio.Alphabet import IUPAC
 from . import utilities
 
 AAletters = ['A', 'C', 'E', 'D', 'G', 'F', 'I', 'H', 'K', 'M', 'L', 'N', 'Q', 'P',\
@@ -20,16 +20,69 @@ AAcodes3 ={'V':'VAL', 'I':'ILE', 'L':'LEU', 'E':'GLU', 'Q':'GLN', \
 'R':'ARG', 'K':'LYS', 'S':'SER', 'T':'THR', 'M':'MET', 'A':'ALA', \
 'G':'GLY', 'P':'PRO', 'C':'CYS'}
 
-def create_random_sequences(size=100,length=9):
-    """Create library of all possible peptides given length"""
-    aa = list(IUPAC.IUPACProtein.letters)
-    vals=[]
-    for i in range(0, size):
-        seq = ""
-        for s in range(0,length):
-            index = random.randint(0, len(aa)-1)
-            seq += aa[index]
-        vals.append(seq)
+def aa_frequencies(seqs=None):
+    """
+    Amino acid frequencies in the order of AAletters, estimated from a
+    list of sequences (e.g. a proteome) or uniform if none given.
+    """
+
+    if seqs is None:
+        return np.ones(len(AAletters))/len(AAletters)
+    x = encode(''.join(seqs))
+    counts = np.bincount(x, minlength=len(AAletters)+1)[:len(AAletters)]
+    return counts/float(counts.sum())
+
+def encode(seq):
+    """Encode a sequence as uint8 indexes into AAletters, unknown residues
+       are given the value len(AAletters)"""
+
+    lookup = np.full(256, len(AAletters), dtype=np.uint8)
+    for i,a in enumerate(AAletters):
+        lookup[ord(a)] = i
+    x = np.frombuffer(seq.upper().encode('ascii', 'replace'), dtype=np.uint8)
+    return lookup[x]
+
+def decode(arr):
+    """Convert a 2d array of encoded peptides to a list of strings"""
+
+    arr = np.asarray(arr)
+    letters = np.frombuffer(''.join(AAletters).encode('ascii'), dtype=np.uint8)
+    x = np.ascontiguousarray(letters[arr])
+    x = x.view('S%s' %arr.shape[1]).ravel()
+    return [i.decode('ascii') for i in x]
+
+def random_peptide_arrays(size=1000, length=9, freqs=None, seed=None, chunksize=1000000):
+    """
+    Generate random encoded peptides in chunks of bounded memory.
+    Args:
+        size: total number of peptides
+        length: peptide length
+        freqs: amino acid frequencies in the order of AAletters, see
+            aa_frequencies, uniform if None
+        seed: random seed
+        chunksize: max peptides per chunk
+    Returns:
+        generator of (n x length) uint8 arrays, use decode to get strings
+    """
+
+    rng = np.random.RandomState(seed)
+    if freqs is None:
+        freqs = aa_frequencies()
+    freqs = np.asarray(freqs, dtype=float)
+    cdf = np.cumsum(freqs/freqs.sum())
+    while size > 0:
+        n = min(size, chunksize)
+        x = np.searchsorted(cdf, rng.random_sample((n, length)), side='right')
+        yield np.minimum(x, len(AAletters)-1).astype(np.uint8)
+        size -= n
+
+def create_random_sequences(size=100, length=9, freqs=None, seed=None):
+    """Create library of random sequences of given length, see
+       random_peptide_arrays for drawing large numbers in bulk"""
+
+    vals = []
+    for x in random_peptide_arrays(size, length, freqs=freqs, seed=seed):
+        vals.extend(decode(x))
     return vals
 
 def create_random_peptides(size=100,length=9):
@@ -112,34 +165,205 @@ def get_AAsubstitutions(template):
         matrix.append(x)
     return seqs, matrix
 
-def get_AAfraction(seq, amino_acids=None):
-    """Get fraction of give amino acids in a sequence"""
+#non-polar residues used for the hydrophobic fraction
+nonpolar = ['A','V','L','F','I','W','P']
+
+def aa_counts(seqs):
+    """
+    Count the amino acids of many sequences at once by encoding them into
+    a single buffer.
+    Args:
+        seqs: list of sequences
+    Returns:
+        (n x 20) array of counts in the order of AAletters, other residues
+        are not counted
+    """
+
+    lengths = np.array([len(s) for s in seqs], dtype=int)
+    x = encode(''.join(seqs)).astype(int)
+    row = np.repeat(np.arange(len(lengths)), lengths)
+    counts = np.bincount(row*21+x, minlength=len(lengths)*21).reshape(-1,21)
+    return counts[:,:20]
+
+def _columns(counts, amino_acids):
+    """Sum of count columns for the given amino acids"""
+    return counts[:,[AAletters.index(a) for a in amino_acids]].sum(1)
+
+def aa_fractions(seqs, amino_acids=None, counts=None):
+    """Fraction of given amino acids in each sequence, rounded to 2 places"""
 
-    X = ProteinAnalysis(seq)
-    #h = X.protein_scale(ProtParam.ProtParamData.kd, len(seq), 0.4)
-    nonpolar = ['A','V','L','F','I','W','P']
     if amino_acids == None:
         amino_acids = nonpolar
-    count=0
-    for aa, i in X.count_amino_acids().iteritems():
-        if aa in amino_acids:
-            count+=i
-    if count == 0: return 0
-    frac = round(float(count)/len(seq),2)
-    return frac
+    if counts is None:
+        counts = aa_counts(seqs)
+    lengths = np.array([len(s) for s in seqs], dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.round(_columns(counts, amino_acids)/lengths, 2)
+
+def net_charges(seqs, counts=None):
+    """Net charge of each sequence from K/R and D/E counts"""
+
+    if counts is None:
+        counts = aa_counts(seqs)
+    return _columns(counts, ['K','R']) - _columns(counts, ['D','E'])
+
+def isoelectric_points(seqs, counts=None):
+    """
+    Isoelectric points of many sequences using the Bjellqvist pK values
+    and terminal corrections from Biopython. The bisection is done on all
+    sequences together and gives the same values as ProteinAnalysis.
+    Args:
+        seqs: list of sequences
+        counts: counts from aa_counts if already calculated
+    Returns:
+        array of pI values
+    """
+
+    from Bio.SeqUtils import IsoelectricPoint as IP
+    if counts is None:
+        counts = aa_counts(seqs)
+    n = len(seqs)
+    #pK values of the terminal residues
+    nterm = np.array([IP.pKnterminal.get(s[:1].upper(), IP.positive_pKs['Nterm'])
+                      for s in seqs], dtype=float)
+    cterm = np.array([IP.pKcterminal.get(s[-1:].upper(), IP.negative_pKs['Cterm'])
+                      for s in seqs], dtype=float)
+
+    def charge(pH):
+        pos = 1.0/(10**(pH-nterm)+1.0)
+        for aa in ['K','R','H']:
+            pos = pos + counts[:,AAletters.index(aa)]/(10**(pH-IP.positive_pKs[aa])+1.0)
+        neg = 1.0/(10**(cterm-pH)+1.0)
+        for aa in ['D','E','C','Y']:
+            neg = neg + counts[:,AAletters.index(aa)]/(10**(IP.negative_pKs[aa]-pH)+1.0)
+        return pos - neg
+
+    pH = np.full(n, 7.775)
+    lo = np.full(n, 4.05)
+    hi = np.full(n, 12.0)
+    while True:
+        m = hi-lo > 0.0001
+        if not m.any():
+            break
+        pos = charge(pH) > 0
+        lo = np.where(m & pos, pH, lo)
+        hi = np.where(m & ~pos, pH, hi)
+        pH = np.where(m, (lo+hi)/2, pH)
+    return pH
+
+def peptide_features(seqs, amino_acids=None):
+    """
+    Physicochemical features of many peptides in one pass over their
+    amino acid counts. Residues outside AAletters are ignored except in
+    the length.
+    Args:
+        seqs: list of sequences
+        amino_acids: residues used for the hydrophobic fraction, default
+            is nonpolar
+    Returns:
+        dataframe with length, hydro, net_charge, gravy, mw and pI columns
+    """
+
+    from Bio.SeqUtils import ProtParamData
+    from Bio.Data import IUPACData
+    seqs = [str(s) for s in seqs]
+    counts = aa_counts(seqs)
+    lengths = np.array([len(s) for s in seqs], dtype=int)
+    kd = np.array([ProtParamData.kd[a] for a in AAletters])
+    weights = np.array([IUPACData.protein_weights[a] for a in AAletters])
+    water = 18.0153
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gravy = counts.dot(kd)/lengths
+    df = pd.DataFrame({'length': lengths,
+                       'hydro': aa_fractions(seqs, amino_acids, counts),
+                       'net_charge': net_charges(seqs, counts),
+                       'gravy': gravy,
+                       'mw': counts.dot(weights) - (lengths-1)*water,
+                       'pI': isoelectric_points(seqs, counts)},
+                       columns=['length','hydro','net_charge','gravy','mw','pI'])
+    return df
+
+def get_AAfraction(seq, amino_acids=None):
+    """Get fraction of give amino acids in a sequence"""
+
+    return aa_fractions([seq], amino_acids)[0]
 
 def net_charge(seq):
     """Get net charge of a peptide sequence"""
 
-    X = ProteinAnalysis(seq)
-    ac = 0
-    ba = 0
-    for aa, i in X.count_amino_acids().iteritems():
-        if aa in ['D','E']:
-            ac -= i
-        elif aa in ['K','R']:
-            ba += i
-    return ac + ba
+    return net_charges([seq])[0]
+
+class Matcher(object):
+    """
+    Aho-Corasick automaton over a set of peptides so that all of them can be
+    found in a sequence with a single pass over it.
+    Args:
+        patterns: list of peptides, ids are their positions in the list
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.lengths = [len(p) for p in self.patterns]
+        goto = [{}]
+        out = [[]]
+        for i,p in enumerate(self.patterns):
+            node = 0
+            for c in p:
+                if c not in goto[node]:
+                    goto.append({})
+                    out.append([])
+                    goto[node][c] = len(goto)-1
+                node = goto[node][c]
+            out[node].append(i)
+        #failure links found breadth first
+        fail = [0]*len(goto)
+        queue = list(goto[0].values())
+        for node in queue:
+            for c,child in goto[node].items():
+                f = fail[node]
+                while f and c not in goto[f]:
+                    f = fail[f]
+                fail[child] = goto[f].get(c, 0)
+                out[child] = out[child] + out[fail[child]]
+                queue.append(child)
+        self.goto = goto
+        self.fail = fail
+        self.out = out
+        return
+
+    def iter(self, text):
+        """Yield (end position, pattern id) of all matches in text"""
+
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        node = 0
+        for i,c in enumerate(text):
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            for j in out[node]:
+                yield i, j
+
+    def found(self, text):
+        """Set of ids of patterns found in text"""
+
+        ids = set(j for i,j in self.iter(text))
+        ids.update([j for j,l in enumerate(self.lengths) if l == 0])
+        return ids
+
+    def first(self, text):
+        """Start of the first match of each pattern in text or -1, the same
+           as text.find for each pattern"""
+
+        pos = np.full(len(self.patterns), -1, dtype=int)
+        for j,l in enumerate(self.lengths):
+            if l == 0:
+                pos[j] = 0
+        for i,j in self.iter(text):
+            if pos[j] == -1:
+                pos[j] = i - self.lengths[j] + 1
+        return pos
 
 def main():
     from optparse import OptionParser
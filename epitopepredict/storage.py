@@ -0,0 +1,1269 @@
+#!/usr/bin/env python
+
+"""
+    epitopepredict, methods for storing and loading prediction results
+    Created October 2026
+    Copyright (C) Damien Farrell
+"""
+
+from __future__ import absolute_import, print_function
+import os, glob, io, json
+import numpy as np
+import pandas as pd
+
+#columns used to partition datasets
+partition_cols = ['predictor','allele']
+
+def require_pyarrow():
+    """Import pyarrow, raising an ImportError explaining how to install it
+       if missing. Needed for the parquet, arrow and feather formats."""
+
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('pyarrow is required for this format, install it with '
+                          'pip install pyarrow or pip install epitopepredict[parquet]')
+    return pyarrow
+
+def is_dataset(path):
+    """Check if path is a partitioned columnar dataset"""
+
+    if path is None or not os.path.isdir(path):
+        return False
+    return len(glob.glob(os.path.join(path, 'predictor=*'))) > 0
+
+def save_dataset(df, path, predictor, compression='snappy'):
+    """
+    Append prediction results to a parquet dataset partitioned by predictor
+    and allele. Rows are sorted by name and position so that row group
+    statistics can be used to skip data when loading. Requires pyarrow.
+    Args:
+        df: dataframe of predictions
+        path: root folder of the dataset
+        predictor: name of the predictor
+        compression: parquet compression codec
+    """
+
+    pa = require_pyarrow()
+    import pyarrow.parquet as pq
+    if df is None or len(df) == 0:
+        return
+    df = df.sort_values(['name','pos']).reset_index(drop=True)
+    df['predictor'] = predictor
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_to_dataset(table, path, partition_cols=partition_cols,
+                        compression=compression)
+    return
+
+def delete_dataset(path, predictor, names=None):
+    """
+    Remove the results of a predictor from a partitioned dataset. With names
+    only the rows of those proteins are removed, files holding other
+    proteins are rewritten without them.
+    Args:
+        path: root folder of the dataset
+        predictor: name of the predictor
+        names: protein names to remove, all results if None
+    """
+
+    import shutil
+    ppath = os.path.join(path, 'predictor=%s' %predictor)
+    if not os.path.exists(ppath):
+        return
+    if names is None:
+        shutil.rmtree(ppath)
+        return
+    pa = require_pyarrow()
+    import pyarrow.parquet as pq
+    import pyarrow.compute as pc
+    names = pa.array(list(names), type=pa.string())
+    files = glob.glob(os.path.join(ppath, '*', '*.parquet'))
+    for f in files:
+        table = pq.read_table(f)
+        mask = pc.is_in(table['name'].cast(pa.string()), value_set=names)
+        n = pc.sum(mask).as_py() or 0
+        if n == 0:
+            continue
+        if n == len(table):
+            os.remove(f)
+        else:
+            pq.write_table(table.filter(pc.invert(mask)), f)
+    return
+
+def get_filter(predictor=None, names=None, alleles=None, filters=None):
+    """
+    Build a pyarrow dataset filter expression.
+    Args:
+        names: list of protein names
+        alleles: list of alleles
+        filters: list of (column, operator, value) tuples combined with and,
+            e.g. [('score','>',2)]
+    """
+
+    require_pyarrow()
+    import pyarrow.dataset as ds
+    import operator as op
+    ops = {'<':op.lt, '<=':op.le, '>':op.gt, '>=':op.ge, '==':op.eq, '!=':op.ne}
+    expr = []
+    if predictor is not None:
+        expr.append(ds.field('predictor') == predictor)
+    if names is not None:
+        expr.append(ds.field('name').isin(list(names)))
+    if alleles is not None:
+        expr.append(ds.field('allele').isin(list(alleles)))
+    if filters is not None:
+        for col, o, val in filters:
+            if o == 'in':
+                expr.append(ds.field(col).isin(list(val)))
+            else:
+                expr.append(ops[o](ds.field(col), val))
+    if len(expr) == 0:
+        return
+    f = expr[0]
+    for e in expr[1:]:
+        f = f & e
+    return f
+
+def load_dataset(path, predictor=None, names=None, alleles=None, filters=None,
+                 columns=None):
+    """
+    Load predictions from a partitioned dataset. Predicates are pushed down
+    into the reader so only matching partitions and row groups are read.
+    Args:
+        path: root folder of the dataset
+        predictor: name of the predictor
+        names: protein names to load
+        alleles: alleles to load
+        filters: list of (column, operator, value) tuples, see get_filter
+        columns: columns to load, all if None
+    Returns:
+        a pandas dataframe
+    """
+
+    require_pyarrow()
+    import pyarrow.dataset as ds
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    f = get_filter(predictor, names, alleles, filters)
+    if columns is not None:
+        columns = [c for c in columns if c not in partition_cols] + ['allele']
+    table = dataset.to_table(filter=f, columns=columns)
+    df = table.to_pandas()
+    if 'predictor' in df.columns:
+        df = df.drop('predictor', axis=1)
+    if 'allele' in df.columns:
+        df['allele'] = df.allele.astype(str)
+    return df
+
+def dataset_names(path, predictor=None):
+    """Get protein names stored in a dataset"""
+
+    if not is_dataset(path):
+        return []
+    df = load_dataset(path, predictor, columns=['name'])
+    return sorted(df.name.unique())
+
+def dataset_units(path, predictor=None):
+    """(name, allele) pairs stored in a dataset"""
+
+    if not is_dataset(path):
+        return set()
+    df = load_dataset(path, predictor, columns=['name'])
+    return set(zip(df.name, df.allele))
+
+#dtypes of the common columns in csv results
+csv_dtypes = {'peptide':object, 'core':object, 'name':object, 'allele':object,
+              'pos':'int64', 'score':'float64', 'rank':'float64',
+              'perc_rank':'float64', 'ic50':'float64'}
+
+def read_csv(filename, compression='infer'):
+    """Read a csv results file with explicit dtypes, the saved index column
+       is skipped rather than parsed"""
+
+    usecols = lambda c: not c.startswith('Unnamed')
+    return pd.read_csv(filename, usecols=usecols, dtype=csv_dtypes,
+                       compression=compression)
+
+def get_csv_files(path, names=None, file_limit=None):
+    """Csv result files in a folder, optionally only those for names"""
+
+    files = sorted(glob.glob(os.path.join(path, '*.csv')))
+    if names is not None:
+        names = set([n+'.csv' for n in names])
+        files = [f for f in files if os.path.basename(f) in names]
+    if file_limit != None:
+        files = files[:file_limit]
+    return files
+
+def csv_length(files):
+    """Peptide length of the first non-empty csv results file, or None"""
+
+    for f in files:
+        df = pd.read_csv(f, nrows=1, usecols=lambda c: c == 'peptide')
+        if len(df) > 0 and 'peptide' in df.columns:
+            return len(str(df.peptide.iloc[0]))
+    return
+
+def cache_file(path):
+    """Name of the consolidated cache file for a folder of csv files"""
+
+    return os.path.normpath(path)+'.cache.feather'
+
+def file_list(files):
+    """Name, size and modification time of files, used to check a cache"""
+
+    return [[os.path.basename(f), os.path.getsize(f), os.path.getmtime(f)] for f in files]
+
+def read_cache(cfile, files):
+    """
+    Read a csv folder cache saved with write_cache if it was made from the
+    same files, i.e. none have been added, removed or changed.
+    Returns:
+        a dataframe or None if there is no valid cache
+    """
+
+    import json
+    import pyarrow as pa
+    if not os.path.exists(cfile):
+        return
+    try:
+        with pa.memory_map(cfile) as source:
+            reader = pa.ipc.open_file(source)
+            meta = reader.schema.metadata or {}
+            if json.loads(meta.get(b'files', b'null').decode()) != file_list(files):
+                return
+            data = reader.read_all().to_pandas()
+    except (pa.ArrowInvalid, IOError, ValueError):
+        return
+    for c in data.columns:
+        if csv_dtypes.get(c) is object:
+            data[c] = data[c].astype(object)
+    return data
+
+def write_cache(data, cfile, files):
+    """Save a dataframe as an Arrow IPC (feather) file with the list of files
+       it was made from in the schema"""
+
+    import json
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    meta = dict(table.schema.metadata or {})
+    meta[b'files'] = json.dumps(file_list(files)).encode()
+    table = table.replace_schema_metadata(meta)
+    #write to a temporary file first so a failed write leaves no partial cache
+    tmp = cfile+'.tmp'
+    feather.write_feather(table, tmp, compression='uncompressed')
+    os.replace(tmp, cfile)
+    return
+
+def load_csv_folder(path, names=None, file_limit=None, compression='infer',
+                    scorekey=None, threads=None, cache=False):
+    """
+    Load a folder of csv result files using a thread pool and concatenate.
+    Args:
+        path: folder with one csv file per protein
+        names: protein names to load, all if None
+        file_limit: only load this number of files
+        scorekey: skip files without this column
+        threads: number of threads, defaults to the cpu count
+        cache: keep a consolidated copy of the whole folder next to it,
+        this is re-used until any csv files are added, removed or changed.
+        Requires pyarrow, otherwise no cache is used
+    Returns:
+        a dataframe or None if no results were found
+    """
+
+    from multiprocessing.pool import ThreadPool
+    files = get_csv_files(path, names, file_limit)
+    if len(files) == 0:
+        return
+    usecache = cache == True and names is None and file_limit is None
+    if usecache == True:
+        try:
+            import pyarrow
+        except ImportError:
+            print ('pyarrow is needed to cache results, not using a cache')
+            usecache = False
+    if usecache == True:
+        cfile = cache_file(path)
+        data = read_cache(cfile, files)
+        if data is not None:
+            return data
+    if threads is None:
+        import multiprocessing as mp
+        threads = mp.cpu_count()
+    threads = max(1, min(threads, len(files)))
+    def read(f):
+        return read_csv(f, compression)
+    pool = ThreadPool(threads)
+    res = pool.map(read, files)
+    pool.close()
+    pool.join()
+    res = [df for df in res if len(df) > 0]
+    if scorekey is not None:
+        res = [df for df in res if scorekey in df.columns]
+    if len(res) == 0:
+        return
+    data = pd.concat(res, ignore_index=True)
+    if usecache == True:
+        write_cache(data, cfile, files)
+    return data
+
+#name of the sqlite results database in a results folder
+database_file = 'predictions.sqlite'
+
+def is_database(path):
+    """Check if path is a folder with a results database"""
+
+    if path is None or not os.path.isdir(path):
+        return False
+    return os.path.exists(os.path.join(path, database_file))
+
+class ResultDB(object):
+    """
+    Indexed sqlite store of predictions with one table per predictor.
+    Tables are indexed on allele/rank, allele/score and name/pos so that
+    threshold queries over all proteins and position ranges in one protein
+    don't scan the whole table.
+    """
+
+    ops = ['<','<=','>','>=','=','==','!=','in']
+
+    def __init__(self, path):
+        import sqlite3
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.filename = os.path.join(path, database_file)
+        self.db = sqlite3.connect(self.filename, timeout=60)
+        return
+
+    def tables(self):
+        cur = self.db.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        return [r[0] for r in cur.fetchall()]
+
+    def columns(self, predictor):
+        cur = self.db.execute('PRAGMA table_info("%s")' %predictor)
+        return [r[1] for r in cur.fetchall()]
+
+    def save(self, df, predictor):
+        """Append predictions to the table for predictor"""
+
+        if df is None or len(df) == 0:
+            return
+        cols = self.columns(predictor)
+        if len(cols) > 0:
+            for c in df.columns:
+                if c not in cols:
+                    self.db.execute('ALTER TABLE "%s" ADD COLUMN "%s"' %(predictor, c))
+        df.to_sql(predictor, self.db, if_exists='append', index=False)
+        if len(cols) == 0:
+            self.create_index(predictor)
+        self.db.commit()
+        return
+
+    def create_index(self, predictor):
+        cols = self.columns(predictor)
+        for idx in [('name','pos'), ('allele','rank'), ('allele','score')]:
+            if not set(idx).issubset(cols):
+                continue
+            self.db.execute('CREATE INDEX IF NOT EXISTS "%s_%s" ON "%s" (%s)'
+                            %(predictor, '_'.join(idx), predictor,
+                              ','.join(['"%s"' %c for c in idx])))
+        return
+
+    def delete(self, predictor, names=None):
+        """Remove results for a predictor, or only those for names"""
+
+        if predictor not in self.tables():
+            return
+        if names is None:
+            self.db.execute('DROP TABLE "%s"' %predictor)
+        else:
+            names = list(names)
+            self.db.execute('DELETE FROM "%s" WHERE name IN (%s)'
+                            %(predictor, ','.join('?'*len(names))), names)
+        self.db.commit()
+        return
+
+    def names(self, predictor):
+        if predictor not in self.tables():
+            return []
+        cur = self.db.execute('SELECT DISTINCT name FROM "%s"' %predictor)
+        return sorted([r[0] for r in cur.fetchall()])
+
+    def units(self, predictor):
+        """(name, allele) pairs stored for a predictor"""
+
+        if predictor not in self.tables():
+            return set()
+        cur = self.db.execute('SELECT DISTINCT name, allele FROM "%s"' %predictor)
+        return set(cur.fetchall())
+
+    def query(self, predictor, names=None, alleles=None, start=None, end=None,
+              filters=None, columns=None):
+        """
+        Get predictions as a dataframe.
+        Args:
+            names: protein names
+            alleles: alleles
+            start, end: range of peptide positions to return
+            filters: list of (column, operator, value) tuples combined with
+            and, e.g. [('rank','<',10)]
+            columns: columns to return, all if None
+        """
+
+        if predictor not in self.tables():
+            return pd.DataFrame()
+        cols = self.columns(predictor)
+        where = []
+        params = []
+        filters = list(filters or [])
+        if names is not None:
+            filters.append(('name','in',names))
+        if alleles is not None:
+            filters.append(('allele','in',alleles))
+        if start is not None:
+            filters.append(('pos','>=',start))
+        if end is not None:
+            filters.append(('pos','<=',end))
+        for col, o, val in filters:
+            if col not in cols or o not in self.ops:
+                raise ValueError('invalid filter %s %s' %(col, o))
+            if o == 'in':
+                val = list(val)
+                where.append('"%s" IN (%s)' %(col, ','.join('?'*len(val))))
+                params.extend(val)
+            else:
+                where.append('"%s" %s ?' %(col, o))
+                params.append(val)
+        if columns is None:
+            sel = '*'
+        else:
+            sel = ','.join(['"%s"' %c for c in columns if c in cols])
+        sql = 'SELECT %s FROM "%s"' %(sel, predictor)
+        if len(where) > 0:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return pd.read_sql(sql, self.db, params=params)
+
+    def close(self):
+        self.db.close()
+        return
+
+def sequence_from_peptides(df):
+    """Derive a protein sequence from a set of overlapping peptides"""
+
+    df = df.drop_duplicates('pos').sort_values('pos')
+    x = ''.join(df.peptide.str[0])
+    return x + df.iloc[-1].peptide[1:]
+
+def save_tracks(df, path, sequences=None, predictor='', scorekey='score',
+                dtype='float32'):
+    """
+    Save fixed length, overlap 1 predictions as dense float32 score tracks,
+    one per protein/allele, in a single binary file that can be memory
+    mapped. An index of track offsets and the protein sequences are stored
+    alongside so that peptides can be recovered, see ScoreTracks.
+    Args:
+        df: dataframe of predictions, may be compacted with base.compact_data
+        path: folder to save to, existing tracks are replaced
+        sequences: dict of protein sequences keyed by name, derived from
+            the peptides if not given. Needed for compacted data
+        predictor: name of the predictor
+        scorekey: score column to store
+        dtype: float32 by default, use float64 to keep scores exactly
+    """
+
+    import json
+    if not os.path.exists(path):
+        os.makedirs(path)
+    compacted = 'peptide' not in df.columns
+    if compacted == True:
+        length = int(df.length.max())
+    else:
+        length = int(df.peptide.str.len().max())
+    if df.duplicated(['name','allele','pos']).any():
+        print ('tracks need one prediction per position, not saved')
+        return
+    if sequences is None:
+        sequences = {}
+    idx = []
+    seqs = []
+    seqoffset = 0
+    offset = 0
+    with open(os.path.join(path, 'scores.bin'), 'wb') as f:
+        for name,g in df.groupby('name', sort=True):
+            if len(g) == 0:
+                continue
+            if name in sequences:
+                seq = sequences[name]
+            elif compacted == True:
+                raise ValueError('sequence of %s is needed for compacted data' %name)
+            else:
+                seq = sequence_from_peptides(g)
+            seqs.append(seq)
+            n = max(len(seq)-length+1, 0)
+            for a,ga in g.groupby('allele', sort=True):
+                if len(ga) == 0:
+                    continue
+                track = np.full(n, np.nan, dtype=dtype)
+                track[ga.pos.values.astype(int)] = ga[scorekey].values
+                track.tofile(f)
+                idx.append([name, a, offset, n, seqoffset, len(seq)])
+                offset += n
+            seqoffset += len(seq)
+    with open(os.path.join(path, 'sequences.txt'), 'w') as f:
+        f.write(''.join(seqs))
+    idx = pd.DataFrame(idx, columns=['name','allele','offset','size',
+                                     'seqoffset','seqlength'])
+    idx.to_csv(os.path.join(path, 'index.csv'), index=False)
+    meta = {'predictor': predictor, 'length': length, 'scorekey': scorekey,
+            'dtype': dtype}
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return
+
+class ScoreTracks(object):
+    """
+    Read-only access to score tracks saved with save_tracks. Scores and
+    sequences are memory mapped so opening is instant and each track is a
+    zero-copy view found by a dict lookup.
+    """
+
+    def __init__(self, path):
+        import json
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.length = self.meta['length']
+        self.scorekey = self.meta['scorekey']
+        self.index = pd.read_csv(os.path.join(path, 'index.csv'),
+                                 dtype={'name':str, 'allele':str})
+        self.tracks = {}
+        self.seqs = {}
+        for r in self.index.itertuples():
+            self.tracks[(r.name, r.allele)] = (r.offset, r.size)
+            self.seqs[r.name] = (r.seqoffset, r.seqlength)
+        dtype = self.meta.get('dtype', 'float32')
+        fname = os.path.join(path, 'scores.bin')
+        if os.path.getsize(fname) > 0:
+            self.scores = np.memmap(fname, dtype=dtype, mode='r')
+        else:
+            self.scores = np.array([], dtype=dtype)
+        fname = os.path.join(path, 'sequences.txt')
+        if os.path.getsize(fname) > 0:
+            self.seqbuffer = np.memmap(fname, dtype='uint8', mode='r')
+        else:
+            self.seqbuffer = np.array([], dtype='uint8')
+        return
+
+    def __repr__(self):
+        return 'score tracks for %s proteins and %s alleles' %(len(self.names()),
+                                                               len(self.alleles()))
+
+    def names(self):
+        return sorted(self.seqs.keys())
+
+    def alleles(self):
+        return sorted(self.index.allele.unique())
+
+    def get_track(self, name, allele):
+        """Scores for one protein/allele indexed by position"""
+
+        offset, size = self.tracks[(name, allele)]
+        return self.scores[offset:offset+size]
+
+    def get_sequence(self, name):
+        offset, size = self.seqs[name]
+        return self.seqbuffer[offset:offset+size].tobytes().decode('ascii')
+
+    def to_dataframe(self, names=None, alleles=None):
+        """
+        Reconstruct prediction dataframe for the given proteins and alleles.
+        Positions with no score are dropped.
+        """
+
+        if names is None:
+            names = self.names()
+        if alleles is None:
+            alleles = self.alleles()
+        l = self.length
+        res = []
+        for name in names:
+            seq = self.get_sequence(name)
+            for a in alleles:
+                if (name, a) not in self.tracks:
+                    continue
+                x = self.get_track(name, a)
+                pos = np.flatnonzero(~np.isnan(x))
+                df = pd.DataFrame({'pos': pos, self.scorekey: x[pos],
+                                   'peptide': [seq[i:i+l] for i in pos]})
+                df['name'] = name
+                df['allele'] = a
+                res.append(df)
+        if len(res) == 0:
+            return pd.DataFrame()
+        return pd.concat(res).reset_index(drop=True)
+
+class CSVSink(object):
+    """Write each protein's predictions to a csv file in path. Files are
+       replaced on the first write for a protein and appended to after
+       that, or always appended to if append is True. A file is rewritten
+       if the rows appended have other columns."""
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.append = append
+        self.written = set()
+        if not os.path.exists(path):
+            os.makedirs(path)
+        return
+
+    def names(self):
+        """Names of proteins already saved"""
+
+        files = glob.glob(os.path.join(self.path, '*.csv'))
+        return [os.path.splitext(os.path.basename(f))[0] for f in files]
+
+    def units(self):
+        """(name, allele) pairs already saved"""
+
+        units = set()
+        for name in self.names():
+            f = os.path.join(self.path, name+'.csv')
+            df = pd.read_csv(f, usecols=lambda c: c == 'allele', dtype=object)
+            if 'allele' in df.columns:
+                units.update([(name, a) for a in df.allele.unique()])
+        return units
+
+    def write(self, df):
+        if len(df) == 0:
+            return
+        name = df.name.iloc[0]
+        filename = os.path.join(self.path, name+'.csv')
+        if (self.append == True or name in self.written) and os.path.exists(filename):
+            cols = pd.read_csv(filename, nrows=0, index_col=0).columns
+            if list(cols) == list(df.columns):
+                df.to_csv(filename, mode='a', header=False)
+            else:
+                #columns differ, e.g. perc_rank added after calibrating, so
+                #the file is rewritten with both sets of columns
+                old = pd.read_csv(filename, index_col=0, dtype=csv_dtypes)
+                pd.concat([old, df]).to_csv(filename)
+        else:
+            df.to_csv(filename)
+        self.written.add(name)
+        return
+
+    def close(self):
+        return
+
+class DatasetSink(object):
+    """Buffer predictions and append them to a partitioned dataset,
+       see save_dataset"""
+
+    def __init__(self, path, predictor, buffer_rows=500000):
+        require_pyarrow()
+        self.path = path
+        self.predictor = predictor
+        self.buffer_rows = buffer_rows
+        self.buffer = []
+        self.rows = 0
+        return
+
+    def write(self, df):
+        self.buffer.append(df)
+        self.rows += len(df)
+        if self.rows >= self.buffer_rows:
+            self.flush()
+        return
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            save_dataset(pd.concat(self.buffer), self.path, self.predictor)
+        self.buffer = []
+        self.rows = 0
+        return
+
+    def close(self):
+        self.flush()
+        return
+
+def sequence_hash(seq):
+    """Hash identifying a protein sequence"""
+
+    import hashlib
+    return hashlib.sha1(seq.encode('ascii', 'replace')).hexdigest()
+
+def output_key(output='all', cutoff=5, cutoff_method='rank'):
+    """Label of the output mode of a run, binders only runs include the
+       cutoff so that they aren't mixed with others"""
+
+    if output == 'all':
+        return 'all'
+    return '%s %s %g' %(output, cutoff_method, float(cutoff))
+
+class RunManifest(object):
+    """
+    Record of the completed units of a prediction run, stored as an sqlite
+    database in the results path. A unit is one protein sequence (by hash)
+    predicted for one allele and peptide length by a predictor version with
+    an output mode, see output_key, so runs can be resumed or extended with
+    new alleles without recomputing. The summary statistics of each unit are
+    saved with it so that those of all saved results can be rebuilt.
+    """
+
+    def __init__(self, path):
+        import sqlite3
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.filename = os.path.join(path, '_manifest.sqlite')
+        self.db = sqlite3.connect(self.filename, timeout=60)
+        self.db.execute('CREATE TABLE IF NOT EXISTS units (hash TEXT, name TEXT, '
+                        'allele TEXT, length INTEGER, predictor TEXT, version TEXT, '
+                        'output TEXT, stats TEXT, '
+                        'PRIMARY KEY (hash, allele, length, predictor, version, output))')
+        self.db.commit()
+        return
+
+    def done(self, predictor, version, length, output='all'):
+        """Completed (hash, allele) pairs"""
+
+        cur = self.db.execute('SELECT hash, allele FROM units WHERE predictor=? '
+                              'AND version=? AND length=? AND output=?',
+                              (predictor, version, length, output))
+        return set(cur.fetchall())
+
+    def count(self, predictor):
+        cur = self.db.execute('SELECT COUNT(*) FROM units WHERE predictor=?', (predictor,))
+        return cur.fetchone()[0]
+
+    def runs(self, predictor, names=None):
+        """(version, length, output) of the units saved for a predictor,
+           optionally only for some protein names"""
+
+        cur = self.db.execute('SELECT DISTINCT version, length, output, name '
+                              'FROM units WHERE predictor=?', (predictor,))
+        rows = cur.fetchall()
+        if names is not None:
+            names = set(names)
+            rows = [r for r in rows if r[3] in names]
+        return set([(v, l, o) for v,l,o,n in rows])
+
+    def add(self, units, predictor, version, length, output='all', stats=None):
+        """Record units given as (hash, name, allele) tuples, with their
+           AlleleSummary from stats keyed by (name, allele) if given"""
+
+        if stats is None:
+            stats = {}
+        rows = []
+        for h,n,a in units:
+            s = stats.get((n,a))
+            if s is not None:
+                s = s.dumps()
+            rows.append((h, n, a, length, predictor, version, output, s))
+        self.db.executemany('INSERT OR REPLACE INTO units VALUES (?,?,?,?,?,?,?,?)', rows)
+        self.db.commit()
+        return
+
+    def summary(self, predictor, scorekey='score', ascending=False, top=50):
+        """Summary of all saved units of a predictor, see AlleleSummary"""
+
+        cur = self.db.execute('SELECT stats FROM units WHERE predictor=? AND '
+                              'stats IS NOT NULL', (predictor,))
+        return AlleleSummary.loads([r[0] for r in cur.fetchall()], scorekey,
+                                   ascending, top)
+
+    def clear(self, predictor, names=None):
+        """Remove the units of a predictor, for all or some protein names"""
+
+        if names is None:
+            self.db.execute('DELETE FROM units WHERE predictor=?', (predictor,))
+        else:
+            self.db.executemany('DELETE FROM units WHERE predictor=? AND name=?',
+                                [(predictor, n) for n in names])
+        self.db.commit()
+        return
+
+    def to_dataframe(self):
+        return pd.read_sql('SELECT hash, name, allele, length, predictor, version, output '
+                           'FROM units', self.db)
+
+    def close(self):
+        self.db.close()
+        return
+
+class DatabaseSink(object):
+    """Buffer predictions and append them to a results database,
+       see ResultDB"""
+
+    def __init__(self, path, predictor, buffer_rows=500000):
+        self.db = ResultDB(path)
+        self.predictor = predictor
+        self.buffer_rows = buffer_rows
+        self.buffer = []
+        self.rows = 0
+        return
+
+    def write(self, df):
+        self.buffer.append(df)
+        self.rows += len(df)
+        if self.rows >= self.buffer_rows:
+            self.flush()
+        return
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.db.save(pd.concat(self.buffer), self.predictor)
+        self.buffer = []
+        self.rows = 0
+        return
+
+    def close(self):
+        self.flush()
+        self.db.close()
+        return
+
+def is_arrow(filename):
+    """Check if a file is in the Arrow IPC file format"""
+
+    if not os.path.isfile(filename):
+        return False
+    with open(filename, 'rb') as f:
+        return f.read(6) == b'ARROW1'
+
+class ArrowSink(object):
+    """
+    Write predictions to a single Arrow IPC (Feather v2) file, one record
+    batch per protein as they arrive. Run metadata such as the method, length
+    and alleles is stored in the schema. Requires pyarrow.
+    """
+
+    def __init__(self, filename, meta=None):
+        require_pyarrow()
+        self.filename = filename
+        self.meta = meta or {}
+        self.writer = None
+        self.schema = None
+        return
+
+    def write(self, df):
+        import json
+        pa = require_pyarrow()
+        if len(df) == 0:
+            return
+        if self.writer is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            self.schema = table.schema.with_metadata(
+                            {'epitopepredict': json.dumps(self.meta)})
+            self.writer = pa.ipc.new_file(self.filename, self.schema)
+        table = pa.Table.from_pandas(df[self.schema.names], schema=self.schema,
+                                     preserve_index=False)
+        #one batch per protein so they can be read individually
+        self.writer.write_batch(table.combine_chunks().to_batches()[0])
+        return
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        return
+
+class ArrowResults(object):
+    """
+    Read predictions saved by ArrowSink. The file is memory mapped and
+    proteins are found by their record batch so any one can be read without
+    loading the rest.
+    """
+
+    def __init__(self, filename):
+        import json
+        pa = require_pyarrow()
+        self.filename = filename
+        self.source = pa.memory_map(filename, 'r')
+        self.reader = pa.ipc.open_file(self.source)
+        meta = self.reader.schema.metadata or {}
+        self.meta = json.loads(meta.get(b'epitopepredict', b'{}'))
+        self.index = {}
+        for i in range(self.reader.num_record_batches):
+            b = self.reader.get_batch(i)
+            if b.num_rows > 0:
+                self.index[b.column('name')[0].as_py()] = i
+        return
+
+    def __repr__(self):
+        return 'arrow results for %s proteins' %len(self.index)
+
+    def names(self):
+        return list(self.index.keys())
+
+    def to_table(self, names=None):
+        """Arrow table of all or some proteins, data is not copied"""
+
+        pa = require_pyarrow()
+        if names is None:
+            return self.reader.read_all()
+        batches = [self.reader.get_batch(self.index[n]) for n in names if n in self.index]
+        return pa.Table.from_batches(batches, schema=self.reader.schema)
+
+    def to_dataframe(self, names=None):
+        """Dataframe of all or some proteins, numeric columns are converted
+           without copying where possible"""
+
+        return self.to_table(names).to_pandas(split_blocks=True)
+
+    def close(self):
+        self.source.close()
+        return
+
+class CallbackSink(object):
+    """Pass each set of predictions to a function"""
+
+    def __init__(self, func):
+        self.func = func
+        return
+
+    def write(self, df):
+        self.func(df)
+        return
+
+    def close(self):
+        return
+
+def save_stats(df, path, label):
+    """Save run statistics with the results in path, these are put in a
+       _stats folder so they are ignored when loading results"""
+
+    statspath = os.path.join(path, '_stats')
+    if not os.path.exists(statspath):
+        os.makedirs(statspath)
+    filename = os.path.join(statspath, label+'.csv')
+    df.to_csv(filename)
+    return filename
+
+def load_stats(path, label):
+    """Load run statistics saved with save_stats"""
+
+    filename = os.path.join(path, '_stats', label+'.csv')
+    if not os.path.exists(filename):
+        return
+    return pd.read_csv(filename, index_col=0)
+
+class QuantileSketch(object):
+    """
+    Mergeable KLL sketch of a stream of scores. Values are kept in a
+    hierarchy of compactors where an item at level h stands for 2**h values,
+    full levels are sorted and every other item promoted. Quantile queries
+    have a rank error of about 1.7/k of the number of values.
+    """
+
+    def __init__(self, k=200, seed=None):
+        self.k = k
+        self.levels = [np.array([])]
+        self.random = np.random.RandomState(seed)
+        return
+
+    def __repr__(self):
+        return 'quantile sketch of %s values in %s items' %(self.count(), self.size())
+
+    def count(self):
+        return int(sum([len(l)*2**h for h,l in enumerate(self.levels)]))
+
+    def size(self):
+        return sum([len(l) for l in self.levels])
+
+    def capacity(self, h):
+        H = len(self.levels)
+        return max(2, int(np.ceil(self.k*(2/3.)**(H-h-1))))
+
+    def update(self, values):
+        """Add an array of values, nans are ignored"""
+
+        x = np.asarray(values, dtype=float)
+        x = x[~np.isnan(x)]
+        self.levels[0] = np.concatenate([self.levels[0], x])
+        self.compress()
+        return
+
+    def compress(self):
+        h = 0
+        while h < len(self.levels):
+            l = self.levels[h]
+            if len(l) >= self.capacity(h):
+                if h+1 == len(self.levels):
+                    self.levels.append(np.array([]))
+                l = np.sort(l)
+                #an even number of items is compacted, any odd one stays
+                m = len(l) - len(l)%2
+                offset = self.random.randint(2)
+                self.levels[h+1] = np.concatenate([self.levels[h+1], l[offset:m:2]])
+                self.levels[h] = l[m:]
+            h += 1
+        return
+
+    def merge(self, other):
+        for h,l in enumerate(other.levels):
+            if h == len(self.levels):
+                self.levels.append(np.array([]))
+            self.levels[h] = np.concatenate([self.levels[h], l])
+        self.compress()
+        return
+
+    def quantile(self, q):
+        """Approximate value at quantile q of all values added"""
+
+        x = np.concatenate(self.levels)
+        if len(x) == 0:
+            return np.nan
+        w = np.concatenate([np.full(len(l), 2**h) for h,l in enumerate(self.levels)])
+        i = np.argsort(x, kind='mergesort')
+        c = np.cumsum(w[i])
+        j = np.searchsorted(c, q*c[-1], side='left')
+        return x[i][min(j, len(x)-1)]
+
+    def to_dataframe(self):
+        df = pd.DataFrame({'level': np.concatenate([np.full(len(l), h, dtype=int)
+                                                    for h,l in enumerate(self.levels)]),
+                           'value': np.concatenate(self.levels)})
+        return df
+
+    @classmethod
+    def from_dataframe(cls, df, k=200):
+        s = cls(k)
+        n = int(df.level.max())+1 if len(df) > 0 else 1
+        s.levels = [df.value.values[df.level.values==h].astype(float) for h in range(n)]
+        return s
+
+def load_sketches(path):
+    """Per allele quantile sketches saved with a run, see AlleleSummary"""
+
+    df = load_stats(path, 'sketches')
+    if df is None:
+        return {}
+    return dict([(a, QuantileSketch.from_dataframe(g)) for a,g in df.groupby('allele')])
+
+def sketch_cutoffs(sketches, cutoff=5, ascending=False):
+    """Approximate per allele score cutoffs at a percentile from sketches,
+       the equivalent of get_cutoffs without the data"""
+
+    q = cutoff/100. if ascending == True else 1-cutoff/100.
+    return pd.Series(dict([(a, sketches[a].quantile(q)) for a in sketches]))
+
+class TopBinders(object):
+    """
+    Best n predictions per allele over all proteins and per protein/allele,
+    kept as predictions arrive. Each update is trimmed back to n rows per
+    group so memory is bounded by the number of groups.
+    """
+
+    def __init__(self, scorekey='score', ascending=False, n=50):
+        self.scorekey = scorekey
+        self.ascending = ascending
+        self.n = n
+        self.alleles = None
+        self.proteins = []
+        return
+
+    def top(self, df, by):
+        df = df.sort_values([self.scorekey,'name','pos'],
+                            ascending=[self.ascending,True,True])
+        return df.groupby(by, sort=False, observed=True).head(self.n)
+
+    def update(self, df):
+        if len(df) == 0:
+            return
+        p = self.top(df, ['name','allele'])
+        self.proteins.append(p)
+        if self.alleles is not None:
+            p = pd.concat([self.alleles, p])
+        self.alleles = self.top(p, 'allele')
+        return
+
+    def merge(self, other):
+        self.proteins.extend(other.proteins)
+        x = [df for df in [self.alleles, other.alleles] if df is not None]
+        if len(x) > 0:
+            #the same predictions can be in both, e.g. saved and reloaded
+            x = pd.concat(x).drop_duplicates(['name','allele','pos'])
+            self.alleles = self.top(x, 'allele')
+        return
+
+    @classmethod
+    def load(cls, path, scorekey='score', ascending=False, n=50):
+        """Top binders saved with the results in path by AlleleSummary"""
+
+        t = cls(scorekey, ascending, n)
+        df = load_stats(path, 'top_allele')
+        if df is not None and len(df) > 0:
+            t.alleles = df
+        df = load_stats(path, 'top_protein')
+        if df is not None and len(df) > 0:
+            t.proteins = [df]
+        return t
+
+    def by_allele(self):
+        """Top n of each allele"""
+
+        if self.alleles is None:
+            return pd.DataFrame()
+        return self.alleles.sort_values(['allele',self.scorekey],
+                            ascending=[True,self.ascending]).reset_index(drop=True)
+
+    def by_protein(self):
+        """Top n of each protein/allele"""
+
+        if len(self.proteins) == 0:
+            return pd.DataFrame()
+        df = pd.concat(self.proteins, ignore_index=True)
+        if len(self.proteins) > 1:
+            df = df.drop_duplicates(['name','allele','pos']).reset_index(drop=True)
+        return df
+
+class AlleleSummary(object):
+    """
+    Per allele summary statistics of predictions, accumulated as they are made.
+    Includes a quantile sketch of the scores for each allele and the top
+    predictions, see TopBinders. Summaries from different workers can be merged.
+    """
+
+    def __init__(self, scorekey='score', ascending=False, top=50):
+        self.scorekey = scorekey
+        self.stats = {}
+        self.sketches = {}
+        self.top = TopBinders(scorekey, ascending, top)
+        return
+
+    def update(self, df, binders=False):
+        """Add a set of predictions, or binders if binders is True"""
+
+        if len(df) == 0:
+            return
+        s = df[self.scorekey].astype(float)
+        if binders == False:
+            self.top.update(df)
+            for a,v in s.groupby(df.allele.values):
+                if a not in self.sketches:
+                    self.sketches[a] = QuantileSketch()
+                self.sketches[a].update(v.values)
+        g = s.groupby(df.allele)
+        x = pd.DataFrame({'n': g.count(), 'sum': g.sum(),
+                          'sumsq': (s**2).groupby(df.allele).sum(),
+                          'min': g.min(), 'max': g.max()})
+        for a,r in x.iterrows():
+            if a not in self.stats:
+                self.stats[a] = {'n':0, 'sum':0., 'sumsq':0., 'min':np.inf,
+                                 'max':-np.inf, 'binders':0}
+            st = self.stats[a]
+            if binders == True:
+                st['binders'] += int(r.n)
+                continue
+            st['n'] += int(r.n)
+            st['sum'] += r['sum']
+            st['sumsq'] += r['sumsq']
+            st['min'] = min(st['min'], r['min'])
+            st['max'] = max(st['max'], r['max'])
+        return
+
+    def merge_stats(self, stats, sketches):
+        for a in stats:
+            o = stats[a]
+            if a not in self.stats:
+                self.stats[a] = dict(o)
+                continue
+            st = self.stats[a]
+            for k in ['n','sum','sumsq','binders']:
+                st[k] += o[k]
+            st['min'] = min(st['min'], o['min'])
+            st['max'] = max(st['max'], o['max'])
+        for a in sketches:
+            if a not in self.sketches:
+                self.sketches[a] = QuantileSketch()
+            self.sketches[a].merge(sketches[a])
+        return
+
+    def merge(self, other):
+        self.merge_stats(other.stats, other.sketches)
+        self.top.merge(other.top)
+        return
+
+    def dumps(self):
+        """Summary as a json string, used to save the statistics of each
+           unit in a run manifest"""
+
+        top = self.top.by_protein()
+        d = {'stats': self.stats,
+             'sketches': dict([(a, [l.tolist() for l in self.sketches[a].levels])
+                               for a in self.sketches]),
+             'top': top.to_json(orient='split', index=False) if len(top) > 0 else None}
+        return json.dumps(d)
+
+    @classmethod
+    def loads(cls, strings, scorekey='score', ascending=False, top=50):
+        """Merge summaries saved with dumps"""
+
+        s = cls(scorekey, ascending, top)
+        tops = []
+        for x in strings:
+            d = json.loads(x)
+            sketches = {}
+            for a in d['sketches']:
+                sketches[a] = QuantileSketch()
+                sketches[a].levels = [np.array(l, dtype=float) for l in d['sketches'][a]]
+            s.merge_stats(d['stats'], sketches)
+            if d['top'] is not None:
+                tops.append(pd.read_json(io.StringIO(d['top']), orient='split',
+                                         dtype=False, convert_dates=False))
+        if len(tops) > 0:
+            df = pd.concat(tops, ignore_index=True)
+            s.top.proteins = [df]
+            s.top.alleles = s.top.top(df, 'allele')
+        return s
+
+    def save(self, path):
+        """Save all summaries with the results in path"""
+
+        save_stats(self.to_dataframe(sums=True), path, 'summary')
+        save_stats(self.sketch_frame(), path, 'sketches')
+        save_stats(self.top.by_allele(), path, 'top_allele')
+        save_stats(self.top.by_protein(), path, 'top_protein')
+        return
+
+    @classmethod
+    def load(cls, path, scorekey='score', ascending=False, top=50):
+        """Summaries and top binders saved with the results in path"""
+
+        s = cls(scorekey, ascending, top)
+        df = load_stats(path, 'summary')
+        if df is not None:
+            for a,r in df.iterrows():
+                s.stats[a] = {'n':int(r.n), 'sum':r['sum'], 'sumsq':r['sumsq'],
+                              'min':r['min'], 'max':r['max'], 'binders':int(r.binders)}
+        s.sketches = load_sketches(path)
+        s.top = TopBinders.load(path, scorekey, ascending, top)
+        return s
+
+    def sketch_frame(self):
+        """All sketches as one dataframe for saving"""
+
+        res = []
+        for a in self.sketches:
+            df = self.sketches[a].to_dataframe()
+            df['allele'] = a
+            res.append(df)
+        if len(res) == 0:
+            return pd.DataFrame(columns=['level','value','allele'])
+        return pd.concat(res, ignore_index=True)
+
+    def to_dataframe(self, sums=False):
+        """Per allele statistics, with the sums needed to merge them if sums
+           is True"""
+
+        df = pd.DataFrame(self.stats).T
+        if len(df) == 0:
+            return df
+        df[['n','binders']] = df[['n','binders']].astype(int)
+        df['mean'] = df['sum']/df.n
+        df['std'] = np.sqrt(np.clip(df.sumsq/df.n - df['mean']**2, 0, None))
+        df.index.name = 'allele'
+        cols = ['n','binders','mean','std','min','max']
+        if sums == True:
+            cols += ['sum','sumsq']
+        return df[cols]
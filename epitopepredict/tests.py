@@ -7,7 +7,8 @@
 """
 
 from __future__ import absolute_import, print_function
-import sys, os
+import sys, os, shutil
+import numpy as np
 import pandas as pd
 import unittest
 from . import base, analysis, sequtils
@@ -71,6 +72,103 @@ class PredictorTests(unittest.TestCase):
             print ('%s binders' %len(b))
         return
 
+    def test_iedb_batch(self):
+        """IEDB tool run in-process on batches, with a stand-in tool"""
+
+        import tempfile
+        tool = '\n'.join([
+            'class Prediction(object):',
+            '    instances = 0',
+            '    seq_num = True',
+            '    def __init__(self):',
+            '        Prediction.instances += 1',
+            '        self.calls = 0',
+            '    def commandline_input(self, args):',
+            '        method, allele, length, fname = args',
+            '        self.calls += 1',
+            '        recs = open(fname).read().split(\'>\')[1:]',
+            '        seqs = [\'\'.join(r.split()[1:]) for r in recs]',
+            '        cols = [\'allele\',\'start\',\'peptide\',\'method\',\'percentile_rank\',\'ann_ic50\']',
+            '        if self.seq_num: cols.insert(1, \'seq_num\')',
+            '        print (\'\\t\'.join(cols))',
+            '        for i,s in enumerate(seqs):',
+            '            for j in range(len(s)-int(length)+1):',
+            '                p = s[j:j+int(length)]',
+            '                row = [allele, j+1, p, 1.0, method, 100+sum(map(ord,p))%500]',
+            '                if self.seq_num: row.insert(1, i+1)',
+            '                print (\'\\t\'.join(map(str,row)))'])
+        path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(path, 'src'))
+        script = os.path.join(path, 'src', 'predict_binding.py')
+        with open(script, 'w') as f:
+            f.write(tool)
+        oldpath = base.iedbmhc1path
+        base.iedbmhc1path = path
+        try:
+            P = base.get_predictor('iedbmhc1')
+            alleles = ["HLA-A*01:01"]
+            P.predictProteins(self.df, length=9, alleles=alleles)
+            x = P.data.sort_values(['name','pos']).reset_index(drop=True)
+            t = base.iedb_tools[script][0]
+            self.assertEqual((t.instances, t.calls), (1, 1))
+            seqs = dict(zip(self.df.locus_tag, self.df.translation))
+            self.assertEqual(len(x), sum([len(seqs[n])-8 for n in seqs]))
+            r = x.iloc[-1]
+            self.assertEqual(r.peptide, seqs[r['name']][r.pos:r.pos+9])
+            #without seq_num the output can't be split so each sequence is run singly
+            t.seq_num = False
+            P.predictProteins(self.df, length=9, alleles=alleles)
+            self.assertEqual(t.calls, 2+len(seqs))
+            y = P.data.sort_values(['name','pos']).reset_index(drop=True)
+            cols = [c for c in x.columns if c != 'seq_num']
+            pd.testing.assert_frame_equal(x[cols], y[cols])
+            #versions without a method are for the default, not the last used
+            P.iedbmethod = 'smm'
+            self.assertEqual(P.version(), P.version('IEDB_recommended'))
+        finally:
+            base.iedbmhc1path = oldpath
+            shutil.rmtree(path)
+        df = pd.DataFrame({'pos':[1,2]})
+        self.assertTrue(base.split_iedb_batch(df, ['a'])['a'] is df)
+        self.assertEqual(base.split_iedb_batch(df, ['a','b']), None)
+        return
+
+    def test_iedb_imports(self):
+        """In-process IEDB tools with modules of the same name stay separate"""
+
+        import tempfile
+        stdout = sys.stdout
+        syspath = list(sys.path)
+        tool = '\n'.join([
+            'import util',
+            'class Prediction(object):',
+            '    def commandline_input(self, args):',
+            '        import util',
+            '        print (util.name)'])
+        paths = []
+        for name in ['mhc1','mhc2']:
+            path = tempfile.mkdtemp()
+            os.mkdir(os.path.join(path, 'src'))
+            with open(os.path.join(path, 'src', 'predict_binding.py'), 'w') as f:
+                f.write(tool)
+            with open(os.path.join(path, 'src', 'util.py'), 'w') as f:
+                f.write('name = \'%s\'' %name)
+            paths.append(path)
+        try:
+            for i in range(2):
+                for name, path in zip(['mhc1','mhc2'], paths):
+                    script = os.path.join(path, 'src', 'predict_binding.py')
+                    res = base.run_iedb_tool(script, [])
+                    self.assertEqual(res.strip(), name.encode())
+                    self.assertTrue(base.iedb_tools[script] is not None)
+            self.assertFalse('util' in sys.modules)
+            self.assertEqual(sys.path, syspath)
+            self.assertTrue(sys.stdout is stdout)
+        finally:
+            for path in paths:
+                shutil.rmtree(path)
+        return
+
     def test_iedbmhc2(self):
         """IEDB MHCII test"""
 
@@ -102,6 +200,532 @@ class PredictorTests(unittest.TestCase):
         P.predictProteins(df, names=names, path=self.testdir)
         return'''
 
+    def test_mhcflurry_cache(self):
+        """Cached MHCflurry model used for batches, with a stand-in model"""
+
+        class Model(object):
+            calls = 0
+            def predict_to_dataframe(self, peptides, allele):
+                Model.calls += 1
+                return pd.DataFrame({'peptide': peptides, 'allele': allele,
+                                     'prediction': [100.+sum(map(ord,p))%500 for p in peptides]})
+
+        old = base.mhcflurry_predictor
+        base.mhcflurry_predictor = Model()
+        try:
+            self.assertTrue(base.get_mhcflurry_predictor() is base.mhcflurry_predictor)
+            P = base.get_predictor('mhcflurry')
+            alleles = ["HLA-A*01:01", "HLA-A*02:01"]
+            P.predictProteins(self.df, length=9, alleles=alleles)
+            #one model call per allele for all proteins
+            self.assertEqual(Model.calls, len(alleles))
+            x = P.data.sort_values(['name','allele','pos']).reset_index(drop=True)
+            P.batch_size = 1
+            P.predictProteins(self.df, length=9, alleles=alleles)
+            y = P.data.sort_values(['name','allele','pos']).reset_index(drop=True)
+            pd.testing.assert_frame_equal(x, y)
+        finally:
+            base.mhcflurry_predictor = old
+        return
+
+    def test_bcell_scales(self):
+        """Native bcell scale methods"""
+
+        from . import bcell
+        scale = dict(zip(bcell.AAletters, [0.5+i*0.1 for i in range(20)]))
+        seqs = {'a':'MKLVAAGLLLAAWYRST', 'b':'MKA'}
+        df = bcell.predict_proteins(seqs, scale, 'Parker')
+        self.assertEqual(len(df), 11)
+        pep = df.iloc[0].Peptide
+        self.assertAlmostEqual(df.iloc[0].Score, sum([scale[a] for a in pep])/7., 3)
+        t = bcell.thresholds(df, 'Parker')
+        self.assertAlmostEqual(t['a'], df[df.name=='a'].Score.mean(), 3)
+        df = bcell.predict_proteins(seqs, scale, 'Emini')
+        pep = df.iloc[0].Peptide
+        self.assertAlmostEqual(df.iloc[0].Score, np.prod([scale[a] for a in pep])*0.37**-6, 3)
+        df = bcell.predict_proteins(seqs, scale, 'Kolaskar-Tongaonkar')
+        pep = df.iloc[-1].Peptide
+        self.assertAlmostEqual(df.iloc[-1].Score, sum([scale[a] for a in pep])/7., 3)
+        #Karplus-Schulz scales depend on the rigid neighbours in each protein
+        from collections import OrderedDict
+        seqs = OrderedDict([('a','MKLVAAGLLLAAWYRST'), ('b','MGKSTDEW')])
+        df = bcell.predict_proteins(seqs, None, 'Karplus-Schulz')
+        for n in seqs:
+            s = seqs[n]
+            r = [(i>0 and s[i-1] in bcell.rigid) + (i<len(s)-1 and s[i+1] in bcell.rigid)
+                 for i in range(len(s))]
+            v = [bcell.karplus_schulz[r[i]][s[i]] for i in range(len(s))]
+            x = [round(np.mean(v[i:i+7]), 3) for i in range(len(s)-6)]
+            self.assertEqual(list(df[df.name==n].Score), x)
+        return
+
+    def test_bcell_iedb(self):
+        """Native bcell methods against the IEDB tool output"""
+
+        from . import bcell
+        P = base.get_predictor('iedbbcell')
+        P.path = '/local/bcell_standalone'
+        if not os.path.exists(P.path):
+            print ('IEDB bcell tools not found')
+            return
+        seq = self.df.translation.iloc[0]
+        cols = ['Start','End','Peptide','Score']
+        for m in bcell.methods:
+            P.iedbmethod = m
+            P.native = False
+            x = P.predict(sequence=seq, name='a').reset_index(drop=True)
+            t = P.threshold
+            P.native = True
+            y = P.predict(sequence=seq, name='a').reset_index(drop=True)
+            pd.testing.assert_frame_equal(x[cols], y[cols], check_dtype=False)
+            self.assertAlmostEqual(t, P.threshold, 3)
+        return
+
+    def test_calibrate(self):
+        """Percentile ranks from calibrated scores"""
+
+        import tempfile
+        P = base.get_predictor('tepitope')
+        alleles = ["HLA-DRB1*0101"]
+        P.calibrate(alleles=alleles, length=11, n=1000, seed=1, save=False)
+        P.predictProteins(self.df, length=11, alleles=alleles)
+        #calibrating again keeps the data and summary of these predictions
+        x, s = P.data, P.summary
+        P.calibrate(alleles=alleles, length=11, n=1000, seed=1, save=False)
+        self.assertTrue(P.data is x and P.summary is s)
+        b = P.getBinders(cutoff=5, cutoff_method='percentile')
+        self.assertTrue((b.perc_rank <= 5).all())
+        #saved calibration is keyed by method and version
+        tmp = tempfile.mkdtemp()
+        fname = P.save_calibration(os.path.join(tmp, 'cal.npz'))
+        P2 = base.get_predictor('tepitope')
+        P2.load_calibration(fname)
+        self.assertEqual(P2.calibration_version, P.version())
+        P2.predictProteins(self.df, length=11, alleles=alleles)
+        self.assertTrue('perc_rank' in P2.data.columns)
+        #not used for predictions from a different version
+        P2.calibration_version = P.version('other')
+        P2.predictProteins(self.df, length=11, alleles=alleles)
+        self.assertFalse('perc_rank' in P2.data.columns)
+        #binders can only be kept by percentile rank with a calibration
+        P.predictProteins(self.df, length=11, alleles=alleles, output='binders',
+                          cutoff=5, cutoff_method='percentile')
+        self.assertEqual(len(P.data), len(b))
+        path = os.path.join(tmp, 'results')
+        with self.assertRaises(ValueError):
+            P2.predictProteins(self.df, length=11, alleles=alleles, path=path,
+                               output='binders', cutoff_method='percentile')
+        self.assertFalse(os.path.exists(path))
+        with self.assertRaises(ValueError):
+            P.predictProteins(self.df, length=9, alleles=alleles, output='binders',
+                              cutoff_method='percentile')
+        shutil.rmtree(tmp)
+        return
+
+    def test_compact(self):
+        """Compact in-memory results"""
+
+        P = base.get_predictor('tepitope')
+        alleles = ["HLA-DRB1*0101", "HLA-DRB1*0305"]
+        P.predictProteins(self.df, length=11, alleles=alleles, compact=True)
+        self.assertFalse('peptide' in P.data.columns)
+        b = P.getBinders(cutoff=5)
+        seq = P.sequences[b.iloc[0]['name']]
+        pos = b.iloc[0].pos
+        self.assertEqual(b.iloc[0].peptide, seq[pos:pos+11])
+        #accessors and save expand the data
+        r = P.rankedBinders()
+        self.assertTrue((r.peptide.str.len() == 11).all())
+        path = os.path.join(self.testdir, 'compact')
+        P.save(prefix=path)
+        name = P.data.name.astype(str).iloc[0]
+        x = pd.read_csv(os.path.join(path, P.name, name+'.csv'))
+        self.assertTrue('peptide' in x.columns and 'core' in x.columns)
+        self.assertEqual(len(x), (P.data.name==name).sum())
+        shutil.rmtree(path)
+        with self.assertRaises(ValueError):
+            base.expand_data(P.data)
+        #every row is checked before peptides are dropped
+        df = base.expand_data(P.data, P.sequences)
+        self.assertTrue(base.check_peptides(df, P.sequences))
+        df.loc[df.index[-1], 'peptide'] = 'X'*11
+        self.assertFalse(base.check_peptides(df, P.sequences))
+        self.assertTrue('peptide' in base.compact_data(df, P.sequences).columns)
+        return
+
+    def test_tracks(self):
+        """Round trip of score tracks for plain and compacted data"""
+
+        from . import storage
+        P = base.get_predictor('tepitope')
+        alleles = ["HLA-DRB1*0101", "HLA-DRB1*0305"]
+        P.predictProteins(self.df, length=11, alleles=alleles)
+        cols = ['name','allele','pos','peptide']
+        x = P.data.sort_values(cols[:3]).reset_index(drop=True)
+        path = os.path.join(self.testdir, 'tracks')
+        P.save_tracks(path)
+        T = storage.ScoreTracks(path)
+        self.assertEqual(T.meta['dtype'], 'float32')
+        self.assertEqual(T.names(), sorted(x.name.unique()))
+        P2 = base.get_predictor('tepitope')
+        P2.load_tracks(path)
+        y = P2.data.sort_values(cols[:3]).reset_index(drop=True)
+        pd.testing.assert_frame_equal(x[cols], y[cols])
+        #float32 scores are close but not exact
+        self.assertTrue(np.allclose(x.score, y.score, rtol=1e-6))
+        P.predictProteins(self.df, length=11, alleles=alleles, compact=True)
+        P.save_tracks(path)
+        y = storage.ScoreTracks(path).to_dataframe()
+        y = y.sort_values(cols[:3]).reset_index(drop=True)
+        pd.testing.assert_frame_equal(x[cols], y[cols])
+        shutil.rmtree(path)
+        return
+
+    def test_binders_output(self):
+        """Only keep binders when predicting"""
+
+        P = base.get_predictor('tepitope')
+        alleles = ["HLA-DRB1*0101", "HLA-DRB1*0305"]
+        P.predictProteins(self.df, length=11, alleles=alleles,
+                          output='binders', cutoff=5, cutoff_method='rank')
+        self.assertTrue((P.data['rank'] <= 5).all())
+        s = P.summary.to_dataframe()
+        self.assertEqual(s.binders.sum(), len(P.data))
+        return
+
+    def test_stream_errors(self):
+        """Bad cutoff methods raise and sinks are closed on errors"""
+
+        import tempfile
+        from . import storage
+        P = base.get_predictor('tepitope')
+        alleles = ["HLA-DRB1*0101", "HLA-DRB1*0305"]
+        with self.assertRaises(ValueError):
+            P.iter_binders([], cutoff_method='default')
+        with self.assertRaises(ValueError):
+            P.predictProteins(self.df, length=11, alleles=alleles,
+                              output='binders', cutoff_method='default')
+        class Sink(storage.CallbackSink):
+            closed = False
+            def close(self):
+                self.closed = True
+        def fail(df):
+            raise IOError('disk full')
+        sinks = [Sink(lambda x: None), Sink(fail)]
+        with self.assertRaises(IOError):
+            P.stream(self.df, sinks, alleles=alleles, length=11, seqkey='translation')
+        self.assertTrue(all([s.closed for s in sinks]))
+        #a failed run only records the units that were saved
+        path = tempfile.mkdtemp()
+        predict_batch = P.predict_batch
+        def second_allele_fails(seqs, allele, **kwargs):
+            if allele == alleles[1]:
+                raise RuntimeError('predictor failed')
+            return predict_batch(seqs, allele=allele, **kwargs)
+        P.predict_batch = second_allele_fails
+        with self.assertRaises(RuntimeError):
+            P.predictProteins(self.df, length=11, alleles=alleles, path=path)
+        m = storage.RunManifest(path).to_dataframe()
+        self.assertTrue((m.allele == alleles[0]).all())
+        self.assertTrue(len(m) > 0)
+        del P.predict_batch
+        P.predictProteins(self.df, length=11, alleles=alleles, path=path, overwrite=False)
+        P.load(path)
+        x = P.data
+        P.predictProteins(self.df, length=11, alleles=alleles)
+        self.assertEqual(len(x), len(P.data))
+        #the summaries include the units saved before the failure
+        s = storage.AlleleSummary.load(path).to_dataframe()
+        self.assertEqual(s.n.to_dict(), x.groupby('allele').size().to_dict())
+        shutil.rmtree(path)
+        return
+
+    def test_resume(self):
+        """Resume and extend saved runs using the manifest"""
+
+        import tempfile
+        from . import storage
+        P = base.get_predictor('tepitope')
+        alleles = ["HLA-DRB1*0101", "HLA-DRB1*0305"]
+        path = tempfile.mkdtemp()
+        P.predictProteins(self.df, length=11, alleles=alleles[:1], path=path)
+        n1 = len(storage.load_csv_folder(path))
+        #resuming a complete run predicts nothing
+        P.predictProteins(self.df, length=11, alleles=alleles[:1], path=path, overwrite=False)
+        self.assertEqual(len(storage.load_csv_folder(path)), n1)
+        #extending with an allele only adds that allele
+        P.predictProteins(self.df, length=11, alleles=alleles, path=path, overwrite=False)
+        x = storage.load_csv_folder(path)
+        P.predictProteins(self.df, length=11, alleles=alleles)
+        self.assertEqual(len(x), len(P.data))
+        self.assertFalse(x.duplicated(['name','allele','pos']).any())
+        #saved summaries include the earlier run
+        s = storage.AlleleSummary.load(path)
+        a = P.summary.to_dataframe().sort_index()
+        b = s.to_dataframe().sort_index()
+        pd.testing.assert_frame_equal(a, b, check_dtype=False, check_names=False)
+        for k in alleles:
+            self.assertEqual(s.sketches[k].count(), P.summary.sketches[k].count())
+        cols = ['name','allele','pos','peptide','score']
+        for by in ['allele','protein']:
+            a = P.top_binders(by=by).sort_values(cols[:3]).reset_index(drop=True)
+            b = P.top_binders(path, by=by).sort_values(cols[:3]).reset_index(drop=True)
+            pd.testing.assert_frame_equal(a[cols], b[cols], check_dtype=False)
+        #overwriting some proteins keeps the summaries of the others
+        names = list(x.name.unique())
+        P.predictProteins(self.df, length=11, alleles=alleles, path=path,
+                          names=names[:1])
+        s = storage.AlleleSummary.load(path)
+        self.assertEqual(s.to_dataframe().n.to_dict(), x.groupby('allele').size().to_dict())
+        self.assertEqual(set(s.top.by_protein().name), set(names))
+        #another length is refused and the files are unchanged
+        with self.assertRaises(ValueError):
+            P.predictProteins(self.df, length=9, alleles=alleles, path=path, overwrite=False)
+        self.assertEqual(len(storage.load_csv_folder(path)), len(x))
+        #overwriting replaces the results and the manifest
+        P.predictProteins(self.df, length=9, alleles=alleles[:1], path=path)
+        P.predictProteins(self.df, length=9, alleles=alleles[:1], path=path, overwrite=False)
+        x = storage.load_csv_folder(path)
+        self.assertTrue((x.peptide.str.len() == 9).all())
+        self.assertFalse(x.duplicated(['name','allele','pos']).any())
+        m = storage.RunManifest(path)
+        self.assertEqual(m.runs(P.name), set([(P.version(), 9, 'all')]))
+        self.assertTrue(len(m.done(P.name, P.version(), 9)) > 0)
+        m.clear(P.name)
+        m.close()
+        #results from before manifests are checked too
+        with self.assertRaises(ValueError):
+            P.predictProteins(self.df, length=11, alleles=alleles, path=path, overwrite=False)
+        shutil.rmtree(path)
+        return
+
+    def test_resume_legacy(self):
+        """Extend results saved before manifests with another allele"""
+
+        import tempfile
+        from . import storage
+        P = base.get_predictor('tepitope')
+        alleles = ["HLA-DRB1*0101", "HLA-DRB1*0305"]
+        P.predictProteins(self.df, length=11, alleles=alleles)
+        n = len(P.data)
+        for format in ['csv','sqlite']:
+            path = tempfile.mkdtemp()
+            P.predictProteins(self.df, length=11, alleles=alleles[:1], path=path,
+                              format=format)
+            os.remove(os.path.join(path, '_manifest.sqlite'))
+            P.predictProteins(self.df, length=11, alleles=alleles, path=path,
+                              format=format, overwrite=False)
+            P.load(path)
+            self.assertEqual(len(P.data), n)
+            self.assertEqual(sorted(P.data.allele.unique()), alleles)
+            m = storage.RunManifest(path).to_dataframe()
+            self.assertEqual(len(m), len(self.df)*len(alleles))
+            shutil.rmtree(path)
+        return
+
+    def test_csv_sink(self):
+        """Rows with other columns are appended to csv files"""
+
+        import tempfile
+        from . import storage
+        P = base.get_predictor('tepitope')
+        alleles = ["HLA-DRB1*0101", "HLA-DRB1*0305"]
+        P.predictProteins(self.df, length=11, alleles=alleles, names=['ZEBOVgp1'])
+        a = P.data[P.data.allele==alleles[0]]
+        b = P.data[P.data.allele==alleles[1]].copy()
+        b['perc_rank'] = 1.0
+        path = tempfile.mkdtemp()
+        sink = storage.CSVSink(path, append=True)
+        sink.write(a)
+        sink.write(b)
+        sink.write(a)
+        x = pd.read_csv(os.path.join(path, 'ZEBOVgp1.csv'))
+        self.assertEqual(len(x), 2*len(a)+len(b))
+        self.assertEqual(x.perc_rank.notnull().sum(), len(b))
+        shutil.rmtree(path)
+        return
+
+    def test_resume_output(self):
+        """Runs with another output mode or cutoff aren't resumed"""
+
+        import tempfile
+        from . import storage
+        P = base.get_predictor('tepitope')
+        alleles = ["HLA-DRB1*0101", "HLA-DRB1*0305"]
+        path = tempfile.mkdtemp()
+        kwargs = dict(length=11, alleles=alleles, path=path, output='binders',
+                      cutoff=5, cutoff_method='rank')
+        P.predictProteins(self.df, **kwargs)
+        n = len(storage.load_csv_folder(path))
+        P.predictProteins(self.df, overwrite=False, **kwargs)
+        self.assertEqual(len(storage.load_csv_folder(path)), n)
+        with self.assertRaises(ValueError):
+            P.predictProteins(self.df, length=11, alleles=alleles, path=path,
+                              overwrite=False)
+        kwargs['cutoff'] = 10
+        with self.assertRaises(ValueError):
+            P.predictProteins(self.df, overwrite=False, **kwargs)
+        self.assertEqual(len(storage.load_csv_folder(path)), n)
+        shutil.rmtree(path)
+        return
+
+    def test_promiscuous_reference(self):
+        """Promiscuous binders against the previous groupby implementation"""
+
+        def reference(P, binders, n=1, unique_core=True):
+            grps = binders.groupby(['peptide','pos','name'])
+            func, skname = max, 'max'
+            s = grps.agg({'allele':pd.Series.count,
+                          'core': base.first, P.scorekey:[func,np.mean],
+                          'rank': np.median})
+            s.columns = s.columns.get_level_values(1)
+            s.rename(columns={skname: P.scorekey, 'count': 'alleles','median':'median_rank',
+                              'first':'core'}, inplace=True)
+            s = s.reset_index()
+            s = s.sort_values(['alleles','median_rank'],ascending=[False,True])
+            if unique_core == True:
+                s = s.drop_duplicates('core')
+            return s[s.alleles>=n]
+
+        P = base.get_predictor('tepitope')
+        alleles = ["HLA-DRB1*0101", "HLA-DRB1*0305", "HLA-DRB1*0401"]
+        P.predictProteins(self.df, length=11, alleles=alleles)
+        for cutoff in [2,5,10]:
+            b = P.getBinders(cutoff=cutoff)
+            for n in [1,2,3]:
+                for u in [True, False]:
+                    x = P.promiscuousBinders(binders=b, n=n, unique_core=u)
+                    y = reference(P, b, n, u)
+                    self.assertTrue(len(x) > 0 or n == 3)
+                    pd.testing.assert_frame_equal(x, y, check_dtype=False)
+        #the same rows from a stream of proteins, cores keep the best row
+        stream = [df for n,df in P.data.groupby('name', sort=False)]
+        b = P.getBinders(cutoff=5, cutoff_method='rank')
+        cols = ['name','pos','peptide']
+        for u in [True, False]:
+            x = P.stream_promiscuous(iter(stream), cutoff=5, n=2, unique_core=u)
+            y = P.promiscuousBinders(binders=b, n=2, unique_core=u)
+            self.assertEqual(len(x), len(y))
+            d = x.alleles.diff()
+            self.assertTrue(((d < 0) | ((d == 0) & (x.median_rank.diff() >= 0)) |
+                             d.isnull()).all())
+            if u == False:
+                pd.testing.assert_frame_equal(x.sort_values(cols).reset_index(drop=True),
+                                              y.sort_values(cols).reset_index(drop=True),
+                                              check_dtype=False)
+            else:
+                k = ['core','alleles','median_rank']
+                pd.testing.assert_frame_equal(x[k].sort_values('core').reset_index(drop=True),
+                                              y[k].sort_values('core').reset_index(drop=True),
+                                              check_dtype=False)
+        return
+
+    def test_index(self):
+        """Binders from the sorted score index"""
+
+        P = base.get_predictor('tepitope')
+        alleles = ["HLA-DRB1*0101", "HLA-DRB1*0305"]
+        P.predictProteins(self.df, length=11, alleles=alleles)
+        for c in [1,5,10]:
+            b = P.getBinders(cutoff=c)
+            cuts = P.allele_cutoffs(c)
+            x = P.data[P.data.score > P.data.allele.map(cuts)]
+            self.assertEqual(len(b), len(x))
+            pr = P.promiscuity(cutoff=c, n=2)
+            self.assertTrue((pr.alleles == 2).all())
+        #with a name the cutoffs are from that protein, as before
+        name = P.data.name.iloc[0]
+        for c in [1,5,10]:
+            b = P.getBinders(name=name, cutoff=c)
+            res = []
+            for a,g in P.data[P.data.name==name].groupby('allele'):
+                res.append(g[g.score > g.score.quantile(1-c/100.)])
+            x = pd.concat(res)
+            self.assertEqual(sorted(zip(b.allele, b.pos)), sorted(zip(x.allele, x.pos)))
+        return
+
+    def test_index_inplace(self):
+        """Index is rebuilt when the data is changed in place"""
+
+        P = base.get_predictor('tepitope')
+        alleles = ["HLA-DRB1*0101", "HLA-DRB1*0305"]
+        P.predictProteins(self.df, length=11, alleles=alleles)
+        cols = ['name','allele','pos','peptide','score']
+        def check(method):
+            b = P.getBinders(cutoff=5, cutoff_method=method)
+            x = P.getBinders(cutoff=5, cutoff_method=method, data=P.data.copy())
+            b = b.sort_values(cols[:3]).reset_index(drop=True)
+            x = x.sort_values(cols[:3]).reset_index(drop=True)
+            pd.testing.assert_frame_equal(b[cols], x[cols])
+        for method in ['default','score']:
+            check(method)
+        P.data.sort_values('score', inplace=True)
+        for method in ['default','score']:
+            check(method)
+        i = P.data.index[0]
+        P.data.loc[i, 'score'] = P.data.score.max()+1
+        for method in ['default','score']:
+            check(method)
+        self.assertTrue(i in P.getBinders(cutoff=1).index)
+        #any index type
+        P.data.index = P.data.peptide + P.data.allele
+        check('default')
+        return
+
+    def test_sketch(self):
+        """Merged quantile sketches"""
+
+        from . import storage
+        x = np.random.RandomState(1).normal(size=100000)
+        s1 = storage.QuantileSketch(seed=1)
+        s2 = storage.QuantileSketch(seed=2)
+        s1.update(x[:50000])
+        s2.update(x[50000:])
+        s1.merge(s2)
+        self.assertEqual(s1.count(), len(x))
+        v = s1.quantile(0.95)
+        self.assertTrue(abs((x < v).mean() - 0.95) < 0.01)
+        return
+
+    def test_consensus(self):
+        """Align predictions with different allele names"""
+
+        self.assertEqual(base.normalise_allele('HLA-DRB1*0101'), 'HLA-DRB1*01:01')
+        P1 = base.get_predictor('tepitope')
+        P1.predictProteins(self.df, length=11, alleles=["HLA-DRB1*0101"])
+        P2 = base.get_predictor('tepitope')
+        P2.predictProteins(self.df, length=11, alleles=["HLA-DRB1*01:01"])
+        df = base.consensus([P1,P2], method='mean')
+        self.assertEqual(len(df), len(P1.data))
+        self.assertTrue((df.score_tepitope == df.score_tepitope_1).all())
+        #different predictors with other alleles only align in an outer join
+        class Model(object):
+            def predict_to_dataframe(self, peptides, allele):
+                return pd.DataFrame({'peptide': peptides, 'allele': allele,
+                                     'prediction': [100.+sum(map(ord,p))%500 for p in peptides]})
+        old = base.mhcflurry_predictor
+        base.mhcflurry_predictor = Model()
+        try:
+            P3 = base.get_predictor('mhcflurry')
+            P3.predictProteins(self.df, length=11, alleles=["HLA-A*02:01"])
+        finally:
+            base.mhcflurry_predictor = old
+        self.assertEqual(len(base.consensus([P1,P3])), 0)
+        df = base.consensus([P1,P3], how='outer')
+        self.assertEqual(len(df), len(P1.data)+len(P3.data))
+        t = df.allele == 'HLA-DRB1*01:01'
+        self.assertEqual(t.sum(), len(P1.data))
+        self.assertTrue(df.score_mhcflurry[t].isnull().all())
+        self.assertTrue(df.score_tepitope[~t].isnull().all())
+        self.assertFalse(df.peptide.isnull().any())
+        self.assertTrue((df.consensus_rank[t] == df.rank_tepitope[t]).all())
+        self.assertTrue((df.consensus_rank[~t] == df.rank_mhcflurry[~t]).all())
+        #predictors without data give an empty frame
+        P4 = base.get_predictor('tepitope')
+        self.assertEqual(len(base.align_predictions([P4, base.get_predictor('tepitope')])), 0)
+        self.assertEqual(len(base.consensus([P1,P4])), 0)
+        return
+
     def test_fasta(self):
         """Test fasta predictions"""
 
@@ -120,18 +744,386 @@ class PredictorTests(unittest.TestCase):
         P.load(infile)
         return
 
+    def test_load_cache(self):
+        """Cached csv folder is invalidated when files change"""
+
+        try:
+            import pyarrow
+        except ImportError:
+            print ('pyarrow not installed')
+            return
+        import tempfile
+        from . import storage
+        P = base.get_predictor('tepitope')
+        alleles = ["HLA-DRB1*0101", "HLA-DRB1*0305"]
+        path = os.path.join(tempfile.mkdtemp(), 'results')
+        P.predictProteins(self.df, length=11, alleles=alleles, path=path)
+        cfile = storage.cache_file(path)
+        x = storage.load_csv_folder(path, cache=True)
+        self.assertTrue(os.path.exists(cfile))
+        y = storage.load_csv_folder(path, cache=True)
+        pd.testing.assert_frame_equal(x, y)
+        #removing a file
+        files = storage.get_csv_files(path)
+        removed = storage.read_csv(files[0])
+        os.remove(files[0])
+        y = storage.load_csv_folder(path, cache=True)
+        self.assertEqual(len(y), len(x)-len(removed))
+        #adding a file
+        removed.to_csv(os.path.join(path, 'extra.csv'))
+        y = storage.load_csv_folder(path, cache=True)
+        self.assertEqual(len(y), len(x))
+        self.assertEqual(len(storage.load_csv_folder(path, cache=True)), len(x))
+        shutil.rmtree(os.path.dirname(path))
+        return
+
+    def test_arrow(self):
+        """Arrow output of plain and compacted data"""
+
+        try:
+            import pyarrow
+        except ImportError:
+            print ('pyarrow not installed')
+            return
+        import tempfile
+        from . import storage
+        P = base.get_predictor('tepitope')
+        alleles = ["HLA-DRB1*0101", "HLA-DRB1*0305"]
+        P.predictProteins(self.df, length=11, alleles=alleles)
+        cols = ['name','allele','pos','peptide','core','score','rank']
+        x = P.data.sort_values(cols[:3]).reset_index(drop=True)
+        path = tempfile.mkdtemp()
+        filename = os.path.join(path, 'results.arrow')
+        P.save_arrow(filename)
+        r = storage.ArrowResults(filename)
+        self.assertEqual(r.meta['length'], 11)
+        self.assertEqual(r.meta['version'], P.version())
+        self.assertEqual(sorted(r.names()), sorted(x.name.unique()))
+        name = x.name.iloc[0]
+        y = r.to_dataframe([name]).reset_index(drop=True)
+        self.assertEqual(len(y), (x.name==name).sum())
+        r.close()
+        P2 = base.get_predictor('tepitope')
+        P2.load(filename)
+        y = P2.data.sort_values(cols[:3]).reset_index(drop=True)
+        pd.testing.assert_frame_equal(x[cols], y[cols], check_dtype=False)
+        P.predictProteins(self.df, length=11, alleles=alleles, compact=True)
+        P.save_arrow(filename)
+        P2.load(filename)
+        y = P2.data.sort_values(cols[:3]).reset_index(drop=True)
+        pd.testing.assert_frame_equal(x[cols], y[cols], check_dtype=False)
+        shutil.rmtree(path)
+        return
+
     def test_save(self):
         """Test saving"""
 
+        try:
+            import pyarrow
+        except ImportError:
+            print ('pyarrow not installed')
+            return
+        import tempfile
+        from . import storage
+        P = base.get_predictor('tepitope')
+        alleles = ["HLA-DRB1*0101", "HLA-DRB1*0305"]
+        path = tempfile.mkdtemp()
+        P.predictProteins(self.df, length=11, alleles=alleles, path=path,
+                          format='parquet')
+        n = len(storage.load_dataset(path, P.name))
+        P.load(path, names=['ZEBOVgp1'], alleles=alleles[:1])
+        self.assertEqual(list(P.data.name.unique()), ['ZEBOVgp1'])
+        self.assertEqual(list(P.data.allele.unique()), alleles[:1])
+        #predicting some proteins again only replaces their results
+        P.predictProteins(self.df, length=11, alleles=alleles, path=path,
+                          format='parquet', names=['ZEBOVgp1'])
+        x = storage.load_dataset(path, P.name)
+        self.assertEqual(len(x), n)
+        self.assertEqual(sorted(x.name.unique()), sorted(self.df.locus_tag.unique()))
+        self.assertFalse(x.duplicated(['name','allele','pos']).any())
+        m = storage.RunManifest(path)
+        self.assertEqual(len(m.to_dataframe()), len(self.df)*len(alleles))
+        m.close()
+        #clear removes all saved results of the predictor
+        P.predictProteins(self.df, length=11, alleles=alleles, path=path,
+                          format='parquet', names=['ZEBOVgp1'], clear=True)
+        self.assertEqual(storage.dataset_names(path, P.name), ['ZEBOVgp1'])
+        shutil.rmtree(path)
+        return
+
+    def test_query(self):
+        """Test querying a results database"""
+
+        import tempfile
+        P = base.get_predictor('tepitope')
+        alleles = ["HLA-DRB1*0101", "HLA-DRB1*0305"]
+        path = tempfile.mkdtemp()
+        P.predictProteins(self.df, length=11, alleles=alleles, path=path,
+                          format='sqlite')
+        df = P.query(path, alleles=alleles[:1], filters=[('rank','<',5)])
+        self.assertEqual(list(df.allele.unique()), alleles[:1])
+        self.assertTrue((df['rank'] < 5).all())
+        df = P.query(path, names=['ZEBOVgp1'], start=100, end=200)
+        self.assertTrue(df.pos.between(100, 200).all())
+        #predicting some proteins again only replaces their results
+        n = len(P.query(path))
+        P.predictProteins(self.df, length=11, alleles=alleles, path=path,
+                          format='sqlite', names=['ZEBOVgp1'])
+        x = P.query(path)
+        self.assertEqual(len(x), n)
+        self.assertEqual(sorted(x.name.unique()), sorted(self.df.locus_tag.unique()))
+        self.assertFalse(x.duplicated(['name','allele','pos']).any())
+        shutil.rmtree(path)
         return
 
     def test_analysis(self):
         """Test analysis methods"""
 
-        #get binders for an entire set of saved results
-        #b = analysis.getAllBinders(path, method='tepitope', n=3)
+        P = base.get_predictor('tepitope')
+        alleles = ["HLA-DRB1*0101", "HLA-DRB1*0305"]
+        P.predictProteins(self.df, length=11, alleles=alleles)
+        b = P.getBinders(cutoff=5)
         #find clusters of binders in these results
-        #cl = analysis.findClusters(b, method, dist=9, minsize=3)
+        cl = analysis.find_clusters(b, min_binders=2)
+        self.assertTrue((cl.binders >= 2).all())
+        #proteins without binders
+        self.assertEqual(len(analysis.find_clusters(b.iloc[:0])), 0)
+        self.assertEqual(base.dbscan(x=[]), [])
+        #n-mers around each binder
+        x = analysis.get_nmer(b, self.df, length=20, how='split')
+        self.assertEqual(len(x), len(b))
+        return
+
+    def test_nmer_reference(self):
+        """N-mers against the previous row by row implementation"""
+
+        def center_nmer(x, n):
+            seq = x['translation']
+            size = x.end-x.start
+            l = int((size-n)/2.0)
+            if size>n:
+                if size%2 == 1: l1 = l+1
+                else: l1=l
+            else:
+                if size%2 == 1: l1 = l-1
+                else: l1=l
+            start = x.start+l1
+            end = x.end-l
+            if start<=0:
+                d=1-start
+                start = start+d
+                end = end+d
+            return seq[start:end]
+
+        def split_nmer(x, n, key, margin=3):
+            size = x.end-x.start
+            if size <= n+margin:
+                seq = center_nmer(x, n)
+                return pd.DataFrame({'peptide': seq,
+                                     'start':x.start,'end':x.end},index=[0])
+            seq = x[key]
+            o=size%n
+            if o<=margin:
+                size=size-o
+                seq = center_nmer(x, size)
+            seqs=[]
+            S=[];E=[]
+            if x.start==0: s=1
+            else: s=0
+            for i in range(s, size, n):
+                if i+n>size:
+                    seqs.append(seq[o:o+n])
+                    S.append(x.start+o)
+                    E.append(x.start+o+n)
+                else:
+                    seqs.append(seq[i:i+n])
+                    S.append(x.start+i)
+                    E.append(x.start+i+n)
+            return pd.DataFrame({'peptide':pd.Series(seqs),'start':S,'end':E})
+
+        g = self.df.drop_duplicates('locus_tag')
+        prot = g.iloc[0]
+        seq = prot.translation
+        L = len(seq)
+        #short, long and trimmed rows, at the start and the end of the sequence
+        coords = [(0,9),(0,11),(0,30),(0,45),(2,13),(5,35),(10,31),(20,65),(40,62),
+                  (L-9,L),(L-11,L),(L-30,L),(L-43,L),(L-2,L)]
+        df = pd.DataFrame([(prot.locus_tag, s, e, seq[s:e]) for s,e in coords],
+                          columns=['name','start','end','peptide'])
+        temp = df.merge(g[['locus_tag','translation']], left_on='name',
+                        right_on='locus_tag', how='left').set_index(df.index)
+        for n in [9, 20]:
+            for margin in [1, 3]:
+                x = analysis.get_nmer(df, g, length=n, how='split', margin=margin)
+                res = []
+                for i,r in temp.iterrows():
+                    d = split_nmer(r, n, 'peptide', margin)
+                    d.index = pd.Index([i]*len(d), name='index')
+                    res.append(d)
+                y = pd.concat(res)[['peptide','start','end']]
+                pd.testing.assert_frame_equal(x, y, check_dtype=False)
+            x = analysis.get_nmer(df, g, length=n, how='center')
+            y = temp.apply(lambda r: center_nmer(r, n), 1)
+            self.assertEqual(list(x), list(y))
+            self.assertTrue((x.index == df.index).all())
+        return
+
+    def test_overlaps_reference(self):
+        """Overlap counts against the previous row by row implementation"""
+
+        def reference(df1, df2, label='overlap', how='inside'):
+            new = []
+            a = base.get_coords(df1)
+            b = base.get_coords(df2)
+            def overlap(x,y):
+                f=0
+                for i,r in y.iterrows():
+                    if how == 'inside':
+                        if ((x.start<=r.start) & (x.end>=r.end)):
+                            f+=1
+                    elif how == 'any':
+                        if ((x.start<r.start) & (x.end>r.start)) or \
+                           ((x.start>r.start) & (x.start<r.end)):
+                            f+=1
+                return f
+            for n,df in a.groupby('name'):
+                found = b[b.name==n]
+                df[label] = df.apply(lambda r: overlap(r,found),axis=1)
+                new.append(df)
+            return pd.concat(new)
+
+        P = base.get_predictor('tepitope')
+        alleles = ["HLA-DRB1*0101", "HLA-DRB1*0305", "HLA-DRB1*0401"]
+        P.predictProteins(self.df, length=11, alleles=alleles)
+        pb = P.promiscuousBinders(cutoff=5, n=2)
+        b = P.getBinders(cutoff=10)
+        #random intervals including zero length ones
+        rs = np.random.RandomState(1)
+        names = pb.name.unique()
+        r = pd.DataFrame({'name': rs.choice(names, 300), 'start': rs.randint(0, 300, 300)})
+        r['end'] = r.start + rs.randint(0, 20, 300)
+        for df2 in [b, r]:
+            for how in ['inside','any']:
+                x = analysis.get_overlaps(pb.copy(), df2.copy(), how=how)
+                y = reference(pb.copy(), df2.copy(), how=how)
+                self.assertTrue(y.overlap.sum() > 0)
+                pd.testing.assert_frame_equal(x, y, check_dtype=False)
+        return
+
+    def test_matches_reference(self):
+        """Peptide matches and coverage against the previous find loops"""
+
+        import math
+        from . import peptutils
+        #overlapping and repeated patterns
+        pats = ['AA','AAA','A','AB','BAB','AB','ABA','C']
+        text = 'AAABABAABAAAB'
+        m = peptutils.Matcher(pats)
+        x = sorted(m.iter(text))
+        y = sorted([(i+len(p)-1, j) for j,p in enumerate(pats)
+                    for i in range(len(text)) if text.startswith(p, i)])
+        self.assertEqual(x, y)
+        self.assertEqual(list(m.first(text)), [text.find(p) for p in pats])
+        self.assertEqual(m.found(text), set([j for j,p in enumerate(pats) if p in text]))
+        aln = pd.DataFrame({'name':['a','b','c'], 'seq':[text, text[::-1], 'CAB']})
+        x = analysis.find_conserved_sequences(pats, aln)
+        f = [[r.find(p) for p in pats] for r in aln.seq]
+        y = pd.DataFrame(f, columns=pats, index=aln.name).replace(-1,np.nan)
+        y[y>0] = 1
+        pd.testing.assert_frame_equal(x, y, check_dtype=False)
+
+        def coverage(expdata, binders, key='sequence', perc=50):
+            def getcoverage(data, peptides, key):
+                target = math.ceil(len(data)*perc/100.0)
+                found=[]
+                count=0
+                for p in peptides:
+                    for i,r in data.iterrows():
+                        if r[key] in found:
+                            continue
+                        if r[key].find(p)!=-1 or p.find(r[key])!=-1:
+                            found.append(r[key])
+                            continue
+                    count+=1
+                    if len(found) >= target:
+                        return count
+                return count
+            total = 0
+            for name, data in expdata.groupby('name'):
+                peptides = binders[binders.name==name].peptide
+                if len(peptides) == 0:
+                    continue
+                total += getcoverage(data, peptides, key)
+            return round(total/float(len(binders))*100,2)
+
+        P = base.get_predictor('tepitope')
+        alleles = ["HLA-DRB1*0101", "HLA-DRB1*0305"]
+        P.predictProteins(self.df, length=11, alleles=alleles)
+        b = P.promiscuousBinders(cutoff=5, n=1)
+        #experimental peptides overlap binders and each other and are repeated
+        rs = np.random.RandomState(2)
+        seqs = dict(zip(self.df.locus_tag, self.df.translation))
+        rows = []
+        for i in rs.randint(0, len(b), 100):
+            r = b.iloc[i]
+            st = max(r.pos + rs.randint(-4, 5), 0)
+            rows.append((r['name'], seqs[r['name']][st:st+rs.randint(6, 20)]))
+        exp = pd.DataFrame(rows+rows[:20], columns=['name','sequence'])
+        for perc in [10,30,50,90]:
+            self.assertEqual(analysis.prediction_coverage(exp, b, perc=perc),
+                             coverage(exp, b, perc=perc))
+        return
+
+    def test_peptide_features(self):
+        """Vectorised peptide properties"""
+
+        from Bio.SeqUtils.ProtParam import ProteinAnalysis
+        seqs = ['MKLVAAGLLLAAWYRST', 'PETER', 'DDEKR']
+        df = analysis.peptide_properties(pd.DataFrame({'peptide':seqs}))
+        for s,pi,mw in zip(seqs, df.pI, df.mw):
+            X = ProteinAnalysis(s)
+            self.assertAlmostEqual(pi, X.isoelectric_point(), 6)
+            self.assertAlmostEqual(mw, X.molecular_weight(), 6)
+        self.assertEqual(list(df.net_charge), [2, -1, -1])
+        return
+
+    def test_require_pyarrow(self):
+        """Clear error for formats needing pyarrow when it is missing"""
+
+        from . import storage
+        saved = sys.modules.get('pyarrow')
+        sys.modules['pyarrow'] = None
+        try:
+            with self.assertRaises(ImportError) as e:
+                storage.DatasetSink(self.testdir, 'tepitope')
+            self.assertTrue('epitopepredict[parquet]' in str(e.exception))
+        finally:
+            if saved is None:
+                del sys.modules['pyarrow']
+            else:
+                sys.modules['pyarrow'] = saved
+        return
+
+    def test_random_peptides(self):
+        """Encoded random peptides and amino acid frequencies"""
+
+        from . import peptutils, bcell
+        self.assertTrue(bcell.encode is peptutils.encode)
+        x = peptutils.encode('ACDXy')
+        idx = [peptutils.AAletters.index(a) for a in 'ACDY']
+        self.assertEqual(list(x), idx[:3]+[20]+idx[3:])
+        self.assertEqual(peptutils.decode(x[[0,1,2,4]].reshape(1,-1)), ['ACDY'])
+        f = peptutils.aa_frequencies()
+        self.assertAlmostEqual(f.sum(), 1.0)
+        f = peptutils.aa_frequencies(['AAAC', 'XA'])
+        self.assertAlmostEqual(f[peptutils.AAletters.index('A')], 0.8)
+        self.assertAlmostEqual(f[peptutils.AAletters.index('C')], 0.2)
+        arrs = list(peptutils.random_peptide_arrays(2500, 9, freqs=f, seed=1, chunksize=1000))
+        self.assertEqual([len(a) for a in arrs], [1000,1000,500])
+        self.assertTrue(all(a.shape[1] == 9 and a.dtype == np.uint8 for a in arrs))
+        seqs = sum([peptutils.decode(a) for a in arrs], [])
+        self.assertEqual(set(''.join(seqs)), set('AC'))
+        self.assertEqual(seqs[:10], peptutils.create_random_sequences(10, 9, freqs=f, seed=1))
         return
 
     def test_features(self):
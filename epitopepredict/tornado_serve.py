@@ -23,7 +23,7 @@ from bokeh.embed import components
 
 wikipage = 'https://github.com/dmnfarrell/epitopepredict/wiki/Web-Application'
 plotkinds = ['tracks','text','grid']
-cut_methods = ['default','rank','score']
+cut_methods = ['default','rank','score','percentile']
 views = ['binders','promiscuous','by allele','summary']
 
 def help_msg():
@@ -81,7 +81,12 @@ class GlobalViewHandler(RequestHandler):
             msg = help_msg()
             self.render('global.html', form=form, msg=msg, path=path, status=0)
 
-        preds = web.get_predictors(path)
+        if view in ['binders','promiscuous']:
+            #only binders are shown so a database/dataset can be queried by rank
+            filters = web.get_rank_filter(defaultargs['cutoff'], defaultargs['cutoff_method'])
+            preds = web.get_predictors(path, filters=filters)
+        else:
+            preds = web.get_predictors(path)
         data = {}
         if view == 'summary':
             for P in preds:
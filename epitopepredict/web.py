@@ -10,7 +10,7 @@ from __future__ import absolute_import, print_function
 import sys,os,glob
 import pandas as pd
 import numpy as np
-from . import base, plotting, sequtils, analysis
+from . import base, plotting, sequtils, analysis, storage
 from bokeh.models import ColumnDataSource, Slider
 from bokeh.models.widgets import DataTable, TableColumn, Select, Button, Slider, TextInput
 from bokeh.layouts import row, column, gridplot, widgetbox, layout
@@ -24,21 +24,38 @@ def get_file_lists(path):
 
     names = []
     for p in predictors:
-        files = glob.glob(os.path.join(path, p, '*.csv'))
+        ppath = os.path.join(path, p)
+        if storage.is_dataset(ppath):
+            names.extend(storage.dataset_names(ppath, p))
+            continue
+        if storage.is_database(ppath):
+            db = storage.ResultDB(ppath)
+            names.extend(db.names(p))
+            db.close()
+            continue
+        files = glob.glob(os.path.join(ppath, '*.csv'))
         n = [os.path.splitext(os.path.basename(i))[0] for i in files]
         names.extend(n)
     names = set(names)
     names = sorted(names)
     return names
 
-def get_results(path, predictor, name=None):
+def get_results(path, predictor, name=None, filters=None):
+    """Load results for a predictor, filters are (column, operator, value)
+       tuples only applied when the results are in a dataset or database"""
 
     P = base.get_predictor(predictor)
-    if name is not None:
+    ppath = os.path.join(path, predictor)
+    if storage.is_dataset(ppath) or storage.is_database(ppath):
+        names = None
+        if name is not None:
+            names = [name]
+        P.load(path=ppath, names=names, filters=filters)
+    elif name is not None:
         filename = os.path.join(path, predictor, name)
         P.load(filename+'.csv')
     else:
-        P.load(path=os.path.join(path, predictor))
+        P.load(path=os.path.join(path, predictor), cache=True)
     #print filename
     #print P.data
     return P
@@ -78,12 +95,12 @@ def get_alleles(preds):
     a = list(set(a))
     return a
 
-def get_predictors(path, name=None):
+def get_predictors(path, name=None, filters=None):
     """Get a set of predictors with available results"""
 
     preds = []
     for pred in predictors:
-        P = get_results(path, pred, name)
+        P = get_results(path, pred, name, filters)
         if P.data is not None and len(P.data)>0:
             preds.append(P)
     return preds
@@ -237,6 +254,17 @@ def create_bokeh_table(path, name):
     table = DataTable(source=source, columns=columns, width=400, height=280)
     return table
 
+def get_rank_filter(cutoff, cutoff_method):
+    """Filter for loading only the rows that can pass a rank cutoff, so that
+       indexed results don't need to be read in full"""
+
+    if cutoff_method != 'rank':
+        return
+    try:
+        return [('rank','<',float(cutoff))]
+    except ValueError:
+        return
+
 def get_binder_tables(preds, name=None, view='binders', **kwargs):
     """Create html tables of prediction data from predictor objects. The
        data is assumed to be loaded into the predictors.
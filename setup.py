@@ -26,6 +26,7 @@ setup(
                       'wtforms>=2.1',
                       'wtforms_tornado',
                       'future'],
+    extras_require={'parquet': ['pyarrow>=0.17']},
     entry_points = {
         'console_scripts': [
             'epitopepredict=epitopepredict.app:main']